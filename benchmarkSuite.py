@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import numpy
+import dumpROOTEvents
+import jaggedArrays
+import optSelection1D
+import optSelection1DLinear
+import optSelection2D
+import plotAngularDist
+import plotKinematics
+import scanAll
+import syntheticSample
+from columnCache import atomicWrite
+from cutOptimizer import writeResults
+from mcReader import getTree, iterJagged
+from scanEngine import peakMemory, energyLabel, signalPoints
+
+# Throughput of the analysis hot paths on synthetic MCParticles samples.
+# Every stage runs on a sample of each size in a fresh process, with the
+# settings of scanAll, and its events/s and peak resident memory are
+# compared to a stored baseline:
+#
+#   { '<stage>|<nEvents>': { 'eventsPerSecond': ..., 'peakMB': ... } }
+#
+# A stage slower, or using more memory, than the baseline by more than the
+# tolerance is reported as a regression and makes the suite fail.
+
+DefaultBaseline = 'benchmarkBaseline.json'
+
+def stage1D( fName, workDir ):
+
+  optSelection1D.selectEvents( getTree( [ fName ], 'MCParticles' ), scanAll.OneDVars, False, *scanAll.OneDCuts )
+# def stage1D()
+
+def stageLinear( fName, workDir ):
+
+  optSelection1DLinear.selectEvents( getTree( [ fName ], 'MCParticles' ), scanAll.LinearVars, *( scanAll.LinearCuts + scanAll.LinearSlopes ) )
+# def stageLinear()
+
+def stage2D( fName, workDir ):
+
+  optSelection2D.selectEvents( getTree( [ fName ], 'MCParticles' ), scanAll.TwoDVars, *scanAll.TwoDCuts )
+# def stage2D()
+
+def stageAngular( fName, workDir ):
+
+  hMomentumList = plotAngularDist.bookMomentumHistograms( scanAll.AngularMomentumVars, 0, 0 )
+  hAngularList  = plotAngularDist.bookAngularHistograms( scanAll.AngularVars, 0, 0 )
+  plotAngularDist.selectEvents( getTree( [ fName ], 'MCParticles' ), hMomentumList, hAngularList, 0.6 )
+# def stageAngular()
+
+def stageKinematics( fName, workDir ):
+
+  h = plotKinematics.bookHistograms( scanAll.KinematicVars, 0., 0 )
+  plotKinematics.fillHistograms( getTree( [ fName ], 'MCParticles' ), h, scanAll.KinematicVars )
+# def stageKinematics()
+
+def stageDump( fName, workDir ):
+
+  dumpROOTEvents.printEvents( getTree( [ fName ], 'MCParticles' ), os.path.join( workDir, 'dump.dat' ), scanAll.DumpVars )
+# def stageDump()
+
+def stageParticles( fName, workDir ):
+
+  particles = sorted( syntheticSample.Particles.keys() )
+  for columns in iterJagged( getTree( [ fName ], 'MCParticles' ), jaggedArrays.jaggedBranches( particles ) ):
+    jaggedArrays.particleSummary( columns, particles )
+# def stageParticles()
+
+def stageSensitivity( fName, workDir ):
+
+  # scalar_dm_plots on synthetic selection results, without the plots.  It
+  # reads its inputs from the repository directory.
+  resultsName = os.path.join( workDir, 'synthetic_results.npz' )
+  points = [ ( Mass, energyLabel( Mass, Gamma ) ) for Mass, Gamma in signalPoints( scanAll.Masses, [ 1.1, 1.25, 10 ] ) ]
+  Vars = [ 'SmearedReconstructable', 'SmearedReconstructableNoN', 'SmearedVisible', 'SmearedVisibleNon' ]
+  rng = numpy.random.RandomState( 1 )
+  selections = [ [ ( dict( ( var, 0.5 ) for var in Vars ), dict( ( var, rng.uniform( 0.2, 1. ) ) for var in Vars ),
+                     dict( ( var, rng.uniform( 0.1, 100. ) ) for var in Vars ), dict( ( var, 1. ) for var in Vars ) ) for point in points ] ]
+  writeResults( resultsName, [ 1. ], points, Vars, selections )
+
+  repoDir = os.path.dirname( os.path.abspath( __file__ ) )
+  nGrid = str( SensitivityGrid )
+  subprocess.check_call( [ sys.executable, os.path.join( repoDir, 'scalar_dm_plots' ), '-i', resultsName, '-o', workDir,
+                           '-u', '1', '--no-plots', '-g', nGrid, nGrid ], cwd = repoDir )
+# def stageSensitivity()
+
+# The sensitivity stage evaluates SensitivityGrid^2 points whatever the
+# sample size
+SensitivityGrid = 200
+
+# name: ( stage, whether it runs on the events of the sample )
+Stages = { '1D':          ( stage1D, True ),
+           'linear':      ( stageLinear, True ),
+           '2D':          ( stage2D, True ),
+           'angular':     ( stageAngular, True ),
+           'kinematics':  ( stageKinematics, True ),
+           'dump':        ( stageDump, True ),
+           'particles':   ( stageParticles, True ),
+           'sensitivity': ( stageSensitivity, False ) }
+
+StageOrder = [ '1D', 'linear', '2D', 'angular', 'kinematics', 'dump', 'particles', 'sensitivity' ]
+
+def sampleName( workDir, nEvents, fmt = 'root' ):
+
+  return os.path.join( workDir, 'synthetic_atmos_%d.%s' % ( nEvents, fmt ) )
+# def sampleName()
+
+def runStage( stage, fName, workDir ):
+
+  # ( seconds, peak MB of the process and of its children ), in a fresh
+  # worker process
+  start = time.time()
+  Stages[stage][0]( fName, workDir )
+  seconds = time.time() - start
+  main, children = peakMemory()
+  return seconds, max( main, children )
+# def runStage()
+
+def inWorker( function, args ):
+
+  pool = multiprocessing.Pool( 1 )
+  try:
+    return pool.apply( function, args )
+  finally:
+    pool.close()
+    pool.join()
+# def inWorker()
+
+def runSuite( stages, sizes, workDir, fmt = 'root' ):
+
+  # { '<stage>|<nEvents>': { 'nEvents', 'seconds', 'eventsPerSecond', 'peakMB' } }
+  if not os.path.exists( workDir ):
+    os.makedirs( workDir )
+
+  results = {}
+  for nEvents in sizes:
+    fName = sampleName( workDir, nEvents, fmt )
+    if not os.path.exists( fName ):
+      print( 'Generating %d synthetic events in %s' % ( nEvents, fName ) )
+      inWorker( syntheticSample.writeSample, ( fName, nEvents, 'atmos', 1, fmt ) )
+
+    for stage in stages:
+      function, perEvent = Stages[stage]
+      if not perEvent and nEvents != sizes[0]:
+        continue
+      seconds, peakMB = inWorker( runStage, ( stage, fName, workDir ) )
+      n = nEvents if perEvent else SensitivityGrid**2
+      results['%s|%d' % ( stage, nEvents )] = { 'nEvents': n, 'seconds': seconds, 'eventsPerSecond': n/max( seconds, 1e-9 ), 'peakMB': peakMB }
+
+  return results
+# def runSuite()
+
+def compare( results, baseline, tolerance = 0.2 ):
+
+  # [ ( key, result, reference or None, regressions ) ]
+  report = []
+  for key in sorted( results.keys(), key = lambda key: ( StageOrder.index( key.split( '|' )[0] ), int( key.split( '|' )[1] ) ) ):
+    result, reference = results[key], baseline.get( key )
+    regressions = []
+    if reference is not None:
+      if result['eventsPerSecond'] < reference['eventsPerSecond']*( 1. - tolerance ):
+        regressions.append( 'slower' )
+      if result['peakMB'] > reference['peakMB']*( 1. + tolerance ):
+        regressions.append( 'more memory' )
+    report.append( ( key, result, reference, regressions ) )
+  return report
+# def compare()
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Benchmark the analysis stages on synthetic samples.' )
+  parser.add_argument( '-n', dest = 'sizes', type = int, nargs = '+', default = [ 10000, 100000 ],
+                      help = 'The numbers of events of the synthetic samples.  Default 10000 100000.' )
+  parser.add_argument( '-s', dest = 'stages', type = str, nargs = '+', default = StageOrder, choices = StageOrder,
+                      help = 'The stages to run.  Default all of them.' )
+  parser.add_argument( '-w', dest = 'workDir', type = str, default = 'benchmarkData',
+                      help = 'The directory of the synthetic samples and outputs, reused across runs.  Default benchmarkData.' )
+  parser.add_argument( '-f', dest = 'fmt', type = str, default = 'root', choices = [ 'root' ],
+                      help = 'The format of the synthetic samples read by the stages.  Default root.' )
+  parser.add_argument( '-b', dest = 'baseline', type = str, default = DefaultBaseline,
+                      help = 'The baseline file.  Default %(default)s.' )
+  parser.add_argument( '--save', dest = 'save', action = 'store_true',
+                      help = 'Store the results as the new baseline.' )
+  parser.add_argument( '-t', dest = 'tolerance', type = float, default = 0.2,
+                      help = 'The relative loss of throughput, or increase of memory, flagged as a regression.  Default 0.2.' )
+
+  args = parser.parse_args()
+
+  results = runSuite( [ stage for stage in StageOrder if stage in args.stages ], sorted( args.sizes ), args.workDir, args.fmt )
+  baseline = json.load( open( args.baseline ) ) if os.path.exists( args.baseline ) else {}
+
+  nRegressions = 0
+  print( '%-12s %10s %10s %12s %10s %12s' % ( 'stage', 'events', 'seconds', 'events/s', 'peak MB', 'baseline' ) )
+  for key, result, reference, regressions in compare( results, baseline, args.tolerance ):
+    status = '%12.0f' % reference['eventsPerSecond'] if reference is not None else '%12s' % '-'
+    if regressions:
+      status += '  REGRESSION: %s' % ', '.join( regressions )
+      nRegressions += 1
+    print( '%-12s %10d %10.2f %12.0f %10.0f %s' % ( key.split( '|' )[0], result['nEvents'], result['seconds'], result['eventsPerSecond'], result['peakMB'], status ) )
+
+  if args.save:
+    baseline.update( results )
+    atomicWrite( args.baseline, json.dumps( baseline, indent = 2, sort_keys = True ) )
+    print( 'Saved the baseline in %s' % args.baseline )
+
+  if nRegressions and not args.save:
+    sys.exit( 1 )
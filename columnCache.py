@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy
+
+# On-disk cache of the columns read from the input ROOT files.  Every input
+# file gets an entry keyed by its path, size, mtime and content hash, holding
+# one .npy file per tree and column:
+#
+#   <cacheDir>/entries/<key>/meta.json
+#   <cacheDir>/entries/<key>/<tree>/<column>.npy
+#
+# Columns are memory-mapped on later reads, so a cached file is never
+# decompressed again.  The mtime of meta.json marks the last use of an entry
+# and the least recently used entries are evicted above the size cap.
+
+DefaultMaxSize = 20.  # GB
+
+def fileDigest( fName, blockSize = 1 << 20 ):
+
+  h = hashlib.sha1()
+  f = open( fName, 'rb' )
+  block = f.read( blockSize )
+  while block:
+    h.update( block )
+    block = f.read( blockSize )
+  f.close()
+
+  return h.hexdigest()
+# def fileDigest()
+
+def atomicWrite( fName, text ):
+
+  tmpName = '%s.%d.tmp' % ( fName, os.getpid() )
+  f = open( tmpName, 'w' )
+  f.write( text )
+  f.close()
+  os.rename( tmpName, fName )
+# def atomicWrite()
+
+def directorySize( path ):
+
+  size = 0
+  for dirPath, dirNames, fileNames in os.walk( path ):
+    for fileName in fileNames:
+      size += os.path.getsize( os.path.join( dirPath, fileName ) )
+
+  return size
+# def directorySize()
+
+
+class ColumnCache( object ):
+
+  def __init__( self, cacheDir, maxSize = DefaultMaxSize ):
+    self.cacheDir   = cacheDir
+    self.maxBytes   = int( maxSize*1e9 )
+    self.entriesDir = os.path.join( cacheDir, 'entries' )
+    self.hashesDir  = os.path.join( cacheDir, 'hashes' )
+    for d in [ self.entriesDir, self.hashesDir ]:
+      if not os.path.exists( d ):
+        os.makedirs( d )
+
+  def contentHash( self, fName, size, mtime ):
+    # Hash every (path, size, mtime) only once
+    statKey = hashlib.sha1( ( '%s|%d|%r' % ( fName, size, mtime ) ).encode( 'utf-8' ) ).hexdigest()
+    hashFile = os.path.join( self.hashesDir, statKey )
+    if os.path.exists( hashFile ):
+      return open( hashFile ).read().strip()
+    digest = fileDigest( fName )
+    atomicWrite( hashFile, digest )
+    return digest
+
+  def entry( self, fName ):
+    # The entry directory of an input file, created if needed
+    fName = os.path.abspath( fName )
+    stat  = os.stat( fName )
+    digest = self.contentHash( fName, stat.st_size, stat.st_mtime )
+    key = hashlib.sha1( ( '%s|%d|%r|%s' % ( fName, stat.st_size, stat.st_mtime, digest ) ).encode( 'utf-8' ) ).hexdigest()
+    entryDir = os.path.join( self.entriesDir, key )
+    metaFile = os.path.join( entryDir, 'meta.json' )
+    if not os.path.exists( metaFile ):
+      if not os.path.exists( entryDir ):
+        os.makedirs( entryDir )
+      meta = { 'path': fName, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': digest }
+      atomicWrite( metaFile, json.dumps( meta, indent = 2 ) )
+    return entryDir
+
+  def read( self, fName, tName, exprs, reader ):
+    # Columns of one input file, the missing ones are read with
+    # reader( fName, tName, exprs ) -> ( nEntries, chunks ) and written chunk
+    # by chunk before being memory-mapped.
+    entryDir = self.entry( fName )
+    treeDir = os.path.join( entryDir, tName )
+    if not os.path.exists( treeDir ):
+      os.makedirs( treeDir )
+
+    paths = {}
+    for expr in exprs:
+      paths[expr] = os.path.join( treeDir, '%s.npy' % expr.replace( '[', '_' ).replace( ']', '' ) )
+
+    missing = [ expr for expr in exprs if not os.path.exists( paths[expr] ) ]
+    if missing:
+      nEntries, chunks = reader( fName, tName, missing )
+      tmpNames = dict( ( expr, '%s.%d.tmp.npy' % ( paths[expr][:-4], os.getpid() ) ) for expr in missing )
+      arrays = {}
+      start = 0
+      for chunk in chunks:
+        stop = start + len( chunk[missing[0]] )
+        for expr in missing:
+          if expr not in arrays:
+            arrays[expr] = numpy.lib.format.open_memmap( tmpNames[expr], mode = 'w+', dtype = chunk[expr].dtype, shape = ( nEntries, ) )
+          arrays[expr][start:stop] = chunk[expr]
+        start = stop
+      for expr in missing:
+        if expr not in arrays:
+          numpy.save( tmpNames[expr], numpy.zeros( 0 ) )
+        else:
+          arrays[expr].flush()
+          del arrays[expr]
+        os.rename( tmpNames[expr], paths[expr] )
+
+    os.utime( os.path.join( entryDir, 'meta.json' ), None )
+    columns = {}
+    for expr in exprs:
+      columns[expr] = numpy.load( paths[expr], mmap_mode = 'r' )
+
+    if missing:
+      self.evict( keep = entryDir )
+    return columns
+
+  def entries( self ):
+    # [ ( entryDir, meta, lastUsed, bytes ) ] from the least recently used on
+    entries = []
+    for key in os.listdir( self.entriesDir ):
+      entryDir = os.path.join( self.entriesDir, key )
+      metaFile = os.path.join( entryDir, 'meta.json' )
+      if not os.path.exists( metaFile ): continue
+      meta = json.load( open( metaFile ) )
+      entries.append( ( entryDir, meta, os.path.getmtime( metaFile ), directorySize( entryDir ) ) )
+
+    return sorted( entries, key = lambda entry: entry[2] )
+
+  def evict( self, maxBytes = None, keep = None ):
+    if maxBytes is None: maxBytes = self.maxBytes
+    entries = self.entries()
+    total = sum( [ entry[3] for entry in entries ] )
+    removed = []
+    for entryDir, meta, lastUsed, size in entries:
+      if total <= maxBytes: break
+      if entryDir == keep: continue
+      shutil.rmtree( entryDir, ignore_errors = True )
+      total -= size
+      removed.append( meta['path'] )
+    return removed
+
+  def purge( self, fNames = None ):
+    # Remove the entries of the given input files, or everything
+    removed = []
+    if fNames is not None:
+      fNames = [ os.path.abspath( fName ) for fName in fNames ]
+    for entryDir, meta, lastUsed, size in self.entries():
+      if fNames is not None and meta['path'] not in fNames: continue
+      shutil.rmtree( entryDir, ignore_errors = True )
+      removed.append( meta['path'] )
+    if fNames is None:
+      shutil.rmtree( self.hashesDir, ignore_errors = True )
+      os.makedirs( self.hashesDir )
+    return removed
+
+# class ColumnCache
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Inspect or purge the column cache.' )
+  parser.add_argument( 'action', choices = [ 'list', 'purge', 'evict' ], help = 'list the entries, purge them or evict the least recently used ones.' )
+  parser.add_argument( '-c', dest = 'cacheDir', type = str, default = os.environ.get( 'BDM_COLUMN_CACHE' ),
+                      help = 'The cache directory.  Default $BDM_COLUMN_CACHE.' )
+  parser.add_argument( '-i', dest = 'iFiles', type = str, nargs = '+', default = None,
+                      help = 'Only purge the entries of these input files.' )
+  parser.add_argument( '-s', dest = 'maxSize', type = float, default = DefaultMaxSize,
+                      help = 'The size cap in GB used by evict.  Default %(default)s.' )
+
+  args = parser.parse_args()
+
+  if args.cacheDir is None:
+    parser.error( 'no cache directory given (-c or $BDM_COLUMN_CACHE)' )
+
+  cache = ColumnCache( args.cacheDir, args.maxSize )
+
+  if args.action == 'list':
+    total = 0
+    for entryDir, meta, lastUsed, size in cache.entries():
+      total += size
+      columns = []
+      for tName in sorted( os.listdir( entryDir ) ):
+        if os.path.isdir( os.path.join( entryDir, tName ) ):
+          columns += [ '%s/%s' % ( tName, c[:-4] ) for c in sorted( os.listdir( os.path.join( entryDir, tName ) ) ) ]
+      print( '%s  %8.1f MB  last used %s' % ( meta['path'], size/1e6, time.strftime( '%Y-%m-%d %H:%M', time.localtime( lastUsed ) ) ) )
+      print( '    %s' % ', '.join( columns ) )
+    print( 'Total: %.1f MB' % ( total/1e6 ) )
+  elif args.action == 'purge':
+    for path in cache.purge( args.iFiles ):
+      print( 'Removed %s' % path )
+  else:
+    for path in cache.evict():
+      print( 'Evicted %s' % path )
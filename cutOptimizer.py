@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import os
+import numpy
+from profiling import stage
+
+# Scale of the background events to the 40 kton * 10 year exposure
+BackgroundExposure = 40./28.705
+
+def sPrime( sEff, bEvents ):
+
+  # The signal needed for a 5 sigma discovery, to be minimized.  No signal
+  # efficiency means no sensitivity at all: inf instead of a division error.
+  sEff    = numpy.asarray( sEff, dtype = numpy.float64 )
+  bEvents = numpy.asarray( bEvents, dtype = numpy.float64 )
+  with numpy.errstate( divide = 'ignore', invalid = 'ignore' ):
+    Sprime = 25./ (2.*sEff) + numpy.sqrt( 25.*bEvents/ (sEff*sEff) + 625./(4.*sEff*sEff) )
+
+  return numpy.where( sEff > 0., Sprime, numpy.inf )
+# def sPrime()
+
+def fom( sEff, bEvents ):
+
+  # sEff/sqrt(bEvents), to be maximized.  Without background any signal
+  # efficiency is infinitely good and no efficiency is worthless.
+  sEff    = numpy.asarray( sEff, dtype = numpy.float64 )
+  bEvents = numpy.asarray( bEvents, dtype = numpy.float64 )
+  with numpy.errstate( divide = 'ignore', invalid = 'ignore' ):
+    FOM = sEff/numpy.sqrt( bEvents )
+
+  return numpy.where( sEff > 0., numpy.where( bEvents > 0., FOM, numpy.inf ), 0. )
+# def fom()
+
+# name: ( figure of merit, whether it is maximized )
+FiguresOfMerit = { 'Sprime': ( sPrime, False ), 'FOM': ( fom, True ) }
+
+def optimizeCuts( sEff, nBkg, backgroundScale, figure = 'Sprime', valid = None ):
+
+  # Best cut along the last axis of the signal efficiencies sEff, shaped e.g.
+  # ( sample, var, cut ), with the background counts nBkg broadcast against
+  # them.  Cells where valid is False are never picked and the first of equal
+  # figures of merit wins, as in the cut loops.  backgroundScale can also be
+  # an array of scales, that adds its axes in front of the results.  Returns,
+  # all shaped backgroundScale.shape + sEff.shape[:-1],
+  #   ( iBest, figure of merit, efficiency, background, background error )
+  return optimizeBlocks( [ ( sEff, nBkg, valid ) ], backgroundScale, figure )
+# def optimizeCuts()
+
+def optimizeBlocks( blocks, backgroundScale, figure = 'Sprime' ):
+
+  # optimizeCuts over cuts that come in consecutive blocks of the last axis,
+  # ( sEff, nBkg, valid ) each, e.g. built one at a time by a generator.
+  # The scales are evaluated one after the other and only the best cell so
+  # far of every scale is kept, so that the temporaries are those of one
+  # block and one scale, whatever the number of scales.  iBest counts the
+  # cuts from the first block.
+  with stage( 'optimize', '' ):
+    function, maximize = FiguresOfMerit[figure]
+    worst = -numpy.inf if maximize else numpy.inf
+    scales = numpy.asarray( backgroundScale, dtype = numpy.float64 )
+    best = [ None ]*scales.size
+    offset = 0
+
+    for sEff, nBkg, valid in blocks:
+      sEff = numpy.asarray( sEff, dtype = numpy.float64 )
+      nBkg = numpy.broadcast_to( numpy.asarray( nBkg, dtype = numpy.float64 ), sEff.shape )
+
+      for iScale, scale in enumerate( scales.reshape( -1 ) ):
+        merit = function( sEff, nBkg*scale )
+        merit[numpy.isnan( merit )] = worst
+        if valid is not None:
+          merit[~numpy.broadcast_to( valid, merit.shape )] = worst
+
+        iBlock = numpy.argmax( merit, axis = -1 ) if maximize else numpy.argmin( merit, axis = -1 )
+        pick = lambda a: numpy.take_along_axis( a, iBlock[..., numpy.newaxis], axis = -1 )[..., 0]
+        candidate = ( iBlock + offset, pick( merit ), pick( sEff ), pick( nBkg ) )
+
+        if best[iScale] is None:
+          best[iScale] = candidate
+        else:
+          # Strictly better only, the earlier block wins the ties
+          better = candidate[1] > best[iScale][1] if maximize else candidate[1] < best[iScale][1]
+          best[iScale] = tuple( [ numpy.where( better, new, old ) for new, old in zip( candidate, best[iScale] ) ] )
+      offset += sEff.shape[-1]
+
+    cells = best[0][0].shape
+    iBest, merit, eff, bkg = [ numpy.array( [ scaleBest[i] for scaleBest in best ] ).reshape( scales.shape + cells ) for i in range( 4 ) ]
+    scales = scales.reshape( scales.shape + ( 1, )*len( cells ) )
+
+    return iBest, merit, eff, bkg*scales, numpy.sqrt( bkg )*scales
+# def optimizeBlocks()
+
+def nestedCounts( counts, keys, Vars, cuts ):
+
+  # counts[key][var][cut] -> array shaped ( key, var, cut )
+  return numpy.array( [ [ [ counts[key][var][cut] for cut in cuts ] for var in Vars ] for key in keys ], dtype = numpy.float64 )
+# def nestedCounts()
+
+def bestSelections( Vars, label, iBest, eff, bkg, bkgErr ):
+
+  # The ( bestCut, bestEff, bestBkg, bestBkgErr ) dicts keyed by variable of
+  # every sample, label( i ) being the cut of the i-th cell
+  selections = []
+  for iKey in range( iBest.shape[0] ):
+    bestCut, bestEff, bestBkg, bestBkgErr = {}, {}, {}, {}
+    for iVar, var in enumerate( Vars ):
+      bestCut[var]    = label( iBest[iKey, iVar] )
+      bestEff[var]    = float( eff[iKey, iVar] )
+      bestBkg[var]    = float( bkg[iKey, iVar] )
+      bestBkgErr[var] = float( bkgErr[iKey, iVar] )
+    selections.append( ( bestCut, bestEff, bestBkg, bestBkgErr ) )
+
+  return selections
+# def bestSelections()
+
+def parseScales( values ):
+
+  # Background scale factors from the command line, each value either a
+  # number or a 'first:last:n' range of n evenly spaced scales
+  scales = []
+  for value in values:
+    if ':' in value:
+      first, last, n = value.split( ':' )
+      scales += [ float( scale ) for scale in numpy.linspace( float( first ), float( last ), int( n ) ) ]
+    else:
+      scales.append( float( value ) )
+
+  return scales
+# def parseScales()
+
+def writeScanTable( txtFile, bgScales, points, Vars, selections ):
+
+  # One line per background scale, signal point and variable, with
+  # selections[iScale][iPoint] the best selection of points[iPoint] = ( Mass, E )
+  with stage( 'write', '' ):
+    txtFile.write( '# bgScale  Mass  E  variable  cut  efficiency  background  backgroundError\n' )
+    for bgScale, scaleSelections in zip( bgScales, selections ):
+      for ( Mass, Eround ), ( bestCut, bestEff, bestBkg, bestBkgErr ) in zip( points, scaleSelections ):
+        for var in Vars:
+          txtFile.write( '%f  %s  %s  %s  %s  %f  %f  %f\n' % ( bgScale, str(Mass), str(Eround), var, str( bestCut[var] ), bestEff[var], bestBkg[var], bestBkgErr[var] ) )
+# def writeScanTable()
+
+# The columns of the results files, one entry per background scale, signal
+# point and variable
+ResultColumns = [ 'bgScale', 'Mass', 'E', 'variable', 'cut', 'efficiency', 'background', 'backgroundError' ]
+
+def writeResults( fName, bgScales, points, Vars, selections ):
+
+  # The entries of writeScanTable as arrays in an .npz file, read back with
+  # loadResults() without any text parsing
+  with stage( 'write', '' ):
+    rows = []
+    for bgScale, scaleSelections in zip( bgScales, selections ):
+      for ( Mass, Eround ), ( bestCut, bestEff, bestBkg, bestBkgErr ) in zip( points, scaleSelections ):
+        for var in Vars:
+          rows.append( ( bgScale, Mass, Eround, var, str( bestCut[var] ), bestEff[var], bestBkg[var], bestBkgErr[var] ) )
+
+    columns = list( zip( *rows ) ) if rows else [ () ]*len( ResultColumns )
+    arrays = {}
+    for name, column in zip( ResultColumns, columns ):
+      arrays[name] = numpy.array( column, dtype = str if name in [ 'variable', 'cut' ] else numpy.float64 )
+
+    tmpName = '%s.%d.tmp.npz' % ( fName[:-4] if fName.endswith( '.npz' ) else fName, os.getpid() )
+    numpy.savez( tmpName, **arrays )
+    os.rename( tmpName, fName )
+# def writeResults()
+
+def loadResults( fName ):
+
+  # { column: array } of a results file
+  results = numpy.load( fName )
+  return dict( ( name, results[name] ) for name in ResultColumns )
+# def loadResults()
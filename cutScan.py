@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import numpy
+
+# The largest ( event, cut, cut ) block broadcast at once, which keeps the
+# boolean and double temporaries of the grid scans to a few tens of MB
+BroadcastCells = 2**21
+
+def countNotBelow( values, cuts ):
+
+  # Number of values passing "not value < cut" for every cut.  The values are
+  # sorted once, so the cost is O(N log N) whatever the number of cuts.  NaN
+  # sorts last and never compares below a cut, i.e. it passes every cut as in
+  # the per-event loops.
+  s = numpy.sort( numpy.asarray( values, dtype = numpy.float64 ) )
+  return len( s ) - numpy.searchsorted( s, numpy.asarray( cuts, dtype = numpy.float64 ), side = 'left' )
+
+# def countNotBelow()
+
+def notBelowFromBins( binCounts ):
+
+  # The counts of countNotBelow from the number of values in every bin
+  # numpy.searchsorted( cuts, value, side = 'right' ), 0..len(cuts), i.e.
+  # below the first cut, between two cuts or above the last one: the values
+  # of bin b pass the cuts k < b.
+  binCounts = numpy.asarray( binCounts )
+  return numpy.cumsum( binCounts[::-1] )[::-1][1:]
+
+# def notBelowFromBins()
+
+def windowSplitCounts( costheta, p, pBins, lowCuts, highCuts ):
+
+  # Count the events inside every cos(theta) window [ lowCut, highCut ] below
+  # and above every momentum split, the same comparisons as
+  #   not ( costheta < lowCut or costheta > highCut ), p < pBin
+  # Each event is binned once by the number of low cuts, high cuts and
+  # momentum splits it passes, and the (pBin, lowCut, highCut) tensors are
+  # then filled with cumulative sums.  Returns the small-p and large-p count
+  # tensors, both shaped ( len(pBins), len(lowCuts), len(highCuts) ).
+  costheta = numpy.asarray( costheta, dtype = numpy.float64 )
+  p        = numpy.asarray( p, dtype = numpy.float64 )
+  nP, nL, nH = len( pBins ), len( lowCuts ), len( highCuts )
+
+  # An event passes the low cuts j < iLow, the high cuts k >= iHigh and is
+  # below the momentum splits m >= iP.  NaN passes every window cut but is
+  # never below a momentum split.
+  iLow  = numpy.searchsorted( lowCuts, costheta, side = 'right' )
+  iHigh = numpy.where( numpy.isnan( costheta ), 0, numpy.searchsorted( highCuts, costheta, side = 'left' ) )
+  iP    = numpy.searchsorted( pBins, p, side = 'right' )
+
+  shape = ( nP + 1, nL + 1, nH + 1 )
+  counts = numpy.bincount( numpy.ravel_multi_index( ( iP, iLow, iHigh ), shape ),
+                           minlength = shape[0]*shape[1]*shape[2] ).reshape( shape )
+
+  return windowSplitFromBins( counts )
+# def windowSplitCounts()
+
+def windowSplitFromBins( counts ):
+
+  # The small-p and large-p count tensors of windowSplitCounts from the
+  # number of events in every ( iP, iLow, iHigh ) bin, shaped
+  # ( len(pBins) + 1, len(lowCuts) + 1, len(highCuts) + 1 )
+  nP, nH = counts.shape[0] - 1, counts.shape[2] - 1
+  counts = numpy.cumsum( counts[:, ::-1, :], axis = 1 )[:, ::-1, :][:, 1:, :]
+  counts = numpy.cumsum( counts, axis = 2 )[:, :, :nH]
+  counts = numpy.cumsum( counts, axis = 0 )
+
+  small = counts[:nP]
+  large = counts[nP] - small
+
+  return small, large
+# def windowSplitFromBins()
+
+def windowMask( lowCuts, highCuts ):
+
+  # The ( lowCut, highCut ) windows that are actually scanned
+  return numpy.asarray( highCuts )[numpy.newaxis, :] > numpy.asarray( lowCuts )[:, numpy.newaxis]
+
+# def windowMask()
+
+def combineSplit( small, large ):
+
+  # Every ( small-p window, large-p window ) combination for each momentum
+  # split: the result is indexed by
+  #   ( ..., pBin, smallLowCut, smallHighCut, largeLowCut, largeHighCut )
+  return small[..., numpy.newaxis, numpy.newaxis] + large[..., numpy.newaxis, numpy.newaxis, :, :]
+
+# def combineSplit()
+
+def linearCutCounts( costheta, p, intercepts, slopes, maxCells = BroadcastCells ):
+
+  # Count the events passing the linear cut of every ( intercept c, slope ph )
+  # pair, the same comparisons as
+  #   not ( p == 0 or p*( 1 - c ) > ph*( costheta - c ) )
+  # The events are broadcast against the whole grid in blocks of at most
+  # maxCells cells.  Returns the counts shaped ( len(intercepts), len(slopes) ).
+  costheta   = numpy.asarray( costheta, dtype = numpy.float64 )[:, numpy.newaxis, numpy.newaxis]
+  p          = numpy.asarray( p, dtype = numpy.float64 )[:, numpy.newaxis, numpy.newaxis]
+  intercepts = numpy.asarray( intercepts, dtype = numpy.float64 )[numpy.newaxis, :, numpy.newaxis]
+  slopes     = numpy.asarray( slopes, dtype = numpy.float64 )[numpy.newaxis, numpy.newaxis, :]
+
+  counts = numpy.zeros( ( intercepts.shape[1], slopes.shape[2] ), dtype = numpy.int64 )
+  block = max( maxCells//counts.size, 1 )
+  for first in range( 0, len( p ), block ):
+    pBlock, cosBlock = p[first:first + block], costheta[first:first + block]
+    veto = ( pBlock == 0. ) | ( pBlock*( 1. - intercepts ) > slopes*( cosBlock - intercepts ) )
+    counts += len( pBlock ) - numpy.count_nonzero( veto, axis = 0 )
+
+  return counts
+
+# def linearCutCounts()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy
+import optSelection1DLinear
+import optSelection2D
+import scanAll
+from mcReader import getTree, readColumns, leadingExprs, enableCache, DefaultMaxSize
+from cutOptimizer import BackgroundExposure, FiguresOfMerit
+from cutScan import BroadcastCells
+from scanEngine import energyLabel, sampleKey, atmosFiles, signalFiles
+from profiling import stage, eventLoop, setSample, enableProfile, reportProfile
+
+# Search of the best selection over any number of cut dimensions, for
+# selections too large to be scanned exhaustively.  A cut space is a list of
+#
+#   ( dimension name, grid of its cut values )
+#
+# and a selection function select( events, cuts ) returning the mask of the
+# events passing every candidate, shaped ( event, candidate ), the events
+# being a dict of columns shaped ( event, 1 ) and the cuts a dict of the
+# values of every dimension shaped ( 1, candidate ).  The candidates are
+# points of the grids, given by their indices, so that an exhaustive search
+# reproduces the count tensors of optSelection1D, optSelection1DLinear and
+# optSelection2D, and smarter searches only visit a fraction of them.
+
+def angleSelection( events, cuts ):
+
+  # optSelection1D: not ( p == 0 or costheta < cut )
+  return ( events['p'] != 0. ) & ~( events['costheta'] < cuts['costheta'] )
+# def angleSelection()
+
+def linearSelection( events, cuts ):
+
+  # optSelection1DLinear: not ( p == 0 or p*(1-c) > ph*(costheta-c) )
+  p, costheta, c = events['p'], events['costheta'], cuts['costheta']
+  return ~( ( p == 0. ) | ( p*( 1. - c ) > cuts['slope']*( costheta - c ) ) )
+# def linearSelection()
+
+def windowSelection( events, cuts ):
+
+  # optSelection2D: a cos(theta) window below and another one above the
+  # momentum split.  NaN momenta are never below the split and NaN angles
+  # pass every window cut, as in the count tensors.
+  p, costheta = events['p'], events['costheta']
+  small = p < cuts['pBin']
+  inSmall = ~( ( costheta < cuts['smallLow'] ) | ( costheta > cuts['smallHigh'] ) )
+  inLarge = ~( ( costheta < cuts['largeLow'] ) | ( costheta > cuts['largeHigh'] ) )
+  return ( p != 0. ) & ( ( small & inSmall ) | ( ~small & inLarge ) )
+# def windowSelection()
+
+def windowValid( cuts ):
+
+  return ( cuts['smallHigh'] > cuts['smallLow'] ) & ( cuts['largeHigh'] > cuts['largeLow'] )
+# def windowValid()
+
+def momentumSelection( events, cuts ):
+
+  # The 1D angle cut with a momentum window, pLow <= p <= pHigh
+  p = events['p']
+  return angleSelection( events, cuts ) & ~( ( p < cuts['pLow'] ) | ( p > cuts['pHigh'] ) )
+# def momentumSelection()
+
+def momentumValid( cuts ):
+
+  return cuts['pHigh'] > cuts['pLow']
+# def momentumValid()
+
+# name: ( dimensions, selection, validity of the cuts or None ), with the
+# grids of the scripts and scanAll built from their settings
+LinearGrids = optSelection1DLinear.makeCutGrids( *( scanAll.LinearCuts + scanAll.LinearSlopes ) )
+TwoDGrids   = optSelection2D.makeCutGrids( *scanAll.TwoDCuts )
+Spaces = { '1D':       ( [ ( 'costheta', numpy.linspace( *scanAll.OneDCuts ) ) ], angleSelection, None ),
+           'linear':   ( [ ( 'costheta', LinearGrids[0] ),
+                           ( 'slope',    LinearGrids[1] ) ], linearSelection, None ),
+           '2D':       ( [ ( 'pBin',      TwoDGrids[0] ),
+                           ( 'smallLow',  TwoDGrids[1] ),
+                           ( 'smallHigh', TwoDGrids[2] ),
+                           ( 'largeLow',  TwoDGrids[1] ),
+                           ( 'largeHigh', TwoDGrids[2] ) ], windowSelection, windowValid ),
+           'momentum': ( [ ( 'costheta', numpy.linspace( *scanAll.OneDCuts ) ),
+                           ( 'pLow',     numpy.linspace( 0., 2., 21 ) ),
+                           ( 'pHigh',    numpy.linspace( 0.5, 10., 20 ) ) ], momentumSelection, momentumValid ) }
+
+Methods = [ 'grid', 'coordinate', 'random', 'lhs', 'refine' ]
+
+# The candidates evaluated in one go, the events being split so that the
+# ( event, candidate ) masks stay within cutScan.BroadcastCells
+CandidateBlock = 4096
+
+def searchColumns( var ):
+
+  return [ 'isIn10kton' ] + leadingExprs( [ var ], [ 'P', 'Angle' ] )
+# def searchColumns()
+
+def searchEvents( columns, var ):
+
+  # ( { 'p': ..., 'costheta': ... } of the fiducial events, nFiducial )
+  fiducial = columns['isIn10kton'] != 0
+  events = { 'p': columns['%sP[0]' % var][fiducial], 'costheta': numpy.cos( columns['%sAngle[0]' % var][fiducial] ) }
+  return events, int( numpy.count_nonzero( fiducial ) )
+# def searchEvents()
+
+def readEvents( fNames, var, tName = 'MCParticles' ):
+
+  # Read through mcReader.readColumns, i.e. from the column cache when it is
+  # enabled, as the searches go over the same events many times
+  return searchEvents( readColumns( getTree( fNames, tName ), searchColumns( var ) ), var )
+# def readEvents()
+
+
+class CutSpace( object ):
+
+  def __init__( self, dims, select, valid = None ):
+    self.names  = [ name for name, values in dims ]
+    self.grids  = [ numpy.asarray( values, dtype = numpy.float64 ) for name, values in dims ]
+    self.shape  = tuple( len( grid ) for grid in self.grids )
+    self.select = select
+    self.valid  = valid
+
+  def cuts( self, index ):
+    # The cut values of the candidates index, shaped ( candidate, dimension )
+    return dict( ( name, grid[index[:, iDim]] ) for iDim, ( name, grid ) in enumerate( zip( self.names, self.grids ) ) )
+
+  def isValid( self, index ):
+    if self.valid is None:
+      return numpy.ones( len( index ), dtype = bool )
+    return numpy.asarray( self.valid( self.cuts( index ) ), dtype = bool )
+
+  def count( self, events, index ):
+    # The number of events passing every candidate, profiled as a fill of
+    # nEvents*nCandidates events
+    nEvents = len( events[list( events.keys() )[0]] )
+    with stage( 'fill' ) as profileCounts:
+      profileCounts['events'] = nEvents*len( index )
+      return eventLoop( self.countCandidates, events, index, nEvents )
+
+  def countCandidates( self, events, index, nEvents ):
+    counts = numpy.zeros( len( index ), dtype = numpy.int64 )
+    for first in range( 0, len( index ), CandidateBlock ):
+      block = index[first:first + CandidateBlock]
+      cuts = dict( ( name, values[numpy.newaxis, :] ) for name, values in self.cuts( block ).items() )
+      eventBlock = max( BroadcastCells//len( block ), 1 )
+      for start in range( 0, nEvents, eventBlock ):
+        columns = dict( ( name, column[start:start + eventBlock, numpy.newaxis] ) for name, column in events.items() )
+        counts[first:first + len( block )] += numpy.count_nonzero( self.select( columns, cuts ), axis = 0 )
+    return counts
+
+  def label( self, index ):
+    return '_'.join( [ '%f' % grid[i] for grid, i in zip( self.grids, index ) ] )
+
+# class CutSpace
+
+def makeSpace( name ):
+
+  dims, select, valid = Spaces[name]
+  return CutSpace( dims, select, valid )
+# def makeSpace()
+
+
+class CutEvaluator( object ):
+
+  # Figure of merit of candidate cuts of a signal sample against the
+  # background.  Every candidate is evaluated once, the number of distinct
+  # evaluations and the best candidate after each of them are recorded.
+  # The first of equal figures of merit wins, as in the grid scans.
+  def __init__( self, space, signal, background, bgScale = 1., figure = 'Sprime' ):
+    self.space = space
+    self.signal, self.nSignal = signal
+    self.background = background[0]
+    self.scale = bgScale*BackgroundExposure
+    self.function, self.maximize = FiguresOfMerit[figure]
+    self.cache = {}
+    self.nEvaluations = 0
+    self.best = None
+    self.bestLoss = numpy.inf
+    self.history = []
+
+  def loss( self, index ):
+    # The figure of merit to be minimized of the candidates index, shaped
+    # ( candidate, dimension ), the invalid ones being the worst
+    index = numpy.asarray( index, dtype = numpy.int64 ).reshape( -1, len( self.space.shape ) )
+    keys = [ tuple( i ) for i in index.tolist() ]
+    new, seen = [], set()
+    for iCand, key in enumerate( keys ):
+      if key not in self.cache and key not in seen:
+        new.append( iCand )
+        seen.add( key )
+    if new:
+      self.evaluate( index[new], [ keys[j] for j in new ] )
+    return numpy.array( [ self.cache[key] for key in keys ] )
+
+  def evaluate( self, index, keys ):
+    loss = numpy.full( len( index ), numpy.inf )
+    valid = self.space.isValid( index )
+    if valid.any():
+      sEff = self.space.count( self.signal, index[valid] )/float( self.nSignal ) if self.nSignal else numpy.zeros( numpy.count_nonzero( valid ) )
+      merit = self.function( sEff, self.space.count( self.background, index[valid] )*self.scale )
+      merit = -merit if self.maximize else merit
+      loss[valid] = numpy.where( numpy.isnan( merit ), numpy.inf, merit )
+
+    for key, value in zip( keys, loss ):
+      self.cache[key] = value
+      self.nEvaluations += 1
+      if value < self.bestLoss or self.best is None:
+        self.best, self.bestLoss = key, value
+        self.history.append( ( self.nEvaluations, value ) )
+
+  def merit( self, loss = None ):
+    if loss is None: loss = self.bestLoss
+    return -loss if self.maximize else loss
+
+  def evaluationsToReach( self, target, tolerance = 0.01 ):
+    # The number of evaluations after which the best figure of merit is
+    # within tolerance (relative) of target, None if it never is
+    for nEvaluations, loss in self.history:
+      merit = self.merit( loss )
+      if ( merit >= target*( 1. - tolerance ) ) if self.maximize else ( merit <= target*( 1. + tolerance ) ):
+        return nEvaluations
+    return None
+
+  def selection( self ):
+    # ( cut label, signal efficiency, background, background error ) of the
+    # best candidate
+    index = numpy.array( [ self.best ] )
+    sEff = self.space.count( self.signal, index )[0]/float( self.nSignal ) if self.nSignal else 0.
+    nBkg = self.space.count( self.background, index )[0]
+    return self.space.label( self.best ), sEff, nBkg*self.scale, numpy.sqrt( nBkg )*self.scale
+
+# class CutEvaluator
+
+def gridSearch( evaluator ):
+
+  # Every point of the grid, in the order of the count tensors
+  shape = evaluator.space.shape
+  size = int( numpy.prod( shape ) )
+  for first in range( 0, size, CandidateBlock ):
+    cells = numpy.arange( first, min( first + CandidateBlock, size ) )
+    evaluator.loss( numpy.stack( numpy.unravel_index( cells, shape ), axis = -1 ) )
+  return evaluator.best
+# def gridSearch()
+
+def randomSearch( evaluator, nSamples, seed = 1 ):
+
+  rng = numpy.random.RandomState( seed )
+  evaluator.loss( numpy.stack( [ rng.randint( 0, n, nSamples ) for n in evaluator.space.shape ], axis = -1 ) )
+  return evaluator.best
+# def randomSearch()
+
+def latinHypercube( shape, nSamples, rng ):
+
+  # nSamples grid points with exactly one point in each of the nSamples
+  # strata of every dimension
+  index = []
+  for n in shape:
+    strata = ( rng.permutation( nSamples ) + rng.uniform( size = nSamples ) )/nSamples
+    index.append( numpy.minimum( ( strata*n ).astype( numpy.int64 ), n - 1 ) )
+  return numpy.stack( index, axis = -1 )
+# def latinHypercube()
+
+def lhsSearch( evaluator, nSamples, seed = 1 ):
+
+  evaluator.loss( latinHypercube( evaluator.space.shape, nSamples, numpy.random.RandomState( seed ) ) )
+  return evaluator.best
+# def lhsSearch()
+
+def coordinateDescent( evaluator, nStarts = 8, maxSweeps = 20, seed = 1 ):
+
+  # Line searches along one dimension at a time, all the values of the
+  # dimension at once, until a sweep over all of them does not improve.
+  # Starts from the best valid points of a Latin hypercube sample.
+  shape = evaluator.space.shape
+  starts = latinHypercube( shape, nStarts, numpy.random.RandomState( seed ) )
+  loss = evaluator.loss( starts )
+  for start in starts[numpy.argsort( loss, kind = 'mergesort' )]:
+    point, pointLoss = start.copy(), evaluator.loss( start )[0]
+    for sweep in range( maxSweeps ):
+      improved = False
+      for iDim, n in enumerate( shape ):
+        line = numpy.repeat( point[numpy.newaxis, :], n, axis = 0 )
+        line[:, iDim] = numpy.arange( n )
+        lineLoss = evaluator.loss( line )
+        iBest = int( numpy.argmin( lineLoss ) )
+        if lineLoss[iBest] < pointLoss:
+          point, pointLoss, improved = line[iBest], lineLoss[iBest], True
+      if not improved:
+        break
+  return evaluator.best
+# def coordinateDescent()
+
+def refineSearch( evaluator, nCoarse = 4, seed = 1 ):
+
+  # Successive grid refinement: a grid of about nCoarse points per dimension,
+  # then grids twice as fine in a window around the best point, until the
+  # full resolution is reached
+  shape = numpy.array( evaluator.space.shape )
+  step = numpy.maximum( shape//nCoarse, 1 )
+  low, high = numpy.zeros_like( shape ), shape - 1
+  while True:
+    axes = [ numpy.unique( numpy.append( numpy.arange( l, h + 1, s ), h ) ) for l, h, s in zip( low, high, step ) ]
+    grid = numpy.stack( [ axis.ravel() for axis in numpy.meshgrid( *axes, indexing = 'ij' ) ], axis = -1 )
+    for first in range( 0, len( grid ), CandidateBlock ):
+      evaluator.loss( grid[first:first + CandidateBlock] )
+    if ( step == 1 ).all():
+      break
+    best = numpy.array( evaluator.best )
+    low  = numpy.maximum( best - step, 0 )
+    high = numpy.minimum( best + step, shape - 1 )
+    step = numpy.maximum( step//2, 1 )
+  return evaluator.best
+# def refineSearch()
+
+def search( evaluator, method, nSamples = 1000, seed = 1 ):
+
+  if method == 'grid':       return gridSearch( evaluator )
+  if method == 'coordinate': return coordinateDescent( evaluator, seed = seed )
+  if method == 'random':     return randomSearch( evaluator, nSamples, seed )
+  if method == 'lhs':        return lhsSearch( evaluator, nSamples, seed )
+  if method == 'refine':     return refineSearch( evaluator )
+  raise ValueError( 'Unknown search method %s' % method )
+# def search()
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Search the best selection of a signal point over a space of cuts.' )
+  parser.add_argument( '-s', dest = 'sDir', type = str, help = 'The directory of the input SIGNAL files.' )
+  parser.add_argument( '-b', dest = 'bDir', type = str, help = 'The directory of the input BACKGROUND files.' )
+  parser.add_argument( '--mass', dest = 'Mass', type = float, default = 10, help = 'The signal mass.  Default 10.' )
+  parser.add_argument( '--gamma', dest = 'Gamma', type = float, default = 1.1, help = 'The signal boost.  Default 1.1.' )
+  parser.add_argument( '-v', dest = 'Vars', type = str, nargs = '+', default = [ 'SmearedReconstructable' ],
+                      help = 'The leading particle variables.  Default SmearedReconstructable.' )
+  parser.add_argument( '--space', dest = 'space', type = str, default = '2D', choices = sorted( Spaces.keys() ),
+                      help = 'The cut space.  Default 2D.' )
+  parser.add_argument( '--method', dest = 'methods', type = str, nargs = '+', default = [ 'coordinate', 'refine', 'lhs' ], choices = Methods,
+                      help = 'The search methods.  Default coordinate refine lhs.' )
+  parser.add_argument( '-N', dest = 'nSamples', type = int, default = 1000,
+                      help = 'The number of candidates of the random and lhs searches.  Default 1000.' )
+  parser.add_argument( '-m', dest = 'bgScale', type = float, default = 1.,
+                      help = 'The scale factor on the background events to account for additional background source.' )
+  parser.add_argument( '--figure', dest = 'figure', type = str, default = 'Sprime', choices = sorted( FiguresOfMerit.keys() ),
+                      help = 'The figure of merit.  Default Sprime.' )
+  parser.add_argument( '--seed', dest = 'seed', type = int, default = 1, help = 'The seed of the sampling.  Default 1.' )
+  parser.add_argument( '--tolerance', dest = 'tolerance', type = float, default = 0.01,
+                      help = 'How close to the best figure of merit of all the methods counts as near optimal.  Default 0.01.' )
+  parser.add_argument( '-c', dest = 'cacheDir', type = str, default = None,
+                      help = 'Cache the columns read from the ROOT files in this directory.' )
+  parser.add_argument( '--cache-size', dest = 'cacheSize', type = float, default = DefaultMaxSize,
+                      help = 'The size cap of the column cache in GB.  Default %(default)s.' )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
+
+  args = parser.parse_args()
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
+  if args.cacheDir:
+    enableCache( args.cacheDir, args.cacheSize )
+
+  Mass  = int( args.Mass ) if args.Mass == int( args.Mass ) else args.Mass
+  Gamma = int( args.Gamma ) if args.Gamma == int( args.Gamma ) else args.Gamma
+  space = makeSpace( args.space )
+  print( 'Searching %d cuts of the %s space (%s) for M = %s GeV, E = %s GeV' % ( numpy.prod( space.shape ), args.space, ' x '.join( map( str, space.shape ) ), str( Mass ), str( energyLabel( Mass, Gamma ) ) ) )
+
+  for var in args.Vars:
+    setSample( '%s %s' % ( sampleKey( Mass, Gamma ), var ) )
+    signal     = readEvents( signalFiles( args.sDir, Mass, Gamma ), var )
+    setSample( 'atmos %s' % var )
+    background = readEvents( atmosFiles( args.bDir ), var )
+    setSample( '%s %s' % ( sampleKey( Mass, Gamma ), var ) )
+
+    evaluators = {}
+    for method in args.methods:
+      evaluators[method] = CutEvaluator( space, signal, background, args.bgScale, args.figure )
+      search( evaluators[method], method, args.nSamples, args.seed )
+
+    # Near optimal relative to the best figure of merit found by any method
+    target = min( [ evaluator.bestLoss for evaluator in evaluators.values() ] )
+    target = -target if FiguresOfMerit[args.figure][1] else target
+    for method in args.methods:
+      evaluator = evaluators[method]
+      cut, sEff, bkg, bkgErr = evaluator.selection()
+      reached = evaluator.evaluationsToReach( target, args.tolerance )
+      print( '  %s %s: cut %s, %s = %f, signal efficiency = %f, background counts = %f +- %f, %d evaluations, near optimal after %s'
+             % ( var, method, cut, args.figure, evaluator.merit(), sEff, bkg, bkgErr, evaluator.nEvaluations, reached ) )
+
+  reportProfile()
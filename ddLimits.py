@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import os
+import re
+import xml.etree.ElementTree as ET
+import numpy
+
+# Direct detection limits from DMTools-style XML files, e.g.
+#
+#   <limit>
+#     <data-label>...</data-label>
+#     <data-values>{[x1 y1; x2 y2; ...]}</data-values>
+#     <x-rescale>1</x-rescale> <y-rescale>1</y-rescale>
+#   </limit>
+#
+# The parsed curves are cached as .npz files named by the sha1 of the XML
+# content, in
+#
+#   <dir of the file>/.limitCache   or   $BDM_LIMIT_CACHE
+#
+# so that a file is only parsed again when it changes.
+
+CacheDir = os.environ.get( 'BDM_LIMIT_CACHE' ) or None
+
+Number = re.compile( r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?' )
+
+def parseLimitFile( fName ):
+
+  # { 'x': masses, 'y': limits, 'label': data-label, 'experiment': ... }
+  root = ET.parse( fName ).getroot()
+  fields = dict( ( child.tag, ( child.text or '' ).strip() ) for child in root )
+  if 'data-values' not in fields:
+    raise ValueError( 'No data-values in the limit file %s' % fName )
+
+  values = numpy.array( Number.findall( fields['data-values'] ), dtype = numpy.float64 )
+  if len( values ) % 2:
+    raise ValueError( 'Illegal limit xml file provided: %s' % fName )
+  x = values[::2]*float( fields.get( 'x-rescale' ) or 1. )
+  y = values[1::2]*float( fields.get( 'y-rescale' ) or 1. )
+  order = numpy.argsort( x, kind = 'mergesort' )
+
+  return { 'x': x[order], 'y': y[order], 'label': fields.get( 'data-label', '' ), 'experiment': fields.get( 'experiment', '' ) }
+# def parseLimitFile()
+
+def cachePath( fName, digest, cacheDir = None ):
+
+  if cacheDir is None: cacheDir = CacheDir
+  if cacheDir is None:
+    cacheDir = os.path.join( os.path.dirname( os.path.abspath( fName ) ), '.limitCache' )
+  return os.path.join( cacheDir, '%s.npz' % digest )
+# def cachePath()
+
+def loadLimitFile( fName, cacheDir = None ):
+
+  # The parsed curve of a limit file, from the cache when its content is
+  # unchanged
+  digest = hashlib.sha1( open( fName, 'rb' ).read() ).hexdigest()
+  path = cachePath( fName, digest, cacheDir )
+  if os.path.exists( path ):
+    cached = numpy.load( path )
+    return Limit( cached['x'], cached['y'], str( cached['label'] ), str( cached['experiment'] ) )
+
+  curve = parseLimitFile( fName )
+  if not os.path.exists( os.path.dirname( path ) ):
+    os.makedirs( os.path.dirname( path ) )
+  tmpName = '%s.%d.tmp.npz' % ( path[:-4], os.getpid() )
+  numpy.savez( tmpName, **curve )
+  os.rename( tmpName, path )
+  return Limit( curve['x'], curve['y'], curve['label'], curve['experiment'] )
+# def loadLimitFile()
+
+def loadLimits( fNames, cacheDir = None ):
+
+  return [ loadLimitFile( fName, cacheDir ) for fName in fNames ]
+# def loadLimits()
+
+
+class Limit( object ):
+
+  # A limit curve, called with an array of masses it returns the limits
+  # interpolated linearly in log-log, NaN outside of the curve
+  def __init__( self, x, y, label = '', experiment = '' ):
+    self.x          = numpy.asarray( x, dtype = numpy.float64 )
+    self.y          = numpy.asarray( y, dtype = numpy.float64 )
+    self.label      = label
+    self.experiment = experiment
+    self.logX       = numpy.log( self.x )
+    self.logY       = numpy.log( self.y )
+
+  def __call__( self, masses ):
+    masses = numpy.asarray( masses, dtype = numpy.float64 )
+    with numpy.errstate( divide = 'ignore', invalid = 'ignore' ):
+      logM = numpy.log( masses )
+    limits = numpy.exp( numpy.interp( logM, self.logX, self.logY ) )
+    return numpy.where( ( masses >= self.x[0] ) & ( masses <= self.x[-1] ), limits, numpy.nan )
+
+# class Limit
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Parse and cache direct detection limit files, or print their limits at some masses.' )
+  parser.add_argument( 'fNames', type = str, nargs = '+', help = 'The XML limit files.' )
+  parser.add_argument( '-m', dest = 'masses', type = float, nargs = '+', default = [], help = 'The masses in GeV to print the limits at.' )
+  parser.add_argument( '-d', dest = 'cacheDir', type = str, default = CacheDir,
+                      help = 'The cache directory.  Default $BDM_LIMIT_CACHE, or .limitCache next to the files.' )
+
+  args = parser.parse_args()
+
+  for fName, limit in zip( args.fNames, loadLimits( args.fNames, args.cacheDir ) ):
+    print( '%s: %s, %d points from %g to %g GeV' % ( fName, limit.label, len( limit.x ), limit.x[0], limit.x[-1] ) )
+    for mass, value in zip( args.masses, limit( args.masses ) ):
+      print( '  %g GeV: %g' % ( mass, value ) )
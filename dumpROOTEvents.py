@@ -1,47 +1,174 @@
 #!/usr/bin/env python
 
 import argparse
+import os
+import shutil
+import tempfile
 import ROOT
-import math
 import numpy
+from mcReader import getTree, iterChunks, chainFiles
+from profiling import stage, isEnabled, setSample, sampleLabel, enableProfile, reportProfile
+from eventIndex import iterSelected
 
-def getTree( fNames, tName ):
+def selectionColumns( Vars ):
 
-  t = ROOT.TChain( tName )
-  for fName in fNames:
-    t.AddFile( fName )
+  return [ 'isIn10kton' ] + [ '%s[0]' % var for var in Vars ]
+# def selectionColumns()
 
-  t.SetDirectory(0)
-  return t
-# getTree()
+# The events are dumped either as the legacy text table (.dat) or as a .npy
+# file holding a structured array with one float64 field per variable, that
+# can be memory-mapped with loadEvents().
+Formats = [ 'dat', 'npy' ]
 
-def printEvents( tree, outFilename, Vars ):
+def cosAngles( columns, Vars ):
 
-  f = open( outFilename, 'w' )
+  # cos(angle) of the fiducial events, -1 for the events without the angle
+  fiducial = columns['isIn10kton'] != 0
+  rows = numpy.empty( int( numpy.count_nonzero( fiducial ) ), dtype = [ ( var, numpy.float64 ) for var in Vars ] )
+  for var in Vars:
+    leaf = columns['%s[0]' % var][fiducial]
+    rows[var] = numpy.where( numpy.isnan( leaf ), -1., numpy.cos( leaf ) )
+
+  return rows
+# def cosAngles()
 
-  n = tree.GetEntries()
+def writeHeader( f, Vars ):
 
   f.write( '#' )
   for var in Vars:
     f.write( '%s    ' % var )
   f.write ( '\n' )
+# def writeHeader()
+
+def writeRows( f, rows, Vars ):
+
+  numpy.savetxt( f, rows, fmt = [ '  %f                     ' ]*len( Vars ), delimiter = '' )
+# def writeRows()
+
+def writeNpyHeader( f, dtype, nEvents ):
+
+  header = { 'descr': numpy.lib.format.dtype_to_descr( dtype ), 'fortran_order': False, 'shape': ( nEvents, ) }
+  numpy.lib.format.write_array_header_1_0( f, header )
+# def writeNpyHeader()
+
+def dumpEvents( chunks, outFilename, Vars, fmt = 'dat' ):
+
+  # Write the events of the column chunks, in order, to outFilename
+  tmpName = '%s.%d.tmp' % ( outFilename, os.getpid() )
+  if fmt == 'dat':
+    f = open( tmpName, 'w' )
+    writeHeader( f, Vars )
+    for columns in chunks:
+      with stage( 'write' ) as counts:
+        rows = cosAngles( columns, Vars )
+        writeRows( f, rows, Vars )
+        counts['events'] = len( rows )
+    f.close()
+  else:
+    # The raw records are streamed first, the .npy header needs their number
+    dtype = numpy.dtype( [ ( var, numpy.float64 ) for var in Vars ] )
+    nEvents = 0
+    raw = open( tmpName + '.raw', 'wb' )
+    for columns in chunks:
+      with stage( 'write' ) as counts:
+        rows = cosAngles( columns, Vars )
+        rows.tofile( raw )
+        counts['events'] = len( rows )
+      nEvents += len( rows )
+    raw.close()
+    f = open( tmpName, 'wb' )
+    writeNpyHeader( f, dtype, nEvents )
+    raw = open( tmpName + '.raw', 'rb' )
+    shutil.copyfileobj( raw, f )
+    raw.close()
+    f.close()
+    os.remove( tmpName + '.raw' )
+
+  os.rename( tmpName, outFilename )
+# def dumpEvents()
+
+def loadEvents( fName ):
+
+  # { var: cos(angle) } of a dump, memory-mapped for the .npy format
+  if fName.endswith( '.npy' ):
+    rows = numpy.load( fName, mmap_mode = 'r' )
+  else:
+    f = open( fName )
+    Vars = f.readline().lstrip( '#' ).split()
+    f.close()
+    rows = numpy.loadtxt( fName, dtype = [ ( var, numpy.float64 ) for var in Vars ], ndmin = 1 )
+
+  return dict( ( var, rows[var] ) for var in rows.dtype.names )
+# def loadEvents()
+
+def printFromColumns( columns, outFilename, Vars, fmt = 'dat' ):
+
+  dumpEvents( [ columns ], outFilename, Vars, fmt )
+# def printFromColumns()
+
+def fillParts( columns, outFilename, Vars, fmt = 'dat' ):
+
+  # The rows of a chunk, as raw records in a temporary part file next to
+  # outFilename.  Returns [ ( outFilename, Vars, fmt, part ) ], the parts of
+  # consecutive chunks and entry ranges are concatenated in entry order by
+  # mergeParts and written out by writeParts, so that a sample can be dumped
+  # chunk by chunk and shard by shard.
+  rows = cosAngles( columns, Vars )
+  handle, part = tempfile.mkstemp( prefix = '%s.' % os.path.basename( outFilename ), suffix = '.part',
+                                   dir = os.path.dirname( outFilename ) or '.' )
+  f = os.fdopen( handle, 'wb' )
+  rows.tofile( f )
+  f.close()
 
-  for i in tree:
-    
-    doChangeLine = True
-    for var in Vars:
-      if ( i.isIn10kton == 0 ):
-        doChangeLine = False
-        continue
-      leaf = eval('i.%s[0]' % var)
-      if ( numpy.isnan( leaf ) ):
-        costheta = -1.
+  return [ ( outFilename, tuple( Vars ), fmt, part ) ]
+# def fillParts()
+
+def mergeParts( a, b ):
+
+  return a + b
+# def mergeParts()
+
+def writeParts( parts ):
+
+  # Write the rows of the part files of fillParts, in order, to their
+  # outFilename and remove them
+  outFilename, Vars, fmt = parts[0][:3]
+  dtype = numpy.dtype( [ ( var, numpy.float64 ) for var in Vars ] )
+  tmpName = '%s.%d.tmp' % ( outFilename, os.getpid() )
+  with stage( 'write' ) as counts:
+    if fmt == 'dat':
+      f = open( tmpName, 'w' )
+      writeHeader( f, Vars )
+    else:
+      f = open( tmpName, 'wb' )
+      writeNpyHeader( f, dtype, sum( [ os.path.getsize( part ) for _, _, _, part in parts ] )//dtype.itemsize )
+    for _, _, _, part in parts:
+      if fmt == 'dat':
+        rows = numpy.fromfile( part, dtype = dtype )
+        writeRows( f, rows, Vars )
+        counts['events'] += len( rows )
       else:
-        costheta = math.cos( leaf )
-      f.write( '  %f                     ' % costheta )
-    if doChangeLine: f.write( '\n' )
-
-  f.close()
+        raw = open( part, 'rb' )
+        shutil.copyfileobj( raw, f )
+        raw.close()
+        counts['events'] += os.path.getsize( part )//dtype.itemsize
+      os.remove( part )
+    f.close()
+
+  os.rename( tmpName, outFilename )
+  return outFilename
+# def writeParts()
+
+def printEvents( tree, outFilename, Vars, fmt = 'dat', useIndex = False ):
+
+  # With the event index, only the fiducial entries are read
+  if isEnabled():
+    setSample( sampleLabel( chainFiles( tree ) ) )
+  if useIndex:
+    chunks = iterSelected( tree, selectionColumns( Vars ), 'fiducial' )
+  else:
+    chunks = iterChunks( tree, selectionColumns( Vars ) )
+  dumpEvents( chunks, outFilename, Vars, fmt )
 # def printEvents()
 
 if __name__ == "__main__":
@@ -53,8 +180,18 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser( description = 'Make angular distributions.')
   parser.add_argument( '-s', dest = 'sDir', type = str, help = 'The directory of the input SIGNAL files.' )
   parser.add_argument( '-b', dest = 'bDir', type = str, help = 'The directory of the input BACKGROUND files.' )
+  parser.add_argument( '-f', dest = 'fmt', type = str, default = 'dat', choices = Formats,
+                      help = 'The output format, the text table (dat) or a memory-mappable NumPy array (npy).  Default dat.' )
+  parser.add_argument( '-x', dest = 'useIndex', action = 'store_true',
+                      help = 'Only read the fiducial events, using (and building if needed) the event index.' )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
 
   args = parser.parse_args()
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
 
 
   Masses   = [ 5, 10, 20, 40 ]
@@ -65,9 +202,9 @@ if __name__ == "__main__":
   # Background
   bFile = [ '%s/prodgenie_atmnu_max_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir, '%s/prodgenie_atmnu_min_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir ]
   bTree = getTree( bFile, 'MCParticles' )
-  bOut = '%s/prodgenie_atmnu_maxmin_dune10kt_gen_g4_NCFilter_reco_ana.dat' % args.bDir
+  bOut = '%s/prodgenie_atmnu_maxmin_dune10kt_gen_g4_NCFilter_reco_ana.%s' % ( args.bDir, args.fmt )
   print 'Atmospheric neutrino...'
-  printEvents( bTree, bOut, Vars )
+  printEvents( bTree, bOut, Vars, args.fmt, args.useIndex )
 
   for Mass in Masses:
     for Gamma in Gammas:
@@ -83,7 +220,9 @@ if __name__ == "__main__":
       # sFile = ['%s/dune_fermion_e%s_m%s_g1_z1_nonuclear.0_Gen_g4_ana.root' %( args.sDir, Estr, str(Mass) ) ]
       sKey = 'e%s_m%s' %( Eround, Mass )
       sTree = getTree( sFile, 'MCParticles' )
-      sOut = '%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_reco_ana.dat' % ( args.sDir, Estr, str(Mass) )
+      sOut = '%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_reco_ana.%s' % ( args.sDir, Estr, str(Mass), args.fmt )
       # sOut = '%s/dune_fermion_e%s_m%s_g1_z1_nonuclear.0_Gen_g4_ana.dat' % ( args.sDir, Estr, str(Mass) )
       print 'M = %d, E = %f' %( Mass, E )
-      printEvents( sTree, sOut, Vars )
+      printEvents( sTree, sOut, Vars, args.fmt, args.useIndex )
+
+  reportProfile()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import os
+import numpy
+from mcReader import getTree, chainFiles, openColumns, iterChunks, chunkRanges, chunkSize
+
+# Persistent index of the event selections of every input file.  The masks
+# below are computed once per file and stored as packed bitmaps, together
+# with the Event numbers of the selected entries, in
+#
+#   <file>.index.npz              next to the data, or
+#   <indexDir>/<sha1(path)>.npz   when an index directory is given
+#
+# The index records the size and mtime of the file and is rebuilt when they
+# change.
+
+def fiducialMask( columns ):
+
+  return columns['isIn10kton'] != 0
+# def fiducialMask()
+
+def noVisibleMask( columns ):
+
+  return columns['nVisible'] == 0
+# def noVisibleMask()
+
+# name: ( columns, mask function )
+Masks = { 'fiducial':  ( [ 'isIn10kton' ], fiducialMask ),
+          'noVisible': ( [ 'nVisible' ], noVisibleMask ) }
+
+IndexDir = os.environ.get( 'BDM_EVENT_INDEX' ) or None
+
+def indexPath( fName, indexDir = None ):
+
+  if indexDir is None: indexDir = IndexDir
+  fName = os.path.abspath( fName )
+  if indexDir is None:
+    return '%s.index.npz' % fName
+  return os.path.join( indexDir, '%s.npz' % hashlib.sha1( fName.encode( 'utf-8' ) ).hexdigest() )
+# def indexPath()
+
+def buildIndex( fName, tName = 'MCParticles', indexDir = None ):
+
+  tree = getTree( [ fName ], tName )
+  exprs = [ 'Event' ]
+  for name, ( maskColumns, mask ) in sorted( Masks.items() ):
+    exprs += [ expr for expr in maskColumns if expr not in exprs ]
+
+  masks  = dict( ( name, [] ) for name in Masks )
+  events = dict( ( name, [] ) for name in Masks )
+  nEntries = 0
+  for columns in iterChunks( tree, exprs ):
+    nEntries += len( columns['Event'] )
+    for name, ( maskColumns, mask ) in Masks.items():
+      selected = numpy.asarray( mask( columns ), dtype = bool )
+      masks[name].append( selected )
+      events[name].append( columns['Event'][selected] )
+
+  stat = os.stat( fName )
+  arrays = { 'path': os.path.abspath( fName ), 'tree': tName, 'size': stat.st_size, 'mtime': stat.st_mtime, 'nEntries': nEntries }
+  for name in Masks:
+    arrays['mask_%s' % name]  = numpy.packbits( numpy.concatenate( masks[name] ) if masks[name] else numpy.zeros( 0, dtype = bool ) )
+    arrays['Event_%s' % name] = numpy.concatenate( events[name] ) if events[name] else numpy.zeros( 0, dtype = numpy.int64 )
+
+  path = indexPath( fName, indexDir )
+  if not os.path.exists( os.path.dirname( path ) ):
+    os.makedirs( os.path.dirname( path ) )
+  tmpName = '%s.%d.tmp.npz' % ( path[:-4], os.getpid() )
+  numpy.savez( tmpName, **arrays )
+  os.rename( tmpName, path )
+  return path
+# def buildIndex()
+
+def loadIndex( fName, tName = 'MCParticles', indexDir = None ):
+
+  # { 'nEntries': n, 'masks': { name: bool array }, 'events': { name: Event numbers } }
+  # of one input file, (re)built when missing or outdated
+  path = indexPath( fName, indexDir )
+  stat = os.stat( fName )
+  index = numpy.load( path ) if os.path.exists( path ) else None
+  if index is None or str( index['tree'] ) != tName or int( index['size'] ) != stat.st_size or float( index['mtime'] ) != stat.st_mtime \
+     or [ name for name in Masks if 'mask_%s' % name not in index.files ]:
+    index = numpy.load( buildIndex( fName, tName, indexDir ) )
+
+  nEntries = int( index['nEntries'] )
+  masks  = {}
+  events = {}
+  for name in Masks:
+    masks[name]  = numpy.unpackbits( index['mask_%s' % name] )[:nEntries].astype( bool )
+    events[name] = index['Event_%s' % name]
+
+  return { 'nEntries': nEntries, 'masks': masks, 'events': events }
+# def loadIndex()
+
+def chainMask( fNames, name, tName = 'MCParticles', indexDir = None ):
+
+  # The mask of a whole chain, in entry order
+  return numpy.concatenate( [ loadIndex( fName, tName, indexDir )['masks'][name] for fName in fNames ] )
+# def chainMask()
+
+def selectedEvents( fNames, name, tName = 'MCParticles', indexDir = None ):
+
+  # The Event numbers of the selected entries, without reading the tree
+  return numpy.concatenate( [ loadIndex( fName, tName, indexDir )['events'][name] for fName in fNames ] )
+# def selectedEvents()
+
+def iterSelected( tree, exprs, name, entries = None, indexDir = None ):
+
+  # Like mcReader.iterChunks, but only the entries selected by the mask are
+  # returned.  Chunks without any selected entry are not read at all and
+  # the others only from their first to their last selected entry.  The
+  # chain is opened once, see mcReader.openColumns().
+  mask = chainMask( chainFiles( tree ), name, tree.GetName(), indexDir )
+  start, stop = entries if entries is not None else ( 0, len( mask ) )
+  read = openColumns( tree, exprs )
+  for first, last in chunkRanges( start, stop, chunkSize( exprs ) ):
+    selected = numpy.flatnonzero( mask[first:last] )
+    if not len( selected ): continue
+    columns = read( ( first + selected[0], first + selected[-1] + 1 ) )
+    keep = selected - selected[0]
+    yield dict( ( expr, column[keep] ) for expr, column in columns.items() )
+# def iterSelected()
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Build or query the event selection index of input files.' )
+  parser.add_argument( 'action', choices = [ 'build', 'events', 'count' ],
+                      help = 'build the index, print the Event numbers of the selected entries or count them.' )
+  parser.add_argument( '-i', dest = 'iFiles', type = str, nargs = '+', help = 'The input files.' )
+  parser.add_argument( '-m', dest = 'mask', type = str, default = 'noVisible', choices = sorted( Masks.keys() ),
+                      help = 'The selection.  Default noVisible.' )
+  parser.add_argument( '-t', dest = 'tName', type = str, default = 'MCParticles', help = 'The tree name.  Default MCParticles.' )
+  parser.add_argument( '-d', dest = 'indexDir', type = str, default = IndexDir,
+                      help = 'The index directory.  Default $BDM_EVENT_INDEX, or next to the input files.' )
+
+  args = parser.parse_args()
+
+  if args.action == 'build':
+    for fName in args.iFiles:
+      print( 'Indexed %s in %s' % ( fName, buildIndex( fName, args.tName, args.indexDir ) ) )
+  elif args.action == 'events':
+    for event in selectedEvents( args.iFiles, args.mask, args.tName, args.indexDir ):
+      print( '%d' % event )
+  else:
+    for fName in args.iFiles:
+      index = loadIndex( fName, args.tName, args.indexDir )
+      print( '%s: %d/%d %s' % ( fName, len( index['events'][args.mask] ), index['nEntries'], args.mask ) )
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import ROOT
+import numpy
+
+# Histograms backed by NumPy arrays, filled with whole columns at a time.
+# They follow the ROOT conventions: bin 0 is the underflow, bin nBins+1 the
+# overflow (where NaN also goes), and the bins are [low, high).  They are
+# plain picklable objects, partial histograms of the same binning add up
+# with +, and toROOT() makes the TH1D/TH2D copy used for drawing.
+
+def binIndex( values, nBins, low, high ):
+
+  # The ROOT bin number, 0..nBins+1, of every value
+  values = numpy.asarray( values, dtype = numpy.float64 )
+  inRange = ( values >= low ) & ( values < high )
+  index = numpy.where( values < low, 0, nBins + 1 )
+  # In range values rounded up to high stay in the last bin, as in TAxis::FindBin
+  index[inRange] = numpy.minimum( 1 + ( nBins*( values[inRange] - low )/( high - low ) ).astype( numpy.int64 ), nBins )
+  return index
+# def binIndex()
+
+
+class Hist1D( object ):
+
+  def __init__( self, name, title, nBins, xMin, xMax ):
+    self.name    = name
+    self.title   = title
+    self.nBins   = nBins
+    self.xMin    = xMin
+    self.xMax    = xMax
+    self.sumw    = numpy.zeros( nBins + 2 )
+    self.sumw2   = numpy.zeros( nBins + 2 )
+    self.entries = 0
+
+  def fill( self, x, weights = None ):
+    index = binIndex( x, self.nBins, self.xMin, self.xMax )
+    if weights is None:
+      counts = numpy.bincount( index, minlength = self.nBins + 2 )
+      self.sumw  += counts
+      self.sumw2 += counts
+    else:
+      weights = numpy.asarray( weights, dtype = numpy.float64 )
+      self.sumw  += numpy.bincount( index, weights, minlength = self.nBins + 2 )
+      self.sumw2 += numpy.bincount( index, weights*weights, minlength = self.nBins + 2 )
+    self.entries += len( index )
+
+  def binning( self ):
+    return ( self.nBins, self.xMin, self.xMax )
+
+  def __add__( self, other ):
+    if other.binning() != self.binning():
+      raise ValueError( 'Cannot add %s and %s, the binnings differ' % ( self.name, other.name ) )
+    h = Hist1D( self.name, self.title, *self.binning() )
+    h.sumw    = self.sumw + other.sumw
+    h.sumw2   = self.sumw2 + other.sumw2
+    h.entries = self.entries + other.entries
+    return h
+
+  def integral( self ):
+    # The sum of the in-range bins, as TH1::Integral()
+    return self.sumw[1:-1].sum()
+
+  def toROOT( self ):
+    h = ROOT.TH1D( self.name, self.title, self.nBins, self.xMin, self.xMax )
+    h.SetDirectory( 0 )
+    h.Sumw2()
+    for iBin in range( self.nBins + 2 ):
+      h.SetBinContent( iBin, self.sumw[iBin] )
+      h.SetBinError( iBin, numpy.sqrt( self.sumw2[iBin] ) )
+    h.SetEntries( self.entries )
+    return h
+
+# class Hist1D
+
+
+class Hist2D( object ):
+
+  def __init__( self, name, title, nXBins, xMin, xMax, nYBins, yMin, yMax ):
+    self.name    = name
+    self.title   = title
+    self.nXBins  = nXBins
+    self.xMin    = xMin
+    self.xMax    = xMax
+    self.nYBins  = nYBins
+    self.yMin    = yMin
+    self.yMax    = yMax
+    self.sumw    = numpy.zeros( ( nXBins + 2, nYBins + 2 ) )
+    self.sumw2   = numpy.zeros( ( nXBins + 2, nYBins + 2 ) )
+    self.entries = 0
+
+  def fill( self, x, y, weights = None ):
+    shape = self.sumw.shape
+    index = binIndex( x, self.nXBins, self.xMin, self.xMax )*shape[1] + binIndex( y, self.nYBins, self.yMin, self.yMax )
+    if weights is None:
+      counts = numpy.bincount( index, minlength = shape[0]*shape[1] ).reshape( shape )
+      self.sumw  += counts
+      self.sumw2 += counts
+    else:
+      weights = numpy.asarray( weights, dtype = numpy.float64 )
+      self.sumw  += numpy.bincount( index, weights, minlength = shape[0]*shape[1] ).reshape( shape )
+      self.sumw2 += numpy.bincount( index, weights*weights, minlength = shape[0]*shape[1] ).reshape( shape )
+    self.entries += len( index )
+
+  def binning( self ):
+    return ( self.nXBins, self.xMin, self.xMax, self.nYBins, self.yMin, self.yMax )
+
+  def __add__( self, other ):
+    if other.binning() != self.binning():
+      raise ValueError( 'Cannot add %s and %s, the binnings differ' % ( self.name, other.name ) )
+    h = Hist2D( self.name, self.title, *self.binning() )
+    h.sumw    = self.sumw + other.sumw
+    h.sumw2   = self.sumw2 + other.sumw2
+    h.entries = self.entries + other.entries
+    return h
+
+  def integral( self ):
+    return self.sumw[1:-1, 1:-1].sum()
+
+  def toROOT( self ):
+    h = ROOT.TH2D( self.name, self.title, *self.binning() )
+    h.SetDirectory( 0 )
+    h.Sumw2()
+    for iX in range( self.nXBins + 2 ):
+      for iY in range( self.nYBins + 2 ):
+        h.SetBinContent( iX, iY, self.sumw[iX, iY] )
+        h.SetBinError( iX, iY, numpy.sqrt( self.sumw2[iX, iY] ) )
+    h.SetEntries( self.entries )
+    return h
+
+# class Hist2D
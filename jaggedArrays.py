@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy
+
+# Per-event operations on the vector branches of the particles, e.g. the
+# ProtonP of every event, without looping over the events in Python.  A
+# vector branch is held as the ( counts, values ) pair of syntheticSample
+# and mcReader.iterJagged: the number of elements of every event and their
+# values concatenated.  The kernels work on its
+#
+#   offsets   the first element of every event, and the end of the values
+#             as the last one, offsetsOf( counts )
+#   contents  the values
+#
+# and return one value per event.  The notebooks can use them on the
+# columns of mcReader.iterJagged in place of their loops over the entries.
+
+Particles  = [ 'Proton', 'Neutron', 'Pion', 'Pi0', 'Meson', 'Baryon' ]
+Components = [ 'P', 'Px', 'Py', 'Pz', 'E' ]
+
+def offsetsOf( counts ):
+
+  return numpy.concatenate( ( [ 0 ], numpy.cumsum( counts, dtype = numpy.int64 ) ) )
+# def offsetsOf()
+
+def segmentIds( offsets ):
+
+  # The event of every element
+  return numpy.repeat( numpy.arange( len( offsets ) - 1 ), numpy.diff( offsets ) )
+# def segmentIds()
+
+def segmentMax( offsets, contents, empty = 0. ):
+
+  # The largest element of every event, NaN elements ignored, empty for the
+  # events without element
+  counts = numpy.diff( offsets )
+  result = numpy.full( len( counts ), empty, dtype = numpy.float64 )
+  filled = counts > 0
+  if filled.any():
+    result[filled] = numpy.fmax.reduceat( numpy.asarray( contents, dtype = numpy.float64 ), offsets[:-1][filled] )
+  return result
+# def segmentMax()
+
+def segmentArgmax( offsets, contents ):
+
+  # The index in contents of the first largest element of every event, as
+  # the "if x > largest" loops find it, -1 for the events without element
+  # (or with NaN elements only)
+  contents = numpy.asarray( contents, dtype = numpy.float64 )
+  counts = numpy.diff( offsets )
+  largest = numpy.repeat( segmentMax( offsets, contents, numpy.nan ), counts )
+  positions = numpy.where( contents == largest, numpy.arange( len( contents ) ), len( contents ) )
+  result = numpy.full( len( counts ), len( contents ), dtype = numpy.int64 )
+  filled = counts > 0
+  if filled.any():
+    result[filled] = numpy.minimum.reduceat( positions, offsets[:-1][filled] )
+  result[result == len( contents )] = -1
+  return result
+# def segmentArgmax()
+
+def segmentSum( offsets, contents ):
+
+  # The sum of the elements of every event, 0 for the events without element
+  return numpy.bincount( segmentIds( offsets ), weights = contents, minlength = len( offsets ) - 1 )
+# def segmentSum()
+
+def segmentSum3( offsets, x, y, z ):
+
+  # The ( x, y, z ) sums of the 3-vectors of every event
+  ids = segmentIds( offsets )
+  n = len( offsets ) - 1
+  return tuple( [ numpy.bincount( ids, weights = component, minlength = n ) for component in ( x, y, z ) ] )
+# def segmentSum3()
+
+def gather( contents, index, fill = 0. ):
+
+  # contents[index] of every event, fill where index is -1
+  values = numpy.full( len( index ), fill, dtype = numpy.float64 )
+  found = index >= 0
+  values[found] = numpy.asarray( contents )[index[found]]
+  return values
+# def gather()
+
+def first( offsets, contents, fill = numpy.nan ):
+
+  # The leading element, [0], of every event
+  starts = numpy.where( numpy.diff( offsets ) > 0, offsets[:-1], -1 )
+  return gather( contents, starts, fill )
+# def first()
+
+def mergeSegments( offsetsList ):
+
+  # ( offsets, index ) of the per-event concatenation of several vectors,
+  # e.g. the ProtonP and NeutronP of every event.  The elements of an event
+  # come in the order of offsetsList, and
+  #   numpy.concatenate( contentsList )[index]
+  # are the merged contents.
+  counts = [ numpy.diff( offsets ) for offsets in offsetsList ]
+  merged = offsetsOf( numpy.sum( counts, axis = 0 ) if counts else [] )
+  index = numpy.zeros( merged[-1], dtype = numpy.int64 )
+  before = merged[:-1].copy()
+  start = 0
+  for offsets, n in zip( offsetsList, counts ):
+    local = numpy.arange( offsets[-1] ) - numpy.repeat( offsets[:-1], n )
+    index[numpy.repeat( before, n ) + local] = start + numpy.arange( offsets[-1] )
+    before += n
+    start += offsets[-1]
+  return merged, index
+# def mergeSegments()
+
+def mergeParticles( columns, particles, components = Components ):
+
+  # { component: ( offsets, contents ) } of all the particles of every event
+  # together, from the columns of the '<particle><component>' branches
+  offsets, index = mergeSegments( [ offsetsOf( columns['%s%s' % ( particle, components[0] )][0] ) for particle in particles ] )
+  merged = {}
+  for component in components:
+    contents = numpy.concatenate( [ numpy.asarray( columns['%s%s' % ( particle, component )][1], dtype = numpy.float64 ) for particle in particles ] )
+    merged[component] = ( offsets, contents[index] )
+  return merged
+# def mergeParticles()
+
+def angleTo( direction, vector ):
+
+  # The angle in rad between two ( x, y, z ) arrays of vectors, NaN when one
+  # of them is null
+  dot = direction[0]*vector[0] + direction[1]*vector[1] + direction[2]*vector[2]
+  norms = numpy.sqrt( ( direction[0]**2 + direction[1]**2 + direction[2]**2 )*( vector[0]**2 + vector[1]**2 + vector[2]**2 ) )
+  with numpy.errstate( divide = 'ignore', invalid = 'ignore' ):
+    cosine = numpy.where( norms > 0., dot/norms, numpy.nan )
+  return numpy.arccos( numpy.clip( cosine, -1., 1. ) )
+# def angleTo()
+
+def leadingParticles( columns, particles = Particles ):
+
+  # { '<particle>P', '<particle>E': leading value of every event, NaN without
+  #   that particle,
+  #   'P', 'E': leading value over all the particles, 0 without particle }
+  # the P and E leading independently, as in Particle_Analysis
+  leading = {}
+  for component in [ 'P', 'E' ]:
+    overall = numpy.zeros( len( columns['%s%s' % ( particles[0], component )][0] ) )
+    for particle in particles:
+      counts, values = columns['%s%s' % ( particle, component )]
+      leading['%s%s' % ( particle, component )] = segmentMax( offsetsOf( counts ), values, numpy.nan )
+      overall = numpy.fmax( overall, leading['%s%s' % ( particle, component )] )
+    leading[component] = overall
+  return leading
+# def leadingParticles()
+
+def directionAngles( columns, particles = Particles, direction = 'InDM' ):
+
+  # { 'leading': angle of the leading momentum particle,
+  #   'total':   angle of the sum of the particle momenta }
+  # of every event to the leading element of the direction branches
+  # '<direction>Px/Py/Pz', NaN when the event has no particle with momentum.
+  # The total angle is the one of the summed 3-vector, Angle_Analysis
+  # divided by the scalar sum of the momenta instead.
+  merged = mergeParticles( columns, particles, [ 'P', 'Px', 'Py', 'Pz' ] )
+  offsets = merged['P'][0]
+  axis = [ first( offsetsOf( columns['%s%s' % ( direction, component )][0] ), columns['%s%s' % ( direction, component )][1] ) for component in [ 'Px', 'Py', 'Pz' ] ]
+
+  iLeading = segmentArgmax( offsets, merged['P'][1] )
+  leadingP = gather( merged['P'][1], iLeading )
+  iLeading[~( leadingP > 0. )] = -1
+  leading = [ gather( merged[component][1], iLeading ) for component in [ 'Px', 'Py', 'Pz' ] ]
+  total = segmentSum3( offsets, merged['Px'][1], merged['Py'][1], merged['Pz'][1] )
+
+  return { 'leading': angleTo( axis, leading ), 'total': angleTo( axis, total ) }
+# def directionAngles()
+
+def jaggedBranches( particles = Particles, components = Components, direction = 'InDM' ):
+
+  # The branches read by leadingParticles and directionAngles
+  branches = [ '%s%s' % ( particle, component ) for particle in particles for component in components ]
+  if direction:
+    branches += [ '%s%s' % ( direction, component ) for component in [ 'Px', 'Py', 'Pz' ] ]
+  return branches
+# def jaggedBranches()
+
+def particleSummary( columns, particles = Particles, direction = 'InDM' ):
+
+  # The leading P and E and the angles to the direction, with and without
+  # the neutrons, of every event
+  summary = leadingParticles( columns, particles )
+  withoutNeutrons = [ particle for particle in particles if particle != 'Neutron' ]
+  for label, selected in [ ( '', particles ), ( 'NoN', withoutNeutrons ) ]:
+    if not selected:
+      continue
+    for kind, angles in directionAngles( columns, selected, direction ).items():
+      summary['%s%sAngle' % ( kind, label )] = angles
+  return summary
+# def particleSummary()
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Compute the leading particle P and E and the angles of the particles to the DM direction of every event.' )
+  parser.add_argument( 'fNames', type = str, nargs = '+', help = 'The ROOT files.' )
+  parser.add_argument( '-o', dest = 'oFile', type = str, help = 'The output .npz file, one array per quantity.' )
+  parser.add_argument( '-p', dest = 'particles', type = str, nargs = '+', default = Particles,
+                      help = 'The particles.  Default %s.' % ' '.join( Particles ) )
+  parser.add_argument( '-t', dest = 'tName', type = str, default = 'MCParticles', help = 'The tree name.  Default MCParticles.' )
+  parser.add_argument( '--max-memory', dest = 'maxMemory', type = float, default = None,
+                      help = 'The memory budget in MB, which sets how many entries are read at a time.  Default chunks of 100000 entries.' )
+
+  args = parser.parse_args()
+
+  from mcReader import getTree, iterJagged, setMaxMemory
+  setMaxMemory( args.maxMemory )
+  chunks = [ particleSummary( columns, args.particles ) for columns in iterJagged( getTree( args.fNames, args.tName ), jaggedBranches( args.particles ) ) ]
+  summary = dict( ( key, numpy.concatenate( [ chunk[key] for chunk in chunks ] ) ) for key in chunks[0] )
+  numpy.savez( args.oFile, **summary )
+  print( 'Wrote %d events to %s' % ( len( summary['P'] ), args.oFile ) )
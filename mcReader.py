@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+import os
+import ROOT
+import numpy
+from columnCache import ColumnCache, DefaultMaxSize
+from profiling import stage
+
+# Optional on-disk column cache, see columnCache.py.  It is switched on with
+# enableCache() or by pointing $BDM_COLUMN_CACHE to a directory.
+Cache = None
+
+# The chains are streamed in chunks of ChunkSize entries.  setMaxMemory()
+# derives the chunk size from a memory budget per process instead, assuming
+# the consumers need ChunkOverhead times the size of the columns they read
+# for their temporaries.
+DefaultChunkSize = 100000
+ChunkOverhead    = 10
+MinChunkSize     = 1000
+MaxMemory = None  # MB
+
+def getTree( fNames, tName ):
+
+  t = ROOT.TChain( tName )
+  for fName in fNames:
+    t.AddFile( fName )
+
+  t.SetDirectory(0)
+  return t
+# getTree()
+
+def columnName( expr ):
+
+  # 'VisibleAngle[0]' -> 'VisibleAngle_0', plain branch names are kept
+  return expr.replace( '[', '_' ).replace( ']', '' )
+
+# def columnName()
+
+def enableCache( cacheDir, maxSize = DefaultMaxSize ):
+
+  global Cache
+  Cache = ColumnCache( cacheDir, maxSize )
+# def enableCache()
+
+if os.environ.get( 'BDM_COLUMN_CACHE' ):
+  enableCache( os.environ['BDM_COLUMN_CACHE'] )
+
+def chainFiles( tree ):
+
+  return [ element.GetTitle() for element in tree.GetListOfFiles() ]
+# def chainFiles()
+
+def shardRanges( nEntries, nShards ):
+
+  # Split [0, nEntries) into nShards contiguous ( start, stop ) entry ranges
+  edges = [ ( nEntries*i )//nShards for i in range( nShards + 1 ) ]
+  return [ ( edges[i], edges[i+1] ) for i in range( nShards ) if edges[i+1] > edges[i] ]
+# def shardRanges()
+
+def setMaxMemory( maxMemory ):
+
+  global MaxMemory
+  MaxMemory = maxMemory
+# def setMaxMemory()
+
+def chunkSize( exprs, maxMemory = None ):
+
+  # The number of entries per chunk that keeps the reading of exprs within
+  # maxMemory MB (MaxMemory by default)
+  if maxMemory is None: maxMemory = MaxMemory
+  if maxMemory is None: return DefaultChunkSize
+  bytesPerEntry = 8*max( len( exprs ), 1 )*ChunkOverhead
+  return max( int( maxMemory*1e6 )//bytesPerEntry, MinChunkSize )
+# def chunkSize()
+
+def chunkRanges( start, stop, size ):
+
+  return [ ( first, min( first + size, stop ) ) for first in range( start, stop, size ) ]
+# def chunkRanges()
+
+def defineColumns( tree, exprs ):
+
+  # ( frame, names ): the RDataFrame of the chain with a Define for every
+  # element expression such as 'VisibleAngle[0]', and the column name of
+  # every expression.  It is set up once and read range by range with
+  # readFrame().
+  frame = ROOT.RDataFrame( tree )
+  names = {}
+  for expr in exprs:
+    name = columnName( expr )
+    if name != expr and name not in names.values():
+      frame = frame.Define( name, expr )
+    names[expr] = name
+
+  return frame, names
+# def defineColumns()
+
+def readFrame( frame, names, entries = None ):
+
+  # Read the columns of defineColumns() in a single event loop and return
+  # them as NumPy arrays keyed by the expression.  Floating point columns
+  # are promoted to double so that the results match the per-event PyROOT
+  # access.  entries restricts the read to a ( start, stop ) range of the
+  # chain; the entries before it pass the Range without their branches
+  # being read.
+  df = frame if entries is None else frame.Range( entries[0], entries[1] )
+
+  with stage( 'read' ) as counts:
+    bytesRead = ROOT.TFile.GetFileBytesRead()
+    arrays = df.AsNumpy( sorted( set( names.values() ) ) )
+    counts['bytes'] = ROOT.TFile.GetFileBytesRead() - bytesRead
+    counts['events'] = len( list( arrays.values() )[0] ) if arrays else 0
+
+  columns = {}
+  for expr, name in names.items():
+    a = numpy.asarray( arrays[name] )
+    if a.dtype.kind == 'f':
+      a = a.astype( numpy.float64 )
+    columns[expr] = a
+
+  return columns
+# def readFrame()
+
+def readTree( tree, exprs, entries = None ):
+
+  # Read all the requested branches (or element expressions) of the chain,
+  # or of its ( start, stop ) entry range, in a single event loop
+  frame, names = defineColumns( tree, exprs )
+  return readFrame( frame, names, entries )
+# def readTree()
+
+def readFile( fName, tName, exprs ):
+
+  # ( nEntries, chunks ) of one input file, the chunks are read lazily so
+  # that the cache can be filled within the memory budget
+  tree = getTree( [ fName ], tName )
+  nEntries = tree.GetEntries()
+  ranges = chunkRanges( 0, nEntries, chunkSize( exprs ) )
+  frame, names = defineColumns( tree, exprs )
+  return nEntries, ( readFrame( frame, names, entries ) for entries in ranges )
+# def readFile()
+
+def sliceParts( parts, exprs, entries = None ):
+
+  # The ( start, stop ) entry range of the cached columns of the files of a
+  # chain, concatenated
+  with stage( 'cache' ) as counts:
+    if entries is not None:
+      start, stop = entries
+      offset = 0
+      sliced = []
+      for part in parts:
+        length = len( part[exprs[0]] )
+        first = min( max( start - offset, 0 ), length )
+        last  = min( max( stop - offset, first ), length )
+        if last > first or not sliced:
+          sliced.append( dict( ( expr, part[expr][first:last] ) for expr in exprs ) )
+        offset += length
+      parts = sliced
+
+    if len( parts ) == 1:
+      columns = parts[0]
+    else:
+      columns = {}
+      for expr in exprs:
+        columns[expr] = numpy.concatenate( [ part[expr] for part in parts ] )
+    # The rows returned, not the entries of the whole files
+    counts['events'] = len( columns[exprs[0]] )
+
+  return columns
+# def sliceParts()
+
+def openColumns( tree, exprs ):
+
+  # read( entries = None ), the columns of the chain or of a ( start, stop )
+  # entry range of it.  The RDataFrame and its Defines, or the memmaps of
+  # the cache when it is enabled, are set up here once for all the ranges.
+  fNames = chainFiles( tree )
+  if Cache is None or not fNames:
+    frame, names = defineColumns( tree, exprs )
+    return lambda entries = None: readFrame( frame, names, entries )
+
+  with stage( 'cache' ):
+    parts = [ Cache.read( fName, tree.GetName(), exprs, readFile ) for fName in fNames ]
+  return lambda entries = None: sliceParts( parts, exprs, entries )
+# def openColumns()
+
+def readColumns( tree, exprs, entries = None ):
+
+  # Columns of the whole chain, or of the ( start, stop ) entry range, from
+  # the cache when it is enabled
+  return openColumns( tree, exprs )( entries )
+# def readColumns()
+
+def iterChunks( tree, exprs, entries = None, size = None ):
+
+  # Columns of consecutive chunks of the chain, or of its ( start, stop )
+  # entry range, at most size entries (chunkSize() by default) at a time.
+  # The chain is opened once, see openColumns(), and only sliced per chunk.
+  if size is None: size = chunkSize( exprs )
+  start, stop = entries if entries is not None else ( 0, tree.GetEntries() )
+  ranges = chunkRanges( start, stop, size )
+  read = openColumns( tree, exprs )
+  if not ranges:
+    # Still one, empty, chunk so that the consumers see every sample
+    yield read( entries )
+  for chunk in ranges:
+    yield read( chunk )
+# def iterChunks()
+
+def leadingExprs( Vars, suffixes ):
+
+  # The first element of the '<var><suffix>' branches, e.g.
+  # leadingExprs( [ 'Visible' ], [ 'P', 'Angle' ] ) -> [ 'VisibleP[0]', 'VisibleAngle[0]' ]
+  exprs = []
+  for var in Vars:
+    for suffix in suffixes:
+      exprs.append( '%s%s[0]' % ( var, suffix ) )
+
+  return exprs
+# def leadingExprs()
+
+def readLeading( tree, Vars, suffixes, extra = () ):
+
+  return readColumns( tree, list( extra ) + leadingExprs( Vars, suffixes ) )
+# def readLeading()
+
+JaggedCode = '''
+namespace mcReader {
+
+// Appends the elements of an entry to the std::vector<double> at address
+// values and returns their number, in the entry order of a single threaded
+// event loop
+template <typename T>
+int appendVector( ULong64_t values, const ROOT::RVec<T>& vector ) {
+  std::vector<double>& buffer = *reinterpret_cast<std::vector<double>*>( values );
+  buffer.insert( buffer.end(), vector.begin(), vector.end() );
+  return vector.size();
+}
+
+// Copies the std::vector<double> at address values to the NumPy buffer at
+// address array and empties it
+void drainVector( ULong64_t values, ULong64_t array ) {
+  std::vector<double>& buffer = *reinterpret_cast<std::vector<double>*>( values );
+  std::copy( buffer.begin(), buffer.end(), reinterpret_cast<double*>( array ) );
+  buffer.clear();
+}
+
+}
+'''
+
+def iterJagged( tree, branches, entries = None, size = None ):
+
+  # All the elements of the vector branches of consecutive chunks of the
+  # chain, or of its ( start, stop ) entry range, as { branch: ( counts,
+  # values ) } with the number of elements of every entry and their values
+  # concatenated, for the kernels of jaggedArrays.  The elements are appended
+  # to a C++ buffer per branch in the event loop, which only returns the
+  # counts, so no vector object reaches Python.  size is in entries,
+  # chunkSize() of the branches by default.
+  if not hasattr( ROOT, 'mcReader' ):
+    ROOT.gInterpreter.Declare( JaggedCode )
+
+  if size is None: size = chunkSize( branches )
+  start, stop = entries if entries is not None else ( 0, tree.GetEntries() )
+  buffers = dict( ( branch, ROOT.std.vector( 'double' )() ) for branch in branches )
+  frame = ROOT.RDataFrame( tree )
+  names = {}
+  for branch in branches:
+    names['n_%s' % branch] = 'n_%s' % branch
+    frame = frame.Define( 'n_%s' % branch, 'mcReader::appendVector( %dULL, %s )' % ( ROOT.addressof( buffers[branch] ), branch ) )
+
+  # Still one, empty, chunk for an empty range
+  for chunk in chunkRanges( start, stop, size ) or [ ( start, stop ) ]:
+    arrays = readFrame( frame, names, chunk )
+    columns = {}
+    for branch in branches:
+      values = numpy.empty( buffers[branch].size(), dtype = numpy.float64 )
+      ROOT.mcReader.drainVector( ROOT.addressof( buffers[branch] ), values.ctypes.data )
+      columns[branch] = ( arrays['n_%s' % branch].astype( numpy.int32 ), values )
+    yield columns
+# def iterJagged()
+
+def readJagged( tree, branches, entries = None ):
+
+  # iterJagged() of the whole chain, or of its ( start, stop ) entry range,
+  # in one piece
+  chunks = list( iterJagged( tree, branches, entries ) )
+  columns = {}
+  for branch in branches:
+    columns[branch] = ( numpy.concatenate( [ chunk[branch][0] for chunk in chunks ] ),
+                        numpy.concatenate( [ chunk[branch][1] for chunk in chunks ] ) )
+
+  return columns
+# def readJagged()
@@ -5,6 +5,13 @@ import argparse
 import ROOT
 import math
 import numpy
+from mcReader import getTree, leadingExprs, setMaxMemory, DefaultChunkSize
+from cutScan import countNotBelow
+from scanEngine import mapSharded, scanChunks, withPassRates, reportPeakMemory, sampleKey
+from profiling import enableProfile, reportProfile
+from rdfBackend import Backends, enableImplicitMT, countAngle
+from selectionExpr import Fiducial, asExpression, bindSelection, selectionMask, parseExpression, loadConfig
+from cutOptimizer import BackgroundExposure, optimizeCuts, nestedCounts, bestSelections, parseScales, writeScanTable, writeResults
 
 def createDir( odir ):
   if not os.path.exists( odir ):
@@ -14,115 +21,91 @@ def createDir( odir ):
     print('   The output directory already exists' )
 # createDir()
 
-def getTree( fNames, tName ):
+def selectionColumns( AngularVars, selection = None ):
 
-  t = ROOT.TChain( tName )
-  for fName in fNames:
-    t.AddFile( fName )
+  exprs = list( asExpression( selection ).columns )
+  return exprs + [ expr for expr in leadingExprs( AngularVars, [ 'P', 'Angle' ] ) if expr not in exprs ]
+# def selectionColumns()
 
-  t.SetDirectory(0)
-  return t
-# getTree()
+def countPassed( columns, AngularVars, costhl, costhh, ncosth, selection = None ):
 
-def selectEvents( tree, AngularVars, isSignal, costhl, costhh, ncosth ):
-
-  n = tree.GetEntries()
-  nFiducial = 0
+  # Partial counts, that can be merged across entry ranges before the pass
+  # rates are computed with scanEngine.withPassRates.  The events are those
+  # of selection, the fiducial volume by default.
+  fiducial = selectionMask( columns, selection )
+  n = len( fiducial )
   nPassed = {}
-  rPassed = {}
 
   costhetaCuts = numpy.linspace( costhl, costhh, ncosth )
 
+  nFiducial = int( numpy.count_nonzero( fiducial ) )
+
   for var in AngularVars:
     nPassed[var] = {}
-    rPassed[var] = {}
-    for costhetaCut in costhetaCuts:
-      nPassed[var][costhetaCut] = 0
-      rPassed[var][costhetaCut] = 0
 
-  for i in tree:
-    if i.isIn10kton == 0: continue
-    nFiducial += 1
+    p = columns['%sP[0]' % var][fiducial]
+    costheta = numpy.cos( columns['%sAngle[0]' % var][fiducial] )
 
-    for var in AngularVars:
+    # Same as the per-event "p == 0. or costheta < costhetaCut" veto
+    counts = countNotBelow( costheta[p != 0.], costhetaCuts )
+    for costhetaCut, count in zip( costhetaCuts, counts ):
+      nPassed[var][costhetaCut] = int( count )
 
-      p = eval( 'i.%sP[0]' % var )
-      leaf = eval( 'i.%sAngle[0]' % var )
-      costheta = math.cos( leaf )
+  return n, nFiducial, nPassed
+# def countPassed()
 
-      for costhetaCut in costhetaCuts:
-        if p == 0. or costheta < costhetaCut: continue
-        nPassed[var][costhetaCut] += 1
-
-  for var in AngularVars:
-    for costhetaCut in costhetaCuts:
-      rPassed[var][costhetaCut] = float(nPassed[var][costhetaCut])/float(nFiducial)
-      # print nPassed[var][costhetaCut], nFiducial
+def selectEvents( tree, AngularVars, isSignal, costhl, costhh, ncosth, backend = 'numpy', selection = None ):
 
-  return n, nFiducial, nPassed, rPassed
+  selection = bindSelection( tree, selection, leadingExprs( AngularVars, [ 'P', 'Angle' ] ) )
+  if backend == 'rdf':
+    counts = countAngle( tree, AngularVars, numpy.linspace( costhl, costhh, ncosth ), selection.toCpp() )
+  else:
+    counts = scanChunks( tree, selectionColumns( AngularVars, selection ), countPassed, ( AngularVars, costhl, costhh, ncosth, selection ) )
+  return withPassRates( counts )
 # def selectEvents()
 
-def optimizeSelection( mass, gamma, AngularVars, bgScale, nPassed, rPassed ):
+def selectSample( fNames, AngularVars, isSignal, costhl, costhh, ncosth, backend = 'numpy', selection = None, entries = None ):
+
+  # The partial counts of an entry range of the sample, read chunk by chunk,
+  # or of the whole sample in one RDataFrame loop
+  tree = getTree( fNames, 'MCParticles' )
+  selection = bindSelection( tree, selection, leadingExprs( AngularVars, [ 'P', 'Angle' ] ) )
+  if backend == 'rdf':
+    return countAngle( tree, AngularVars, numpy.linspace( costhl, costhh, ncosth ), selection.toCpp() )
+  return scanChunks( tree, selectionColumns( AngularVars, selection ), countPassed, ( AngularVars, costhl, costhh, ncosth, selection ), entries )
+# def selectSample()
+
+def optimizeSamples( sKeys, AngularVars, bgScales, nPassed, rPassed, figure = 'Sprime' ):
 
-  E = mass * gamma
-  if E in [ 11., 15., 22., 25., 30., 44., 50., 60. ]: Eround = int(E)
-  else: Eround = E
-  sKey = 'e%s_m%s' %( Eround, mass )
+  # The best cut of every background scale, signal sample and variable
+  # against the atmos background, all evaluated at once from the same counts
+  cuts = sorted( nPassed['atmos'][AngularVars[0]].keys() )
+  sEff = nestedCounts( rPassed, sKeys, AngularVars, cuts )
+  nBkg = nestedCounts( nPassed, [ 'atmos' ], AngularVars, cuts )
   # Scale the background events to 40kton*10 year exposure
-  backgroundScale = bgScale* 40./28.705
-  bestCut = {}
-  bestEff = {}
-  bestBkg = {}
+  iBest, merit, eff, bkg, bkgErr = optimizeCuts( sEff, nBkg, numpy.asarray( bgScales )*BackgroundExposure, figure )
 
-  for var in AngularVars:
-    SprimeMin = 10000.
-    for costhetaCut in sorted( nPassed[sKey][var].keys() ):
-      sEff = rPassed[sKey][var][costhetaCut]
-      bEvents = float(nPassed['atmos'][var][costhetaCut])*backgroundScale
-      Sprime = 25./ (2.*sEff) + math.sqrt( 25.*bEvents/ (sEff*sEff) + 625./(4.*sEff*sEff) )
-      # print costhetaCut, sEff, bEvents, Sprime, SprimeMin
-      if Sprime < SprimeMin:
-        SprimeMin = Sprime
-        bestCut[var] = costhetaCut
-        bestEff[var] = sEff
-        bestBkg[var] = bEvents
-        bestBkgErr[var] = math.sqrt( float(nPassed['atmos'][var][costhetaCut]) )*backgroundScale
-      # print 'Best cut: %s, Sprime: %s' % ( bestCut[var], Sprime )
-
-  return bestCut, bestEff, bestBkg, bestBkgErr
+  return [ bestSelections( AngularVars, cuts.__getitem__, iBest[i], eff[i], bkg[i], bkgErr[i] ) for i in range( len( bgScales ) ) ]
+# def optimizeSamples()
+
+def optimizeSelection( mass, gamma, AngularVars, bgScale, nPassed, rPassed ):
 
+  return optimizeSamples( [ sampleKey( mass, gamma ) ], AngularVars, [ bgScale ], nPassed, rPassed, 'Sprime' )[0][0]
 # def optimizeSelection()
 
 def optimizeSelectionFOM( mass, gamma, AngularVars, bgScale, nPassed, rPassed ):
 
-  E = mass * gamma
-  if E in [ 11., 15., 22., 25., 30., 44., 50., 60. ]: Eround = int(E)
-  else: Eround = E
-  sKey = 'e%s_m%s' %( Eround, mass )
-  # Scale the background events to 40kton*10 year exposure
-  backgroundScale = bgScale* 40./28.705
-  bestCut = {}
-  bestEff = {}
-  bestBkg = {}
+  return optimizeSamples( [ sampleKey( mass, gamma ) ], AngularVars, [ bgScale ], nPassed, rPassed, 'FOM' )[0][0]
+# def optimizeSelectionFOM()
+
+def writeSample( txtFile, Mass, Eround, AngularVars, bestCut, bestEff, bestBkg, bestBkgErr ):
+
+  txtFile.write('Mass = %s GeV, E = %s GeV\n' % ( str(Mass), str(Eround) ) )
 
   for var in AngularVars:
-    FOMMax = 0.
-    for costhetaCut in sorted( nPassed[sKey][var].keys() ):
-      sEff = rPassed[sKey][var][costhetaCut]
-      bEvents = float(nPassed['atmos'][var][costhetaCut])*backgroundScale
-      FOM = sEff/math.sqrt(bEvents)
-      print( costhetaCut, sEff, bEvents, FOM, FOMMax )
-      if FOM > FOMMax:
-        FOMMax = FOM
-        bestCut[var] = costhetaCut
-        bestEff[var] = sEff
-        bestBkg[var] = bEvents
-        bestBkgErr[var] = math.sqrt( float(nPassed['atmos'][var][costhetaCut]) )*backgroundScale
-      print('Best cut: %s, FOM: %s' % ( bestCut[var], FOM ))
-
-  return bestCut, bestEff, bestBkg, bestBkgErr
+    txtFile.write( '  %s: optimal cut at %f, signal efficieny = %f, background counts = %f, background uncertainty =  %f\n' %( var, bestCut[var], bestEff[var], bestBkg[var], bestBkgErr[var] ) )
 
-# def optimizeSelectionFOM()
+# def writeSample()
 
 
 if __name__ == "__main__":
@@ -136,10 +119,37 @@ if __name__ == "__main__":
   parser.add_argument( '-s', dest = 'sDir', type = str, help = 'The directory of the input SIGNAL files.' )
   parser.add_argument( '-b', dest = 'bDir', type = str, help = 'The directory of the input BACKGROUND files.' )
   parser.add_argument( '-o', dest = 'oDir', type = str, help = 'The directory of the output plots.' )
-  parser.add_argument( '-m', dest = 'bgScale', type = float, default = 1.,
-                      help = 'The scale factor on the background events to account for additional background source.' )
+  parser.add_argument( '-m', dest = 'bgScales', type = str, nargs = '+', default = [ '1.' ],
+                      help = 'The scale factors on the background events to account for additional background source, numbers or first:last:n ranges.  Default 1.' )
+  parser.add_argument( '-j', dest = 'nJobs', type = int, default = 1,
+                      help = 'The number of samples processed in parallel.  Default 1.' )
+  parser.add_argument( '-n', dest = 'nShards', type = int, default = 1,
+                      help = 'The number of entry ranges each sample is split into for the parallel processing.  Default 1.' )
+  parser.add_argument( '--max-memory', dest = 'maxMemory', type = float, default = None,
+                      help = 'The memory budget of each process in MB, which sets how many entries are read at a time.  Default chunks of %d entries.' % DefaultChunkSize )
+  parser.add_argument( '--backend', dest = 'backend', type = str, default = 'numpy', choices = Backends,
+                      help = 'The event loop, NumPy on the columns read chunk by chunk or a single RDataFrame loop per sample on ROOT implicit multi-threading (samples one at a time, -n ignored).  Default numpy.' )
+  parser.add_argument( '--threads', dest = 'nThreads', type = int, default = 0,
+                      help = 'The number of threads of the rdf backend, 0 for all the cores.  Default 0.' )
+  parser.add_argument( '--config', dest = 'config', type = str, default = None,
+                      help = 'A JSON file with the "vars" to optimize and the "selection" of the events.  Default the variables above and the fiducial volume.' )
+  parser.add_argument( '--selection', dest = 'selection', type = str, default = None,
+                      help = 'The selection of the events, e.g. "isIn10kton && VisibleNoNP > 0", over the one of the config.  Default %s.' % Fiducial )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
 
   args = parser.parse_args()
+  config = loadConfig( args.config ) if args.config else {}
+  AngularVars = config.get( 'vars', AngularVars )
+  selection = parseExpression( args.selection or config.get( 'selection', Fiducial ) )
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
+  if args.backend == 'rdf':
+    enableImplicitMT( args.nThreads )
+  setMaxMemory( args.maxMemory )
+  bgScales = parseScales( args.bgScales )
 
   Masses     = [ 5, 10, 20, 40 ]
   Gammas     = [ 1.1, 1.25, 1.5, 10 ]
@@ -151,25 +161,18 @@ if __name__ == "__main__":
   costhl     = 0.2
   costhh     = 0.95
   ncosth     = 16
-  bestCut    = {}
-  bestEff    = {}
-  bestBkg    = {}
-  bestBkgErr = {}
 
   # Create the output directory
   createDir( args.oDir )
 
-  # Create the output text file
-  txtName = '%s/1DFOM_Efficiency_scalar_bgScale%f.txt' % ( args.oDir, args.bgScale )
-  txtFile = open( txtName, 'w' )
 
 
   # Background
   bFile = [ '%s/prodgenie_atmnu_max_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir, '%s/prodgenie_atmnu_min_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir ]
-  bTree = getTree( bFile, 'MCParticles' )
-  nTotal['atmos'], nFiducial['atmos'], nPassed['atmos'], passRate['atmos'] = selectEvents( bTree, AngularVars, False, costhl, costhh, ncosth )
+  samples = [ ( 'atmos', bFile, False ) ]
 
   # Signal
+  signals = []
   for Mass in Masses:
     for Gamma in Gammas:
 
@@ -181,12 +184,31 @@ if __name__ == "__main__":
       else: Eround = E
       sFile = [ '%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_reco_ana.root' %( args.sDir, str(Eround), str(Mass) ) ]
       sKey = 'e%s_m%s' %( Eround, Mass )
-      sTree = getTree( sFile, 'MCParticles' )
-      nTotal[sKey], nFiducial[sKey], nPassed[sKey], passRate[sKey] = selectEvents( sTree, AngularVars, True, costhl, costhh, ncosth )
-      # optimize the selection
-      # print 'Mass: %d, Energy: %s' %( Mass, Eround )
-      bestCut[sKey], bestEff[sKey], bestBkg[sKey], bestBkgErr[sKey] = optimizeSelectionFOM( Mass, Gamma, AngularVars, args.bgScale, nPassed, passRate )
-      txtFile.write('Mass = %s GeV, E = %s GeV\n' % ( str(Mass), str(Eround) ) )
-
-      for var in AngularVars:
-        txtFile.write( '  %s: optimal cut at %f, signal efficieny = %f, background counts = %f, background uncertainty =  %f\n' %( var, bestCut[sKey][var], bestEff[sKey][var], bestBkg[sKey][var], bestBkgErr[sKey][var] ) )
+      samples.append( ( sKey, sFile, True ) )
+      signals.append( ( Mass, Gamma, Eround, sKey ) )
+
+  # Select the events of all the samples, args.nJobs entry ranges at a time
+  # or one sample at a time on all the threads
+  jobs = [ ( fNames, AngularVars, isSignal, costhl, costhh, ncosth, args.backend, selection ) for key, fNames, isSignal in samples ]
+  nJobs, nShards = ( 1, 1 ) if args.backend == 'rdf' else ( args.nJobs, args.nShards )
+  for ( key, fNames, isSignal ), result in zip( samples, mapSharded( selectSample, jobs, nJobs, nShards ) ):
+    nTotal[key], nFiducial[key], nPassed[key], passRate[key] = withPassRates( result )
+
+  # optimize the selections of all the signal samples and background scales at once
+  best = optimizeSamples( [ sKey for Mass, Gamma, Eround, sKey in signals ], AngularVars, bgScales, nPassed, passRate, 'FOM' )
+  for bgScale, scaleSelections in zip( bgScales, best ):
+    txtFile = open( '%s/1DFOM_Efficiency_scalar_bgScale%f.txt' % ( args.oDir, bgScale ), 'w' )
+    for ( Mass, Gamma, Eround, sKey ), bestCuts in zip( signals, scaleSelections ):
+      writeSample( txtFile, Mass, Eround, AngularVars, *bestCuts )
+    txtFile.close()
+
+  # All the scales in one table
+  txtFile = open( '%s/1DFOM_Efficiency_scalar_bgScaleTable.txt' % args.oDir, 'w' )
+  writeScanTable( txtFile, bgScales, [ ( Mass, Eround ) for Mass, Gamma, Eround, sKey in signals ], AngularVars, best )
+  txtFile.close()
+
+  # and in the results file read by scalar_dm_plots
+  writeResults( '%s/1DFOM_Efficiency_scalar_results.npz' % args.oDir, bgScales, [ ( Mass, Eround ) for Mass, Gamma, Eround, sKey in signals ], AngularVars, best )
+
+  reportProfile()
+  reportPeakMemory( args.maxMemory )
@@ -5,6 +5,13 @@ import argparse
 import ROOT
 import math
 import numpy
+from mcReader import getTree, leadingExprs, setMaxMemory, DefaultChunkSize
+from cutScan import linearCutCounts
+from scanEngine import mapSharded, scanChunks, withPassRates, reportPeakMemory, sampleKey
+from profiling import enableProfile, reportProfile
+from rdfBackend import Backends, enableImplicitMT, countLinear
+from selectionExpr import Fiducial, asExpression, bindSelection, selectionMask, parseExpression, loadConfig
+from cutOptimizer import BackgroundExposure, optimizeCuts, bestSelections, parseScales, writeScanTable, writeResults
 
 def createDir( odir ):
   if not os.path.exists( odir ):
@@ -14,87 +21,115 @@ def createDir( odir ):
     print "   The output directory already exists"
 # createDir()
 
-def getTree( fNames, tName ):
+# The slopes of the former fixed cut per gamma, 1.1: 1, 1.25: 1.6, 2: 3 and
+# 10: 80, always scanned so that its selections can be reproduced
+LegacySlopes = [ 1., 1.6, 3., 80. ]
 
-  t = ROOT.TChain( tName )
-  for fName in fNames:
-    t.AddFile( fName )
+def makeCutGrids( costhl, costhh, ncosth, phl, phh, nph ):
 
-  t.SetDirectory(0)
-  return t
-# getTree()
+  # The intercepts c of the linear cut are evenly spaced and its slopes ph
+  # geometrically, as they span orders of magnitude, with the legacy slopes
+  # within [phl, phh] added
+  costhetaCuts = numpy.linspace( costhl, costhh, ncosth )
+  slopes       = numpy.exp( numpy.linspace( math.log( phl ), math.log( phh ), nph ) )
+  slopes       = numpy.union1d( slopes, [ ph for ph in LegacySlopes if phl <= ph <= phh ] )
 
-def selectEvents( tree, Vars, costhl, costhh, ncosth, ph ):
+  return costhetaCuts, slopes
+# def makeCutGrids()
 
-  n = tree.GetEntries()
-  nFiducial = 0
-  nPassed = {}
-  rPassed = {}
-  
-  costhetaCuts = numpy.linspace( costhl, costhh, ncosth )
+def cutLabel( cutGrids, index ):
+
+  # '<costheta cut>_<slope>' for a cell of the count tensor
+  costhetaCuts, slopes = cutGrids
+  iCut, iSlope = index
+
+  return '%f_%f' % ( costhetaCuts[iCut], slopes[iSlope] )
+# def cutLabel()
+
+def selectionColumns( Vars, selection = None ):
+
+  exprs = list( asExpression( selection ).columns )
+  return exprs + [ expr for expr in leadingExprs( Vars, [ 'P', 'Angle' ] ) if expr not in exprs ]
+# def selectionColumns()
+
+def countPassed( columns, Vars, cutGrids, selection = None ):
+
+  # nPassed is a dense tensor indexed by ( var, costhetaCut, slope ), the
+  # events passing p*(1-c) <= ph*(costheta-c) for every pair of the grid.
+  # The counts can be merged across entry ranges before the pass rates are
+  # computed with scanEngine.withPassRates.  The events are those of
+  # selection, the fiducial volume by default.
+  fiducial = selectionMask( columns, selection )
+  n = len( fiducial )
+
+  costhetaCuts, slopes = cutGrids
+  nPassed = numpy.zeros( ( len( Vars ), len( costhetaCuts ), len( slopes ) ), dtype = numpy.int64 )
   
-  for var in Vars:
-    nPassed[var] = {}
-    rPassed[var] = {}
-    for costhetaCut in costhetaCuts:
-      nPassed[var][costhetaCut] = 0
-      rPassed[var][costhetaCut] = 0
+  nFiducial = int( numpy.count_nonzero( fiducial ) )
   
-  for i in tree:
-    if i.isIn10kton == 0: continue
-    nFiducial += 1
+  for iVar, var in enumerate( Vars ):
     
-    for var in Vars:
-      
-      p = eval( 'i.%sP[0]' % var )
-      leaf = eval( 'i.%sAngle[0]' % var )
-      costheta = math.cos( leaf )
-      
-      for costhetaCut in costhetaCuts:
-        # pc = ( 1. - costhetaCut )*p + ph*costheta
-        # print 'p: %f, theta: %f, costheta: %f, pc: %f, ph: %f, costhl: %f' % ( p, leaf, costheta, pc, ph, costhetaCut )
-        if p == 0. or p*( 1. - costhetaCut ) > ph*( costheta - costhetaCut ): continue
-        nPassed[var][costhetaCut] += 1
+    p = columns['%sP[0]' % var][fiducial]
+    costheta = numpy.cos( columns['%sAngle[0]' % var][fiducial] )
+    nPassed[iVar] = linearCutCounts( costheta, p, costhetaCuts, slopes )
 
-  for var in Vars:
-    for costhetaCut in costhetaCuts:
-      rPassed[var][costhetaCut] = float(nPassed[var][costhetaCut])/float(nFiducial)
-      # print nPassed[var][costhetaCut], nFiducial
+  return n, nFiducial, nPassed
+# def countPassed()
 
+def selectEvents( tree, Vars, costhl, costhh, ncosth, phl, phh, nph, backend = 'numpy', selection = None ):
 
-  return n, nFiducial, nPassed, rPassed
+  selection = bindSelection( tree, selection, leadingExprs( Vars, [ 'P', 'Angle' ] ) )
+  cutGrids = makeCutGrids( costhl, costhh, ncosth, phl, phh, nph )
+  if backend == 'rdf':
+    counts = countLinear( tree, Vars, cutGrids, selection.toCpp() )
+  else:
+    counts = scanChunks( tree, selectionColumns( Vars, selection ), countPassed, ( Vars, cutGrids, selection ) )
+  return withPassRates( counts )
 # def selectEvents()
 
-def optimizeSelection( mass, gamma, Vars, bgScale, nPassed, rPassed ):
+def selectSample( fNames, Vars, cutGrids, backend = 'numpy', selection = None, entries = None ):
+
+  # The partial counts of an entry range of the sample, read chunk by chunk,
+  # or of the whole sample in one RDataFrame loop
+  tree = getTree( fNames, 'MCParticles' )
+  selection = bindSelection( tree, selection, leadingExprs( Vars, [ 'P', 'Angle' ] ) )
+  if backend == 'rdf':
+    return countLinear( tree, Vars, cutGrids, selection.toCpp() )
+  return scanChunks( tree, selectionColumns( Vars, selection ), countPassed, ( Vars, cutGrids, selection ), entries )
+# def selectSample()
 
-  E = mass * gamma
-  if E in [ 11., 22., 25., 44., 50. ]: Eround = int(E)
-  else: Eround = E
-  sKey = 'e%s_m%s' %( Eround, mass )
-  bKey = 'atmos_%s' % gamma
+def optimizeSamples( sKeys, Vars, bgScales, nPassed, rPassed, cutGrids ):
+
+  # The best ( costheta cut, slope ) of every background scale, signal
+  # sample and variable against the atmos background, all evaluated at once
+  # from the same counts
+  cellShape = ( len( cutGrids[0] ), len( cutGrids[1] ) )
+
+  nVars = len( Vars )
+  sEff = numpy.array( [ rPassed[sKey].reshape( nVars, -1 ) for sKey in sKeys ] )
+  nBkg = nPassed['atmos'].reshape( 1, nVars, -1 )
   # Scale the background events to 40kton*10 year exposure
-  backgroundScale = bgScale* 40./28.705
-  bestCut = {}
-  bestEff = {}
-  bestBkg = {}
-  
-  for var in Vars:
-    SprimeMin = 10000.
-    for costhetaCut in nPassed[sKey][var].keys():
-      sEff = rPassed[sKey][var][costhetaCut]
-      bEvents = float(nPassed[bKey][var][costhetaCut])*backgroundScale
-      Sprime = 25./ (2.*sEff) + math.sqrt( 25.*bEvents/ (sEff*sEff) + 625./(4.*sEff*sEff) )
-      if Sprime < SprimeMin:
-        SprimeMin = Sprime
-        bestCut[var] = costhetaCut
-        bestEff[var] = sEff
-        bestBkg[var] = bEvents
-        bestBkgErr[var] = math.sqrt( float(nPassed[bKey][var][costhetaCut]) )*backgroundScale
-  
-  return bestCut, bestEff, bestBkg, bestBkgErr
+  iBest, merit, eff, bkg, bkgErr = optimizeCuts( sEff, nBkg, numpy.asarray( bgScales )*BackgroundExposure, 'Sprime' )
+
+  label = lambda iCell: cutLabel( cutGrids, numpy.unravel_index( iCell, cellShape ) )
+  return [ bestSelections( Vars, label, iBest[i], eff[i], bkg[i], bkgErr[i] ) for i in range( len( bgScales ) ) ]
+# def optimizeSamples()
+
+def optimizeSelection( mass, gamma, Vars, bgScale, nPassed, rPassed, cutGrids ):
+
+  return optimizeSamples( [ sampleKey( mass, gamma ) ], Vars, [ bgScale ], nPassed, rPassed, cutGrids )[0][0]
   
 # def optimizeSelection()
 
+def writeSample( txtFile, Mass, Eround, Vars, bestCut, bestEff, bestBkg, bestBkgErr ):
+
+  txtFile.write('Mass = %s GeV, E = %s GeV\n' % ( str(Mass), str(Eround) ) )
+  
+  for var in Vars:
+    txtFile.write( '  %s: optimal cut at %s, signal efficieny = %f, background counts = %f, background uncertainty =  %f\n' %( var, bestCut[var], bestEff[var], bestBkg[var], bestBkgErr[var] ) )
+
+# def writeSample()
+
 if __name__ == "__main__":
  
   Vars = [ 'Visible', 'VisibleNoN', 'LeadingParticle', 'LeadingParticleNoN',
@@ -106,10 +141,43 @@ if __name__ == "__main__":
   parser.add_argument( '-s', dest = 'sDir', type = str, help = 'The directory of the input SIGNAL files.' )
   parser.add_argument( '-b', dest = 'bDir', type = str, help = 'The directory of the input BACKGROUND files.' )
   parser.add_argument( '-o', dest = 'oDir', type = str, help = 'The directory of the output plots.' )
-  parser.add_argument( '-m', dest = 'bgScale', type = float, default = 1., 
-                      help = 'The scale factor on the background events to account for additional background source.' )
+  parser.add_argument( '-m', dest = 'bgScales', type = str, nargs = '+', default = [ '1.' ],
+                      help = 'The scale factors on the background events to account for additional background source, numbers or first:last:n ranges.  Default 1.' )
+  parser.add_argument( '-j', dest = 'nJobs', type = int, default = 1,
+                      help = 'The number of samples processed in parallel.  Default 1.' )
+  parser.add_argument( '-n', dest = 'nShards', type = int, default = 1,
+                      help = 'The number of entry ranges each sample is split into for the parallel processing.  Default 1.' )
+  parser.add_argument( '--max-memory', dest = 'maxMemory', type = float, default = None,
+                      help = 'The memory budget of each process in MB, which sets how many entries are read at a time.  Default chunks of %d entries.' % DefaultChunkSize )
+  parser.add_argument( '--phl', dest = 'phl', type = float, default = 0.5,
+                      help = 'The smallest slope of the linear cut.  Default 0.5.' )
+  parser.add_argument( '--phh', dest = 'phh', type = float, default = 128.,
+                      help = 'The largest slope of the linear cut.  Default 128.' )
+  parser.add_argument( '--nph', dest = 'nph', type = int, default = 25,
+                      help = 'The number of slopes scanned, evenly spaced in log, to which the former slopes 1, 1.6, 3 and 80 are added.  Default 25.' )
+  parser.add_argument( '--backend', dest = 'backend', type = str, default = 'numpy', choices = Backends,
+                      help = 'The event loop, NumPy on the columns read chunk by chunk or a single RDataFrame loop per sample on ROOT implicit multi-threading (samples one at a time, -n ignored).  Default numpy.' )
+  parser.add_argument( '--threads', dest = 'nThreads', type = int, default = 0,
+                      help = 'The number of threads of the rdf backend, 0 for all the cores.  Default 0.' )
+  parser.add_argument( '--config', dest = 'config', type = str, default = None,
+                      help = 'A JSON file with the "vars" to optimize and the "selection" of the events.  Default the variables above and the fiducial volume.' )
+  parser.add_argument( '--selection', dest = 'selection', type = str, default = None,
+                      help = 'The selection of the events, e.g. "isIn10kton && VisibleNoNP > 0", over the one of the config.  Default %s.' % Fiducial )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
   
   args = parser.parse_args()
+  config = loadConfig( args.config ) if args.config else {}
+  Vars = config.get( 'vars', Vars )
+  selection = parseExpression( args.selection or config.get( 'selection', Fiducial ) )
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
+  if args.backend == 'rdf':
+    enableImplicitMT( args.nThreads )
+  setMaxMemory( args.maxMemory )
+  bgScales = parseScales( args.bgScales )
 
   Masses     = [ 5, 10, 20, 40 ]
   Gammas     = [ 1.1, 1.25, 2, 10 ]
@@ -121,32 +189,22 @@ if __name__ == "__main__":
   costhl     = 0.1
   costhh     = 0.95
   ncosth     = 18
-  ph         = { 1.1: 1., 1.25: 1.6, 2: 3., 10: 80. }
-  bestCut    = {}
-  bestEff    = {}
-  bestBkg    = {}
-  bestBkgErr = {}
+  cutGrids   = makeCutGrids( costhl, costhh, ncosth, args.phl, args.phh, args.nph )
 
   # Create the output directory
   createDir( args.oDir )
   
-  # Create the output text file
-  txtName = '%s/1DLinear_Efficiency_scalar_bgScale%f.txt' % ( args.oDir, args.bgScale )
-  txtFile = open( txtName, 'w' )
     
 
-  # Background
+  # Background, read once for the whole ( costheta cut, slope ) grid
   bFile = [ '%s/prodgenie_atmnu_max_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir, '%s/prodgenie_atmnu_min_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir ]
-  bTree = getTree( bFile, 'MCParticles' )
+  samples = [ ( 'atmos', bFile ) ]
   
   # Signal
+  signals = []
   for Mass in Masses:
     for Gamma in Gammas:
       
-      bKey = 'atmos_%s' % Gamma
-      nTotal[bKey], nFiducial[bKey], nPassed[bKey], passRate[bKey] = selectEvents( bTree, Vars, costhl, costhh, ncosth, ph[Gamma] )
-    
-      
       if Mass in [ 5, 20, 40 ] and ( Gamma == 2 ):
         continue
       
@@ -155,11 +213,31 @@ if __name__ == "__main__":
       else: Eround = E
       sFile = [ '%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_reco_ana.root' %( args.sDir, str(Eround), str(Mass) ) ]
       sKey = 'e%s_m%s' %( Eround, Mass )
-      sTree = getTree( sFile, 'MCParticles' )
-      nTotal[sKey], nFiducial[sKey], nPassed[sKey], passRate[sKey] = selectEvents( sTree, Vars, costhl, costhh, ncosth, ph[Gamma] )
-      # optimize the selection
-      bestCut[sKey], bestEff[sKey], bestBkg[sKey], bestBkgErr[sKey] = optimizeSelection( Mass, Gamma, Vars, args.bgScale, nPassed, passRate )
-      txtFile.write('Mass = %s GeV, E = %s GeV\n' % ( str(Mass), str(Eround) ) )
-      
-      for var in Vars:
-        txtFile.write( '  %s: optimal cut at %f, signal efficieny = %f, background counts = %f, background uncertainty =  %f\n' %( var, bestCut[sKey][var], bestEff[sKey][var], bestBkg[sKey][var], bestBkgErr[sKey][var] ) )
+      samples.append( ( sKey, sFile ) )
+      signals.append( ( Mass, Gamma, Eround, sKey ) )
+
+  # Select the events of all the samples, args.nJobs entry ranges at a time
+  # or one sample at a time on all the threads
+  jobs = [ ( fNames, Vars, cutGrids, args.backend, selection ) for key, fNames in samples ]
+  nJobs, nShards = ( 1, 1 ) if args.backend == 'rdf' else ( args.nJobs, args.nShards )
+  for ( key, fNames ), result in zip( samples, mapSharded( selectSample, jobs, nJobs, nShards ) ):
+    nTotal[key], nFiducial[key], nPassed[key], passRate[key] = withPassRates( result )
+
+  # optimize the selections of all the signal samples and background scales at once
+  best = optimizeSamples( [ sKey for Mass, Gamma, Eround, sKey in signals ], Vars, bgScales, nPassed, passRate, cutGrids )
+  for bgScale, scaleSelections in zip( bgScales, best ):
+    txtFile = open( '%s/1DLinear_Efficiency_scalar_bgScale%f.txt' % ( args.oDir, bgScale ), 'w' )
+    for ( Mass, Gamma, Eround, sKey ), bestCuts in zip( signals, scaleSelections ):
+      writeSample( txtFile, Mass, Eround, Vars, *bestCuts )
+    txtFile.close()
+
+  # All the scales in one table
+  txtFile = open( '%s/1DLinear_Efficiency_scalar_bgScaleTable.txt' % args.oDir, 'w' )
+  writeScanTable( txtFile, bgScales, [ ( Mass, Eround ) for Mass, Gamma, Eround, sKey in signals ], Vars, best )
+  txtFile.close()
+
+  # and in the results file read by scalar_dm_plots
+  writeResults( '%s/1DLinear_Efficiency_scalar_results.npz' % args.oDir, bgScales, [ ( Mass, Eround ) for Mass, Gamma, Eround, sKey in signals ], Vars, best )
+
+  reportProfile()
+  reportPeakMemory( args.maxMemory )
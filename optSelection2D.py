@@ -5,6 +5,13 @@ import argparse
 import ROOT
 import math
 import numpy
+from mcReader import getTree, leadingExprs, setMaxMemory, DefaultChunkSize
+from cutScan import windowSplitCounts, windowMask, combineSplit
+from scanEngine import mapSharded, scanChunks, withPassRates, reportPeakMemory, sampleKey
+from profiling import enableProfile, reportProfile
+from rdfBackend import Backends, enableImplicitMT, countWindows
+from selectionExpr import Fiducial, asExpression, bindSelection, selectionMask, parseExpression, loadConfig
+from cutOptimizer import BackgroundExposure, optimizeBlocks, bestSelections, parseScales, writeScanTable, writeResults
 
 def createDir( odir ):
   if not os.path.exists( odir ):
@@ -14,112 +21,127 @@ def createDir( odir ):
     print "   The output directory already exists"
 # createDir()
 
-def getTree( fNames, tName ):
+def makeCutGrids( pl, ph, np, costhll, costhlh, ncosthl, costhhl, costhhh, ncosthh ):
 
-  t = ROOT.TChain( tName )
-  for fName in fNames:
-    t.AddFile( fName )
-
-  t.SetDirectory(0)
-  return t
-# getTree()
-
-def selectEvents( tree, Vars, pl, ph, np, costhll, costhlh, ncosthl, costhhl, costhhh, ncosthh ):
-
-  n = tree.GetEntries()
-  nFiducial = 0
-  nPassed = {}
-  rPassed = {}
-  largeP  = {}
-  smallP  = {}
-  
   pBins      = numpy.linspace( pl, ph, np )
   costhlCuts = numpy.linspace( costhll, costhlh, ncosthl )
   costhhCuts = numpy.linspace( costhhl, costhhh, ncosthh )
+
+  return pBins, costhlCuts, costhhCuts
+# def makeCutGrids()
+
+def cutLabel( cutGrids, index ):
+
+  # '<pBin>_<small-p window>_<large-p window>' for a cell of the count tensor
+  pBins, costhlCuts, costhhCuts = cutGrids
+  iP, iSmallLow, iSmallHigh, iLargeLow, iLargeHigh = index
+
+  return '%f_%0.2f_%0.2f_%0.2f_%0.2f' % ( pBins[iP], costhlCuts[iSmallLow], costhhCuts[iSmallHigh],
+                                          costhlCuts[iLargeLow], costhhCuts[iLargeHigh] )
+# def cutLabel()
+
+def selectionColumns( Vars, selection = None ):
+
+  exprs = list( asExpression( selection ).columns )
+  return exprs + [ expr for expr in leadingExprs( Vars, [ 'P', 'Angle' ] ) if expr not in exprs ]
+# def selectionColumns()
+
+def countPassed( columns, Vars, cutGrids, selection = None ):
+
+  # nPassed is the ( smallP, largeP ) pair of the window counts below and
+  # above every momentum split, both indexed by
+  #   ( var, pBin, lowCut, highCut )
+  # and combined with cutScan.combineSplit into the counts of every
+  # ( pBin, small-p window, large-p window ) cell only when the cells are
+  # optimized, see optimizeSamples.  The counts can be merged across entry ranges before the pass rates are
+  # computed with scanEngine.withPassRates.  The events are those of
+  # selection, the fiducial volume by default.
+  fiducial = selectionMask( columns, selection )
+  n = len( fiducial )
+
+  pBins, costhlCuts, costhhCuts = cutGrids
+  smallP = numpy.zeros( ( len( Vars ), len( pBins ), len( costhlCuts ), len( costhhCuts ) ), dtype = numpy.int64 )
+  largeP = numpy.zeros( ( len( Vars ), len( pBins ), len( costhlCuts ), len( costhhCuts ) ), dtype = numpy.int64 )
   
-  for var in Vars:
-    nPassed[var] = {}
-    rPassed[var] = {}
-    largeP[var]  = {}
-    smallP[var]  = {}
-    for pBin in pBins:
-      largeP[var][pBin] = {}
-      smallP[var][pBin] = {}
-      for costhlCut in costhlCuts:
-        for costhhCut in costhhCuts:
-          if costhhCut <= costhlCut: continue
-          cut = '%0.2f_%0.2f' % ( costhlCut, costhhCut )
-          largeP[var][pBin][cut] = 0
-          smallP[var][pBin][cut] = 0
-  
-  for i in tree:
-    if i.isIn10kton == 0: continue
-    nFiducial += 1
+  nFiducial = int( numpy.count_nonzero( fiducial ) )
     
-    for var in Vars:
-      
-      p = eval( 'i.%sP[0]' % var )
-      leaf = eval( 'i.%sAngle[0]' % var )
-      costheta = math.cos( leaf )
-      if p == 0.: continue
-      
-      for costhlCut in costhlCuts:
-        for costhhCut in costhhCuts:
-          if costhhCut <= costhlCut: continue
-          if costheta < costhlCut or costheta > costhhCut: continue
-          for pBin in pBins:
-            cut = '%0.2f_%0.2f' % ( costhlCut, costhhCut )
-            # print 'var: %s, pBin: %f, cut: %s' % ( var, pBin, cut )
-            if p < pBin:
-              smallP[var][pBin][cut] += 1
-            else:
-              largeP[var][pBin][cut] += 1
+  for iVar, var in enumerate( Vars ):
+    
+    p = columns['%sP[0]' % var][fiducial]
+    costheta = numpy.cos( columns['%sAngle[0]' % var][fiducial] )
+    valid = p != 0.
+    smallP[iVar], largeP[iVar] = windowSplitCounts( costheta[valid], p[valid], pBins, costhlCuts, costhhCuts )
 
-  for var in Vars:
-    for pBin in pBins:
-      for smallKey in smallP[var][pBin].keys():
-        for largeKey in largeP[var][pBin].keys():
-          cut = '%f_%s_%s' % ( pBin, smallKey, largeKey )
-          nPassed[var][cut] = smallP[var][pBin][smallKey] + largeP[var][pBin][largeKey]
+  return n, nFiducial, ( smallP, largeP )
+# def countPassed()
 
+def selectEvents( tree, Vars, pl, ph, np, costhll, costhlh, ncosthl, costhhl, costhhh, ncosthh, backend = 'numpy', selection = None ):
 
-  for var in Vars:
-    for Cut in nPassed[var].keys():
-      rPassed[var][Cut] = float(nPassed[var][Cut])/float(nFiducial)
-      # print nPassed[var][costhetaCut], nFiducial
-
-  return n, nFiducial, nPassed, rPassed
+  selection = bindSelection( tree, selection, leadingExprs( Vars, [ 'P', 'Angle' ] ) )
+  cutGrids = makeCutGrids( pl, ph, np, costhll, costhlh, ncosthl, costhhl, costhhh, ncosthh )
+  if backend == 'rdf':
+    counts = countWindows( tree, Vars, cutGrids, selection.toCpp() )
+  else:
+    counts = scanChunks( tree, selectionColumns( Vars, selection ), countPassed, ( Vars, cutGrids, selection ) )
+  return withPassRates( counts )
 # def selectEvents()
 
-def optimizeSelection( mass, gamma, Vars, bgScale, nPassed, rPassed ):
+def selectSample( fNames, Vars, cutGrids, backend = 'numpy', selection = None, entries = None ):
+
+  # The partial counts of an entry range of the sample, read chunk by chunk,
+  # or of the whole sample in one RDataFrame loop
+  tree = getTree( fNames, 'MCParticles' )
+  selection = bindSelection( tree, selection, leadingExprs( Vars, [ 'P', 'Angle' ] ) )
+  if backend == 'rdf':
+    return countWindows( tree, Vars, cutGrids, selection.toCpp() )
+  return scanChunks( tree, selectionColumns( Vars, selection ), countPassed, ( Vars, cutGrids, selection ), entries )
+# def selectSample()
+
+def optimizeSamples( sKeys, Vars, bgScales, nPassed, nFiducial, cutGrids ):
+
+  # The best cell of the count tensors of every background scale, signal
+  # sample and variable against the atmos background, all evaluated from the
+  # same counts.  The small-p and large-p windows are combined one momentum
+  # split at a time, so that only one block of cells exists at once, and the
+  # efficiencies are their counts over nFiducial, as the pass rates of the
+  # whole tensors would be.  Only the cells where both windows are scanned
+  # compete.
+  pBins, costhlCuts, costhhCuts = cutGrids
+  window = windowMask( costhlCuts, costhhCuts )
+  scanned = window[:, :, numpy.newaxis, numpy.newaxis] & window[numpy.newaxis, numpy.newaxis, :, :]
+  cellShape = ( len( pBins ), ) + scanned.shape
+
+  nVars = len( Vars )
+  sSmall = numpy.array( [ nPassed[sKey][0] for sKey in sKeys ] )
+  sLarge = numpy.array( [ nPassed[sKey][1] for sKey in sKeys ] )
+  sFiducial = numpy.array( [ float( nFiducial[sKey] ) for sKey in sKeys ] ).reshape( -1, 1, 1 )
+  bSmall, bLarge = nPassed['atmos']
+  blocks = ( ( combineSplit( sSmall[:, :, iP], sLarge[:, :, iP] ).reshape( len( sKeys ), nVars, -1 )/sFiducial,
+               combineSplit( bSmall[:, iP], bLarge[:, iP] ).reshape( 1, nVars, -1 ),
+               scanned.reshape( -1 ) ) for iP in range( len( pBins ) ) )
 
-  E = mass * gamma
-  if E in [ 11., 22., 25., 44., 50. ]: Eround = int(E)
-  else: Eround = E
-  sKey = 'e%s_m%s' %( Eround, mass )
   # Scale the background events to 40kton*10 year exposure
-  backgroundScale = bgScale* 40./28.705
-  bestCut = {}
-  bestEff = {}
-  bestBkg = {}
-  
-  for var in Vars:
-    SprimeMin = 10000.
-    for Cut in nPassed[sKey][var].keys():
-      sEff = rPassed[sKey][var][Cut]
-      bEvents = float(nPassed['atmos'][var][Cut])*backgroundScale
-      Sprime = 25./ (2.*sEff) + math.sqrt( 25.*bEvents/ (sEff*sEff) + 625./(4.*sEff*sEff) )
-      if Sprime < SprimeMin:
-        SprimeMin = Sprime
-        bestCut[var] = Cut
-        bestEff[var] = sEff
-        bestBkg[var] = bEvents
-        bestBkgErr[var] = math.sqrt( float(nPassed['atmos'][var][Cut]) )*backgroundScale
-  
-  return bestCut, bestEff, bestBkg, bestBkgErr
+  iBest, merit, eff, bkg, bkgErr = optimizeBlocks( blocks, numpy.asarray( bgScales )*BackgroundExposure, 'Sprime' )
+
+  label = lambda iCell: cutLabel( cutGrids, numpy.unravel_index( iCell, cellShape ) )
+  return [ bestSelections( Vars, label, iBest[i], eff[i], bkg[i], bkgErr[i] ) for i in range( len( bgScales ) ) ]
+# def optimizeSamples()
+
+def optimizeSelection( mass, gamma, Vars, bgScale, nPassed, nFiducial, cutGrids ):
+
+  return optimizeSamples( [ sampleKey( mass, gamma ) ], Vars, [ bgScale ], nPassed, nFiducial, cutGrids )[0][0]
   
 # def optimizeSelection()
 
+def writeSample( txtFile, Mass, Eround, Vars, bestCut, bestEff, bestBkg, bestBkgErr ):
+
+  txtFile.write('Mass = %s GeV, E = %s GeV\n' % ( str(Mass), str(Eround) ) )
+  
+  for var in Vars:
+    txtFile.write( '  %s: optimal cut at %s, signal efficieny = %f, background counts = %f, background uncertainty =  %f\n' %( var, bestCut[var], bestEff[var], bestBkg[var], bestBkgErr[var] ) )
+
+# def writeSample()
+
 if __name__ == "__main__":
  
   Vars = [ 'Visible', 'VisibleNoN', 'SmearedReconstructable', 'SmearedReconstructableNoN',
@@ -129,10 +151,37 @@ if __name__ == "__main__":
   parser.add_argument( '-s', dest = 'sDir', type = str, help = 'The directory of the input SIGNAL files.' )
   parser.add_argument( '-b', dest = 'bDir', type = str, help = 'The directory of the input BACKGROUND files.' )
   parser.add_argument( '-o', dest = 'oDir', type = str, help = 'The directory of the output plots.' )
-  parser.add_argument( '-m', dest = 'bgScale', type = float, default = 1., 
-                      help = 'The scale factor on the background events to account for additional background source.' )
+  parser.add_argument( '-m', dest = 'bgScales', type = str, nargs = '+', default = [ '1.' ],
+                      help = 'The scale factors on the background events to account for additional background source, numbers or first:last:n ranges.  Default 1.' )
+  parser.add_argument( '-j', dest = 'nJobs', type = int, default = 1,
+                      help = 'The number of samples processed in parallel.  Default 1.' )
+  parser.add_argument( '-n', dest = 'nShards', type = int, default = 1,
+                      help = 'The number of entry ranges each sample is split into for the parallel processing.  Default 1.' )
+  parser.add_argument( '--max-memory', dest = 'maxMemory', type = float, default = None,
+                      help = 'The memory budget of each process in MB, which sets how many entries are read at a time.  Default chunks of %d entries.' % DefaultChunkSize )
+  parser.add_argument( '--backend', dest = 'backend', type = str, default = 'numpy', choices = Backends,
+                      help = 'The event loop, NumPy on the columns read chunk by chunk or a single RDataFrame loop per sample on ROOT implicit multi-threading (samples one at a time, -n ignored).  Default numpy.' )
+  parser.add_argument( '--threads', dest = 'nThreads', type = int, default = 0,
+                      help = 'The number of threads of the rdf backend, 0 for all the cores.  Default 0.' )
+  parser.add_argument( '--config', dest = 'config', type = str, default = None,
+                      help = 'A JSON file with the "vars" to optimize and the "selection" of the events.  Default the variables above and the fiducial volume.' )
+  parser.add_argument( '--selection', dest = 'selection', type = str, default = None,
+                      help = 'The selection of the events, e.g. "isIn10kton && VisibleNoNP > 0", over the one of the config.  Default %s.' % Fiducial )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
 
   args = parser.parse_args()
+  config = loadConfig( args.config ) if args.config else {}
+  Vars = config.get( 'vars', Vars )
+  selection = parseExpression( args.selection or config.get( 'selection', Fiducial ) )
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
+  if args.backend == 'rdf':
+    enableImplicitMT( args.nThreads )
+  setMaxMemory( args.maxMemory )
+  bgScales = parseScales( args.bgScales )
 
   Masses     = [ 5, 10, 20, 40 ]
   Gammas     = [ 1.1, 1.25 ]
@@ -150,25 +199,19 @@ if __name__ == "__main__":
   pl         = 0.1
   ph         = 1.
   np         = 19
-  bestCut    = {}
-  bestEff    = {}
-  bestBkg    = {}
-  bestBkgErr = {}
+  cutGrids   = makeCutGrids( pl, ph, np, costhll, costhlh, ncosthl, costhhl, costhhh, ncosthh )
   
   # Create the output directory
   createDir( args.oDir )
   
-  # Create the output text file
-  txtName = '%s/2D_Efficiency_p0.1-1_scalar_bgScale%f.txt' % ( args.oDir, args.bgScale )
-  txtFile = open( txtName, 'w' )
     
 
   # Background
   bFile = [ '%s/prodgenie_atmnu_max_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir, '%s/prodgenie_atmnu_min_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir ]
-  bTree = getTree( bFile, 'MCParticles' )
-  nTotal['atmos'], nFiducial['atmos'], nPassed['atmos'], passRate['atmos'] = selectEvents( bTree, Vars, pl, ph, np, costhll, costhlh, ncosthl, costhhl, costhhh, ncosthh )
+  samples = [ ( 'atmos', bFile ) ]
 
   # Signal
+  signals = []
   for Mass in Masses:
     for Gamma in Gammas:
       
@@ -180,11 +223,31 @@ if __name__ == "__main__":
       else: Eround = E
       sFile = [ '%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_reco_ana.root' %( args.sDir, str(Eround), str(Mass) ) ]
       sKey = 'e%s_m%s' %( Eround, Mass )
-      sTree = getTree( sFile, 'MCParticles' )
-      nTotal[sKey], nFiducial[sKey], nPassed[sKey], passRate[sKey] = selectEvents( sTree, Vars, pl, ph, np, costhll, costhlh, ncosthl, costhhl, costhhh, ncosthh )
-      # optimize the selection
-      bestCut[sKey], bestEff[sKey], bestBkg[sKey], bestBkgErr[sKey] = optimizeSelection( Mass, Gamma, Vars, args.bgScale, nPassed, passRate )
-      txtFile.write('Mass = %s GeV, E = %s GeV\n' % ( str(Mass), str(Eround) ) )
-      
-      for var in Vars:
-        txtFile.write( '  %s: optimal cut at %s, signal efficieny = %f, background counts = %f, background uncertainty =  %f\n' %( var, bestCut[sKey][var], bestEff[sKey][var], bestBkg[sKey][var], bestBkgErr[sKey][var] ) )
+      samples.append( ( sKey, sFile ) )
+      signals.append( ( Mass, Gamma, Eround, sKey ) )
+
+  # Select the events of all the samples, args.nJobs entry ranges at a time
+  # or one sample at a time on all the threads
+  jobs = [ ( fNames, Vars, cutGrids, args.backend, selection ) for key, fNames in samples ]
+  nJobs, nShards = ( 1, 1 ) if args.backend == 'rdf' else ( args.nJobs, args.nShards )
+  for ( key, fNames ), result in zip( samples, mapSharded( selectSample, jobs, nJobs, nShards ) ):
+    nTotal[key], nFiducial[key], nPassed[key], passRate[key] = withPassRates( result )
+
+  # optimize the selections of all the signal samples and background scales at once
+  best = optimizeSamples( [ sKey for Mass, Gamma, Eround, sKey in signals ], Vars, bgScales, nPassed, nFiducial, cutGrids )
+  for bgScale, scaleSelections in zip( bgScales, best ):
+    txtFile = open( '%s/2D_Efficiency_p0.1-1_scalar_bgScale%f.txt' % ( args.oDir, bgScale ), 'w' )
+    for ( Mass, Gamma, Eround, sKey ), bestCuts in zip( signals, scaleSelections ):
+      writeSample( txtFile, Mass, Eround, Vars, *bestCuts )
+    txtFile.close()
+
+  # All the scales in one table
+  txtFile = open( '%s/2D_Efficiency_p0.1-1_scalar_bgScaleTable.txt' % args.oDir, 'w' )
+  writeScanTable( txtFile, bgScales, [ ( Mass, Eround ) for Mass, Gamma, Eround, sKey in signals ], Vars, best )
+  txtFile.close()
+
+  # and in the results file read by scalar_dm_plots
+  writeResults( '%s/2D_Efficiency_p0.1-1_scalar_results.npz' % args.oDir, bgScales, [ ( Mass, Eround ) for Mass, Gamma, Eround, sKey in signals ], Vars, best )
+
+  reportProfile()
+  reportPeakMemory( args.maxMemory )
@@ -2,18 +2,18 @@
 
 import argparse
 import ROOT
-import math
+import numpy
 import os
+from mcReader import getTree, iterChunks, setMaxMemory, DefaultChunkSize
+from scanEngine import mapSharded, mergeResults, scanChunks, reportPeakMemory, sampleKey
+from histograms import Hist1D
+from plotRendering import renderPlots
+from profiling import enableProfile, reportProfile
+from rdfBackend import Backends, enableImplicitMT, fillAngular
+from selectionExpr import asExpression, bindSelection, selectionMask, parseExpression, loadConfig
 
-def getTree( fNames, tName ):
-
-  t = ROOT.TChain( tName )
-  for fName in fNames:
-    t.AddFile( fName )
-
-  t.SetDirectory(0)
-  return t
-# getTree()
+# The events counted in the pass rates, by default
+Fiducial = 'isIn10kton == 1'
 
 
 def bookAngularHistograms( Vars, Mass, Gamma ):
@@ -32,7 +32,7 @@ def bookAngularHistograms( Vars, Mass, Gamma ):
     if Mass == 0.:
       hName = 'atmosNu_%s' % var
       
-    hList[var] = ROOT.TH1D( hName, "%s; %s; %s" % ( hName, xTitle, yTitle ), nBins, xMin, xMax )
+    hList[var] = Hist1D( hName, "%s; %s; %s" % ( hName, xTitle, yTitle ), nBins, xMin, xMax )
 
   return hList
 
@@ -54,45 +54,89 @@ def bookMomentumHistograms( Vars, Mass, Gamma ):
     if Mass == 0.:
       hName = 'atmosNu_%s' % var
       
-    hList[var] = ROOT.TH1D( hName, "%s; %s; %s" % ( hName, xTitle, yTitle ), nBins, xMin, xMax )
+    hList[var] = Hist1D( hName, "%s; %s; %s" % ( hName, xTitle, yTitle ), nBins, xMin, xMax )
 
   return hList
 
 # def bookMomentumHistograms()
 
-def selectEvents( tree, hMomentumList, hAngularList, costhetaCut ):
+def selectionColumns( AngularVars, selection = None ):
+
+  MomentumVars = [ 'InParticleP', 'OutParticleP' ]
+  exprs = list( asExpression( selection, Fiducial ).columns )
+  return exprs + [ '%s[0]' % var for var in MomentumVars + list( AngularVars ) if '%s[0]' % var not in exprs ]
+# def selectionColumns()
 
-  n = tree.GetEntries()
+def fillFromColumns( columns, hMomentumList, hAngularList, costhetaCut, selection = None ):
+
+  # Partial histograms and counts, that can be merged across entry ranges
+  # before passRates() is applied.  The counts are the events of selection,
+  # the fiducial volume by default.
+  fiducial = selectionMask( columns, selection, Fiducial )
+  n = len( fiducial )
   nPassedEvents = {}
-  rPassedEvents = {}
   
   for var in hAngularList.keys():
     if var in [ 'InParticleAngle', 'OutParticleAngle' ]: continue
     nPassedEvents[var] = 0
-    rPassedEvents[var] = 0
   
-  for i in tree:
-    
-    for var in [ 'InParticleP', 'OutParticleP' ]:
-      leaf = eval( 'i.%s[0]' % var )
-      hMomentumList[var].Fill( leaf )
-    
-    for var in hAngularList.keys():
-      leaf = eval('i.%s[0]' % var)
-      costheta = math.cos( leaf )
-      hAngularList[var].Fill( costheta )
-      if var in [ 'InParticleAngle', 'OutParticleAngle' ]: continue
-      if ( i.isIn10kton == 1 ):
-        nPassedEvents[var] += 1
+  for var in [ 'InParticleP', 'OutParticleP' ]:
+    hMomentumList[var].fill( columns['%s[0]' % var] )
+  
+  nFiducial = int( numpy.count_nonzero( fiducial ) )
+  for var in hAngularList.keys():
+    hAngularList[var].fill( numpy.cos( columns['%s[0]' % var] ) )
+    if var in [ 'InParticleAngle', 'OutParticleAngle' ]: continue
+    nPassedEvents[var] += nFiducial
 
+  return hMomentumList, hAngularList, n, nPassedEvents
+# def fillFromColumns()
+
+def passRates( result ):
+
+  hMomentumList, hAngularList, n, nPassedEvents = result
+  rPassedEvents = {}
   for var in hAngularList.keys():
     if var in [ 'InParticleAngle', 'OutParticleAngle' ]: continue
     rPassedEvents[var] = float(nPassedEvents[var])/float(n)
     print '%s: %d/%d' %( var, nPassedEvents[var], n )
 
   return hMomentumList, hAngularList, n, nPassedEvents, rPassedEvents
+# def passRates()
+
+def selectEvents( tree, hMomentumList, hAngularList, costhetaCut, backend = 'numpy', selection = None ):
+
+  # The histograms are filled chunk by chunk, the counts summed up
+  selection = bindSelection( tree, selection, [ '%s[0]' % var for var in list( hMomentumList.keys() ) + list( hAngularList.keys() ) ], Fiducial )
+  if backend == 'rdf':
+    return passRates( fillAngular( tree, hMomentumList, hAngularList, selection.toCpp() ) )
+  n = 0
+  nPassedEvents = {}
+  for columns in iterChunks( tree, selectionColumns( hAngularList.keys(), selection ) ):
+    result = fillFromColumns( columns, hMomentumList, hAngularList, costhetaCut, selection )
+    n += result[2]
+    nPassedEvents = mergeResults( nPassedEvents, result[3] )
+  return passRates( ( hMomentumList, hAngularList, n, nPassedEvents ) )
 # def selectEvents()
 
+def fillChunk( columns, MomentumVars, AngularVars, Mass, Gamma, costhetaCut, selection = None ):
+
+  hMomentumList = bookMomentumHistograms( MomentumVars, Mass, Gamma )
+  hAngularList  = bookAngularHistograms( AngularVars, Mass, Gamma )
+  return fillFromColumns( columns, hMomentumList, hAngularList, costhetaCut, selection )
+# def fillChunk()
+
+def selectSample( fNames, MomentumVars, AngularVars, Mass, Gamma, costhetaCut, backend = 'numpy', selection = None, entries = None ):
+
+  # The partial histograms and counts of an entry range of the sample, read
+  # chunk by chunk, or of the whole sample in one RDataFrame loop
+  tree = getTree( fNames, 'MCParticles' )
+  selection = bindSelection( tree, selection, [ '%s[0]' % var for var in MomentumVars + list( AngularVars ) ], Fiducial )
+  if backend == 'rdf':
+    return fillAngular( tree, bookMomentumHistograms( MomentumVars, Mass, Gamma ), bookAngularHistograms( AngularVars, Mass, Gamma ), selection.toCpp() )
+  return scanChunks( tree, selectionColumns( AngularVars, selection ), fillChunk, ( MomentumVars, AngularVars, Mass, Gamma, costhetaCut, selection ), entries )
+# def selectSample()
+
 def makeAngularPlot( hADict, Mass, Gammas, var, oDir ):
 
   ROOT.gStyle.SetOptStat(0)
@@ -109,11 +153,10 @@ def makeAngularPlot( hADict, Mass, Gammas, var, oDir ):
   l.SetFillStyle(0)
   
   # Find the Ymax
-  gamma = Gammas[-1]
-  e = gamma*Mass
-  sKey = 'e%s_m%s' %( e, Mass )
-  h = hADict[sKey][var]
-  Ymax = h.GetBinContent( h.GetMaximumBin() )
+  Ymax = hADict[sampleKey( Mass, Gammas[-1] )][var].sumw[1:-1].max()
+
+  # The ROOT copies drawn on the canvas, kept alive until it is saved
+  hists = []
   
   for gamma in Gammas:
     if ( gamma == 2 ) and Mass in [ 5, 20, 40 ]:
@@ -122,7 +165,8 @@ def makeAngularPlot( hADict, Mass, Gammas, var, oDir ):
     if e in [ 11., 15., 22., 25., 30., 44., 50., 60. ]: eround = int(e)
     else: eround = e
     sKey = 'e%s_m%s' %( eround, Mass )
-    h = hADict[sKey][var]
+    h = hADict[sKey][var].toROOT()
+    hists.append( h )
     if gamma in [ 1.1, 1.25 ]:
       h.Scale( 5. )
     h.SetLineColor( colors[str(gamma)] )
@@ -144,7 +188,8 @@ def makeAngularPlot( hADict, Mass, Gammas, var, oDir ):
       l.AddEntry( h, 'DM, E = %s GeV' % str(eround) )
     # print 'M = %d, E = %f, total events = %f' %( Mass, e, h.Integral() )
   
-  h = hADict['atmos'][var]
+  h = hADict['atmos'][var].toROOT()
+  hists.append( h )
   h.SetLineColor( colors['atmos'] )
   h.SetLineWidth(3)
   print 'Atmospheric neutrino, total events = %f' % h.Integral()
@@ -156,11 +201,23 @@ def makeAngularPlot( hADict, Mass, Gammas, var, oDir ):
   c.Draw()
   plotName = '%s/m%s_%s.png' %( oDir, str(Mass), var )
   c.SaveAs( plotName )
-  h.Scale( 28.705/100. )
   
   
 # def makeAngularPlot()
 
+def angularPlotTasks( hADict, Masses, Gammas, Vars, oDir ):
+
+  # One rendering task per plot, with only the histograms that it draws
+  tasks = []
+  for Mass in Masses:
+    keys = [ 'atmos' ] + [ sampleKey( Mass, gamma ) for gamma in Gammas if not ( gamma == 2 and Mass in [ 5, 20, 40 ] ) ]
+    for var in Vars:
+      hists = dict( ( key, { var: hADict[key][var] } ) for key in keys )
+      tasks.append( ( '%s/m%s_%s.png' % ( oDir, str(Mass), var ), makeAngularPlot, ( hists, Mass, Gammas, var, oDir ) ) )
+
+  return tasks
+# def angularPlotTasks()
+
 if __name__ == "__main__":
 
   MomentumVars = [ 'InParticleP', 'OutParticleP' ]
@@ -174,8 +231,36 @@ if __name__ == "__main__":
   parser.add_argument( '-s', dest = 'sDir', type = str, help = 'The directory of the input SIGNAL files.' )
   parser.add_argument( '-b', dest = 'bDir', type = str, help = 'The directory of the input BACKGROUND files.' )
   parser.add_argument( '-o', dest = 'oDir', type = str, help = 'The directory of the output plots.' )
+  parser.add_argument( '-j', dest = 'nJobs', type = int, default = 1,
+                      help = 'The number of samples processed in parallel.  Default 1.' )
+  parser.add_argument( '-n', dest = 'nShards', type = int, default = 1,
+                      help = 'The number of entry ranges each sample is split into for the parallel processing.  Default 1.' )
+  parser.add_argument( '--max-memory', dest = 'maxMemory', type = float, default = None,
+                      help = 'The memory budget of each process in MB, which sets how many entries are read at a time.  Default chunks of %d entries.' % DefaultChunkSize )
+  parser.add_argument( '--force', dest = 'force', action = 'store_true',
+                      help = 'Redraw all the plots, also the ones whose histograms and style have not changed.' )
+  parser.add_argument( '--backend', dest = 'backend', type = str, default = 'numpy', choices = Backends,
+                      help = 'The event loop, NumPy on the columns read chunk by chunk or a single RDataFrame loop per sample on ROOT implicit multi-threading (samples one at a time, -n ignored).  Default numpy.' )
+  parser.add_argument( '--threads', dest = 'nThreads', type = int, default = 0,
+                      help = 'The number of threads of the rdf backend, 0 for all the cores.  Default 0.' )
+  parser.add_argument( '--config', dest = 'config', type = str, default = None,
+                      help = 'A JSON file with the angle branches to plot as "vars" and the "selection" of the events counted in the pass rates.  Default the branches above and the fiducial volume.' )
+  parser.add_argument( '--selection', dest = 'selection', type = str, default = None,
+                      help = 'The selection of the events counted in the pass rates, over the one of the config.  Default %s.' % Fiducial )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
   
   args = parser.parse_args()
+  config = loadConfig( args.config ) if args.config else {}
+  AngularVars = config.get( 'vars', AngularVars )
+  selection = parseExpression( args.selection or config.get( 'selection', Fiducial ) )
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
+  if args.backend == 'rdf':
+    enableImplicitMT( args.nThreads )
+  setMaxMemory( args.maxMemory )
 
 
   Masses   = [ 5, 10, 20, 40 ]
@@ -192,11 +277,7 @@ if __name__ == "__main__":
 
   # Background
   bFile = [ '%s/prodgenie_atmnu_max_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir, '%s/prodgenie_atmnu_min_dune10kt_gen_g4_NCFilter_reco_ana.root' % args.bDir ]
-  hPDict['atmos'] = bookMomentumHistograms( MomentumVars, 0., 0. )
-  hADict['atmos'] = bookAngularHistograms( AngularVars, 0., 0. )
-  bTree = getTree( bFile, 'MCParticles' )
-  print 'Atmospheric neutrino...'
-  hPDict['atmos'], hADict['atmos'], nTotal['atmos'], nPassed['atmos'], passRate['atmos'] = selectEvents( bTree, hPDict['atmos'], hADict['atmos'], 0.6 )
+  samples = [ ( 'atmos', bFile, 0., 0. ) ]
 
   for Mass in Masses:
     for Gamma in Gammas:
@@ -213,13 +294,20 @@ if __name__ == "__main__":
       Estr = str(Eround)
       sFile = ['%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_reco_ana.root' %( args.sDir, Estr, str(Mass) ) ]
       sKey = 'e%s_m%s' %( Eround, Mass )
-      hPDict[sKey] = bookMomentumHistograms( MomentumVars, Mass, Gamma )
-      hADict[sKey] = bookAngularHistograms( AngularVars, Mass, Gamma )
-      sTree = getTree( sFile, 'MCParticles' )
-      print 'M = %d, E = %f' %( Mass, E )
-      hPDict[sKey], hADict[sKey], nTotal[sKey], nPassed[sKey], passRate[sKey] = selectEvents( sTree, hPDict[sKey], hADict[sKey], 0.6 )
+      samples.append( ( sKey, sFile, Mass, Gamma ) )
+
+  # Fill the histograms of all the samples, args.nJobs entry ranges at a time
+  # or one sample at a time on all the threads
+  jobs = [ ( fNames, MomentumVars, AngularVars, Mass, Gamma, 0.6, args.backend, selection ) for key, fNames, Mass, Gamma in samples ]
+  nJobs, nShards = ( 1, 1 ) if args.backend == 'rdf' else ( args.nJobs, args.nShards )
+  for ( key, fNames, Mass, Gamma ), result in zip( samples, mapSharded( selectSample, jobs, nJobs, nShards ) ):
+    if key == 'atmos':
+      print 'Atmospheric neutrino...'
+    else:
+      print 'M = %d, E = %f' %( Mass, Mass * Gamma )
+    hPDict[key], hADict[key], nTotal[key], nPassed[key], passRate[key] = passRates( result )
 
-  for Mass in Masses:
-    for var in AngularVars:
-      makeAngularPlot( hADict, Mass, Gammas, var, args.oDir )
+  renderPlots( angularPlotTasks( hADict, Masses, Gammas, AngularVars, args.oDir ), args.nJobs, args.force )
 
+  reportProfile()
+  reportPeakMemory( args.maxMemory )
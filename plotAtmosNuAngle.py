@@ -2,18 +2,17 @@
 
 import argparse
 import ROOT
-import math
+import numpy
 import os
+from mcReader import getTree, iterChunks, setMaxMemory, DefaultChunkSize
+from scanEngine import reportPeakMemory
+from histograms import Hist1D
+from plotRendering import renderPlots
+from profiling import stage, setSample, enableProfile, reportProfile
+from selectionExpr import asExpression, bindSelection, selectionMask, parseExpression, loadConfig
 
-def getTree( fNames, tName ):
-
-  t = ROOT.TChain( tName )
-  for fName in fNames:
-    t.AddFile( fName )
-
-  t.SetDirectory(0)
-  return t
-# getTree()
+# The events filled in the histograms, by default
+Fiducial = 'isIn10kton == 1'
 
 
 def bookAngularHistograms( Vars, Sample ):
@@ -29,14 +28,23 @@ def bookAngularHistograms( Vars, Sample ):
     
     hName = '%s_%s' % ( Sample, var )
 
-    hList[var] = ROOT.TH1D( hName, "%s; %s; %s" % ( hName, xTitle, yTitle ), nBins, xMin, xMax )
+    hList[var] = Hist1D( hName, "%s; %s; %s" % ( hName, xTitle, yTitle ), nBins, xMin, xMax )
 
   return hList
 
 # def bookAngularHistograms()
 
-def fillHistograms( tree, hAngularList ):
+def selectionColumns( Vars, selection = None ):
+
+  exprs = list( asExpression( selection, Fiducial ).columns )
+  return exprs + [ '%s[0]' % var for var in Vars if '%s[0]' % var not in exprs ]
+# def selectionColumns()
+
+def fillHistograms( tree, hAngularList, selection = None ):
 
+  # Only the events of selection, the fiducial volume by default, are filled
+  # and counted
+  selection = bindSelection( tree, selection, [ '%s[0]' % var for var in hAngularList.keys() ], Fiducial )
   n = tree.GetEntries()
   nPassedEvents = {}
   rPassedEvents = {}
@@ -45,14 +53,15 @@ def fillHistograms( tree, hAngularList ):
     nPassedEvents[var] = 0
     rPassedEvents[var] = 0
   
-  for i in tree:
-        
-    for var in hAngularList.keys():
-      leaf = eval('i.%s[0]' % var)
-      costheta = math.cos( leaf )
-      if ( i.isIn10kton == 1 ):
-        hAngularList[var].Fill( costheta )
-        nPassedEvents[var] += 1
+  for columns in iterChunks( tree, selectionColumns( hAngularList.keys(), selection ) ):
+    with stage( 'fill' ) as counts:
+      fiducial = selectionMask( columns, selection, Fiducial )
+      nFiducial = int( numpy.count_nonzero( fiducial ) )
+  
+      for var in hAngularList.keys():
+        hAngularList[var].fill( numpy.cos( columns['%s[0]' % var][fiducial] ) )
+        nPassedEvents[var] += nFiducial
+      counts['events'] = len( fiducial )
 
   for var in hAngularList.keys():
     rPassedEvents[var] = float(nPassedEvents[var])/float(n)
@@ -79,9 +88,13 @@ def makeAngularPlot( hADict, var, oDir ):
   # h = hADict['noosc_E010G_100G'][var]
   # h.Scale( 1./h.Integral() )
   # Ymax = h.GetBinContent( h.GetMaximumBin() )
+
+  # The ROOT copies drawn on the canvas, kept alive until it is saved
+  hists = []
   
   for sample in hADict.keys():
-    h = hADict[sample][var]
+    h = hADict[sample][var].toROOT()
+    hists.append( h )
     h.Scale( 1./h.Integral() )
     h.SetLineColor( colors[sample] )
     h.SetLineWidth(3)
@@ -120,6 +133,16 @@ def makeAngularPlot( hADict, var, oDir ):
   
 # def makeAngularPlot()
 
+def angularPlotTasks( hADict, Vars, oDir ):
+
+  tasks = []
+  for var in Vars:
+    hists = dict( ( sample, { var: hADict[sample][var] } ) for sample in hADict.keys() )
+    tasks.append( ( '%s/%s.png' % ( oDir, var ), makeAngularPlot, ( hists, var, oDir ) ) )
+
+  return tasks
+# def angularPlotTasks()
+
 
 
 if __name__ == "__main__":
@@ -136,8 +159,28 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser( description = 'Make angular distributions for the atmospheric neutrino samples.')
   parser.add_argument( '-i', dest = 'iDir', type = str, help = 'Specify the directory of the input ROOT files.' )
   parser.add_argument( '-o', dest = 'oDir', type = str, help = 'Specify the directory for the output plots.' )
+  parser.add_argument( '--config', dest = 'config', type = str, default = None,
+                      help = 'A JSON file with the angle branches to plot as "vars" and the "selection" of the events filled.  Default the branches above and the fiducial volume.' )
+  parser.add_argument( '--selection', dest = 'selection', type = str, default = None,
+                      help = 'The selection of the events filled, over the one of the config.  Default %s.' % Fiducial )
+  parser.add_argument( '--max-memory', dest = 'maxMemory', type = float, default = None,
+                      help = 'The memory budget in MB, which sets how many entries are read at a time.  Default chunks of %d entries.' % DefaultChunkSize )
+  parser.add_argument( '-j', dest = 'nJobs', type = int, default = 1,
+                      help = 'The number of plots rendered in parallel.  Default 1.' )
+  parser.add_argument( '--force', dest = 'force', action = 'store_true',
+                      help = 'Redraw all the plots, also the ones whose histograms and style have not changed.' )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
   
   args = parser.parse_args()
+  config = loadConfig( args.config ) if args.config else {}
+  Vars = config.get( 'vars', Vars )
+  selection = parseExpression( args.selection or config.get( 'selection', Fiducial ) )
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
+  setMaxMemory( args.maxMemory )
   
   if not os.path.exists( args.oDir ):
     os.makedirs( args.oDir )  
@@ -173,9 +216,12 @@ if __name__ == "__main__":
   for sample in Files.keys():
     
     print 'Filling the histograms for the sample %s...' % sample
+    setSample( sample )
     hADict[sample] = bookAngularHistograms( Vars, sample )
     tree = getTree( Files[sample], 'MCParticles' )
-    hADict[sample] = fillHistograms( tree, hADict[sample] )
+    hADict[sample] = fillHistograms( tree, hADict[sample], selection )
 
-  for var in Vars:
-    makeAngularPlot( hADict, var, args.oDir )
+  renderPlots( angularPlotTasks( hADict, Vars, args.oDir ), args.nJobs, args.force )
+
+  reportProfile()
+  reportPeakMemory( args.maxMemory )
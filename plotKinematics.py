@@ -2,18 +2,18 @@
 
 import argparse
 import ROOT
-import math
+import numpy
 import os
+from mcReader import getTree, iterChunks, leadingExprs, setMaxMemory, DefaultChunkSize
+from scanEngine import mapSharded, scanChunks, reportPeakMemory
+from histograms import Hist2D
+from plotRendering import renderPlots
+from profiling import enableProfile, reportProfile
+from rdfBackend import Backends, enableImplicitMT, fillKinematics
+from selectionExpr import asExpression, bindSelection, selectionMask, parseExpression, loadConfig
 
-def getTree( fNames, tName ):
-
-  t = ROOT.TChain( tName )
-  for fName in fNames:
-    t.AddFile( fName )
-
-  t.SetDirectory(0)
-  return t
-# getTree()
+# The events filled in the histograms, by default all of them
+AllEvents = '1'
 
 
 def bookHistograms( Vars, Mass, Gamma ):
@@ -44,56 +44,97 @@ def bookHistograms( Vars, Mass, Gamma ):
     else:
       hName = "e%s_m%s_%s" % ( str(Gamma*Mass), str(Mass), var )
       
-    hList[var] = ROOT.TH2D( hName, "%s; %s; %s" % ( hName, xTitle, yTitle ), nXBins, xMin, xMax, nYBins, yMin, yMax )
+    hList[var] = Hist2D( hName, "%s; %s; %s" % ( hName, xTitle, yTitle ), nXBins, xMin, xMax, nYBins, yMin, yMax )
 
   return hList
 
 # def bookHistograms()
 
-def fillHistograms( t, h, Vars ):
+# The leading-particle branches behind each kinematic correlation
+KinematicBranches = { 'TrueKin': 'Visible', 'RecoKin': 'SmearedReconstructable',
+                      'TrueNoNKin': 'VisibleNoN', 'RecoNoNKin': 'SmearedReconstructableNoN' }
+
+def selectionColumns( Vars, selection = None ):
+
+  exprs = list( asExpression( selection, AllEvents ).columns )
+  return exprs + [ expr for expr in leadingExprs( [ KinematicBranches[var] for var in Vars ], [ 'P', 'Angle' ] ) if expr not in exprs ]
+# def selectionColumns()
+
+def fillFromColumns( columns, h, Vars, selection = None ):
   
-  for i in t:
-    for var in Vars:
-      if var == 'TrueKin':
-        visibleCosth = math.cos( i.VisibleAngle[0] )
-        h[var].Fill( visibleCosth, i.VisibleP[0] )
-      elif var == 'RecoKin':
-        recoCosth = math.cos( i.SmearedReconstructableAngle[0] )
-        h[var].Fill( recoCosth, i.SmearedReconstructableP[0] )
-      elif var == 'TrueNoNKin':
-        visibleNoNCosth = math.cos( i.VisibleNoNAngle[0] )
-        h[var].Fill ( visibleNoNCosth, i.VisibleNoNP[0] )
-      elif var == 'RecoNoNKin':
-        recoNoNCosth = math.cos( i.SmearedReconstructableNoNAngle[0] )
-        h[var].Fill( recoNoNCosth, i.SmearedReconstructableNoNP[0] )
+  selected = selectionMask( columns, selection, AllEvents )
+  for var in Vars:
+    branch = KinematicBranches[var]
+    h[var].fill( numpy.cos( columns['%sAngle[0]' % branch][selected] ), columns['%sP[0]' % branch][selected] )
         
   return h
 
+# def fillFromColumns()
+
+def fillHistograms( t, h, Vars, backend = 'numpy', selection = None ):
+  
+  selection = bindSelection( t, selection, selectionColumns( Vars ), AllEvents )
+  if backend == 'rdf':
+    return fillKinematics( t, h, Vars, KinematicBranches, selection.toCpp() )
+  for columns in iterChunks( t, selectionColumns( Vars, selection ) ):
+    fillFromColumns( columns, h, Vars, selection )
+  return h
+
 # def fillHistograms()
 
-def makePlots( sample, hDict, Vars, oDir ):
+def fillChunk( columns, Vars, Mass, Gamma, selection = None ):
+
+  h = bookHistograms( Vars, Mass, Gamma )
+  return fillFromColumns( columns, h, Vars, selection )
+
+# def fillChunk()
+
+def fillSample( fNames, Vars, Mass, Gamma, backend = 'numpy', selection = None, entries = None ):
+
+  # The histograms of the events of selection, all of them by default, in an
+  # entry range of the sample, filled chunk by chunk, or in the whole sample
+  # in one RDataFrame loop
+  tree = getTree( fNames, 'MCParticles' )
+  selection = bindSelection( tree, selection, selectionColumns( Vars ), AllEvents )
+  if backend == 'rdf':
+    return fillKinematics( tree, bookHistograms( Vars, Mass, Gamma ), Vars, KinematicBranches, selection.toCpp() )
+  return scanChunks( tree, selectionColumns( Vars, selection ), fillChunk, ( Vars, Mass, Gamma, selection ), entries )
+
+# def fillSample()
+
+def makePlot( sample, h, var, outdir ):
   
+  ROOT.gStyle.SetOptStat(0)
+  cName = '%s%s' % ( sample, var )
+  cTitle = '%s %s Kinematics' % ( sample, var )
+  c = ROOT.TCanvas( cName, cTitle, 800, 600 )
+  c.SetLeftMargin( 0.15 )
+  c.SetBottomMargin( 0.15 )
+
+  h = h.toROOT()
+  h.GetXaxis().SetLabelSize(0.06)
+  h.GetYaxis().SetLabelSize(0.06)
+  h.GetXaxis().SetTitleSize(0.07)
+  h.GetYaxis().SetTitleSize(0.07)
+  h.SetTitle( '')
+  h.Draw('COLZ')
+  c.Draw()
+  plotName = '%s/%s_%s.png' % ( outdir, sample, var )
+  c.SaveAs( plotName )
+
+# def makePlot()
+
+def kinematicPlotTasks( sample, hDict, Vars, outdir ):
+
   if not os.path.exists( outdir ):
     os.makedirs( outdir )
+
+  return [ ( '%s/%s_%s.png' % ( outdir, sample, var ), makePlot, ( sample, hDict[sample][var], var, outdir ) ) for var in Vars ]
+# def kinematicPlotTasks()
+
+def makePlots( sample, hDict, Vars, outdir, nJobs = 1, force = False ):
   
-  for var in Vars:
-    
-    ROOT.gStyle.SetOptStat(0)
-    cName = '%s%s' % ( sample, var )
-    cTitle = '%s %s Kinematics' % ( sample, var )
-    c = ROOT.TCanvas( cName, cTitle, 800, 600 )
-    c.SetLeftMargin( 0.15 )
-    c.SetBottomMargin( 0.15 )
-
-    hDict[sample][var].GetXaxis().SetLabelSize(0.06)
-    hDict[sample][var].GetYaxis().SetLabelSize(0.06)
-    hDict[sample][var].GetXaxis().SetTitleSize(0.07)
-    hDict[sample][var].GetYaxis().SetTitleSize(0.07)
-    hDict[sample][var].SetTitle( '')
-    hDict[sample][var].Draw('COLZ')
-    c.Draw()
-    plotName = '%s/%s_%s.png' % ( outdir, sample, var )
-    c.SaveAs( plotName )
+  renderPlots( kinematicPlotTasks( sample, hDict, Vars, outdir ), nJobs, force )
 
 # def makePlots()
 
@@ -106,8 +147,36 @@ if __name__ == "__main__":
   parser.add_argument( '-s', dest = 'sDir', type = str, help = 'The directory of the input SIGNAL files.' )
   parser.add_argument( '-b', dest = 'bDir', type = str, help = 'The directory of the input BACKGROUND files.' )
   parser.add_argument( '-o', dest = 'oDir', type = str, help = 'The directory of the output plots.' )
+  parser.add_argument( '--config', dest = 'config', type = str, default = None,
+                      help = 'A JSON file with the correlations to plot as "vars", among %s, and the "selection" of the events filled.  Default all the correlations and all the events.' % ' '.join( sorted( KinematicBranches.keys() ) ) )
+  parser.add_argument( '--selection', dest = 'selection', type = str, default = None,
+                      help = 'The selection of the events filled, over the one of the config.  Default all the events.' )
+  parser.add_argument( '-j', dest = 'nJobs', type = int, default = 1,
+                      help = 'The number of samples processed in parallel.  Default 1.' )
+  parser.add_argument( '-n', dest = 'nShards', type = int, default = 1,
+                      help = 'The number of entry ranges each sample is split into for the parallel processing.  Default 1.' )
+  parser.add_argument( '--max-memory', dest = 'maxMemory', type = float, default = None,
+                      help = 'The memory budget of each process in MB, which sets how many entries are read at a time.  Default chunks of %d entries.' % DefaultChunkSize )
+  parser.add_argument( '--force', dest = 'force', action = 'store_true',
+                      help = 'Redraw all the plots, also the ones whose histograms and style have not changed.' )
+  parser.add_argument( '--backend', dest = 'backend', type = str, default = 'numpy', choices = Backends,
+                      help = 'The event loop, NumPy on the columns read chunk by chunk or a single RDataFrame loop per sample on ROOT implicit multi-threading (samples one at a time, -n ignored).  Default numpy.' )
+  parser.add_argument( '--threads', dest = 'nThreads', type = int, default = 0,
+                      help = 'The number of threads of the rdf backend, 0 for all the cores.  Default 0.' )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
   
   args = parser.parse_args()
+  config = loadConfig( args.config ) if args.config else {}
+  Vars = config.get( 'vars', Vars )
+  selection = parseExpression( args.selection or config.get( 'selection', AllEvents ) )
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
+  if args.backend == 'rdf':
+    enableImplicitMT( args.nThreads )
+  setMaxMemory( args.maxMemory )
 
 
   Masses   = [ 5, 10, 20, 40 ]
@@ -117,13 +186,7 @@ if __name__ == "__main__":
 
   # Background
   bFile = [ '%s/prodgenie_atmnu_max_dune10kt_gen_g4_NCFilter_RecoSmear_ana.root' % args.bDir, '%s/prodgenie_atmnu_min_dune10kt_gen_g4_NCFilter_RecoSmear_ana.root' % args.bDir ]
-  hDict['atmos'] = bookHistograms( Vars, 0, 0 )
-  bTree = getTree( bFile, 'MCParticles' )
-  print 'Atmospheric neutrino sample: Fill histograms...'
-  hDict['atmos'] = fillHistograms( bTree, hDict['atmos'], Vars )
-  print 'Atmospheric neutrino sample: Make plots...'
-  outdir = '%s/atmos_kinematics' % args.oDir
-  makePlots( 'atmos', hDict, Vars, outdir )
+  samples = [ ( 'atmos', bFile, 0, 0 ) ]
 
   for Mass in Masses:
     for Gamma in Gammas:
@@ -140,10 +203,25 @@ if __name__ == "__main__":
       else: Estr = str(Eround)
       sFile = ['%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_RecoSmear_ana.root' %( args.sDir, Estr, str(Mass) ) ]
       sKey = 'e%s_m%s' %( Eround, Mass )
-      hDict[sKey] = bookHistograms( Vars, Mass, Gamma )
-      sTree = getTree( sFile, 'MCParticles' )
-      print 'BDM M = %d, E = %f sample: Fill histograms...' %( Mass, E )
-      hDict[sKey] = fillHistograms( sTree, hDict[sKey], Vars )
-      print 'BDM M = %d, E = %f sample: Make plots...' %( Mass, E )
-      outdir = '%s/%s_kinematics' % ( args.oDir, sKey )
-      makePlots( sKey, hDict, Vars, outdir )
+      samples.append( ( sKey, sFile, Mass, Gamma ) )
+
+  # Fill the histograms of all the samples, args.nJobs entry ranges at a time
+  # or one sample at a time on all the threads
+  print 'Fill histograms...'
+  jobs = [ ( fNames, Vars, Mass, Gamma, args.backend, selection ) for key, fNames, Mass, Gamma in samples ]
+  nJobs, nShards = ( 1, 1 ) if args.backend == 'rdf' else ( args.nJobs, args.nShards )
+  for ( key, fNames, Mass, Gamma ), h in zip( samples, mapSharded( fillSample, jobs, nJobs, nShards ) ):
+    hDict[key] = h
+
+  tasks = []
+  for key, fNames, Mass, Gamma in samples:
+    if key == 'atmos':
+      print 'Atmospheric neutrino sample: Make plots...'
+    else:
+      print 'BDM M = %d, E = %f sample: Make plots...' %( Mass, Mass * Gamma )
+    outdir = '%s/%s_kinematics' % ( args.oDir, key )
+    tasks += kinematicPlotTasks( key, hDict, Vars, outdir )
+  renderPlots( tasks, args.nJobs, args.force )
+
+  reportProfile()
+  reportPeakMemory( args.maxMemory )
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import hashlib
+import inspect
+import json
+import os
+import ROOT
+import numpy
+from columnCache import atomicWrite
+from scanEngine import mapSamples
+from profiling import stage
+
+# Batch rendering of the plots.  A plot is a task
+#
+#   ( plotName, function, args )
+#
+# where function( *args ) draws and saves plotName from snapshots of the
+# histograms (histograms.Hist1D/Hist2D, never modified by the drawing).  The
+# tasks are rendered in ROOT batch mode by a pool of processes, and a plot
+# is skipped when its file exists and the hash of its histograms, arguments
+# and drawing code is the one recorded in the RenderHashes file of its
+# directory at the last run.
+
+RenderHashes = '.renderHashes.json'
+
+def updateHash( h, value ):
+
+  # Feed value to the hash h: histograms by content, containers element by
+  # element (dicts sorted by key), anything else by its repr
+  if hasattr( value, 'sumw' ):
+    h.update( ( '%s|%s|%r|%d' % ( value.name, value.title, value.binning(), value.entries ) ).encode( 'utf-8' ) )
+    h.update( numpy.ascontiguousarray( value.sumw ).tobytes() )
+    h.update( numpy.ascontiguousarray( value.sumw2 ).tobytes() )
+  elif isinstance( value, dict ):
+    h.update( b'{' )
+    for key in sorted( value.keys(), key = repr ):
+      h.update( repr( key ).encode( 'utf-8' ) )
+      updateHash( h, value[key] )
+    h.update( b'}' )
+  elif isinstance( value, ( list, tuple ) ):
+    h.update( b'[' )
+    for element in value:
+      updateHash( h, element )
+    h.update( b']' )
+  else:
+    h.update( repr( value ).encode( 'utf-8' ) )
+# def updateHash()
+
+def plotHash( function, args ):
+
+  h = hashlib.sha1()
+  h.update( inspect.getsource( function ).encode( 'utf-8' ) )
+  updateHash( h, args )
+  return h.hexdigest()
+# def plotHash()
+
+def loadHashes( plotDir ):
+
+  fName = os.path.join( plotDir, RenderHashes )
+  if not os.path.exists( fName ):
+    return {}
+  return json.load( open( fName ) )
+# def loadHashes()
+
+def renderTask( function, args ):
+
+  ROOT.gROOT.SetBatch( True )
+  function( *args )
+# def renderTask()
+
+def renderPlots( tasks, nJobs = 1, force = False ):
+
+  # Render the changed plots, nJobs at a time, and return their names
+  hashes = {}
+  todo   = []
+  for plotName, function, args in tasks:
+    plotDir = os.path.dirname( plotName ) or '.'
+    if plotDir not in hashes:
+      hashes[plotDir] = loadHashes( plotDir )
+    digest = plotHash( function, args )
+    if not force and os.path.exists( plotName ) and hashes[plotDir].get( os.path.basename( plotName ) ) == digest:
+      continue
+    todo.append( ( plotName, plotDir, digest, function, args ) )
+
+  with stage( 'render', '' ):
+    mapSamples( renderTask, [ ( function, args ) for plotName, plotDir, digest, function, args in todo ], nJobs )
+
+  for plotName, plotDir, digest, function, args in todo:
+    hashes[plotDir][os.path.basename( plotName )] = digest
+  for plotDir in set( [ plotDir for plotName, plotDir, digest, function, args in todo ] ):
+    atomicWrite( os.path.join( plotDir, RenderHashes ), json.dumps( hashes[plotDir], indent = 2, sort_keys = True ) )
+
+  print( 'Rendered %d plots, %d unchanged' % ( len( todo ), len( tasks ) - len( todo ) ) )
+  return [ plotName for plotName, plotDir, digest, function, args in todo ]
+# def renderPlots()
@@ -3,16 +3,7 @@
 import argparse
 import os
 import ROOT
-
-def getTree( fNames, tName ):
-
-  t = ROOT.TChain( tName )
-  for fName in fNames:
-    t.AddFile( fName )
-
-  t.SetDirectory(0)
-  return t
-# getTree()
+from eventIndex import selectedEvents
 
 if __name__ == "__main__":
   
@@ -26,10 +17,9 @@ if __name__ == "__main__":
     os.remove( args.oFile )
   
   iFiles = [ args.iFile ]
-  tree = getTree( iFiles, 'MCParticles' )
   
   oFile = open( args.oFile, 'w' )
   
-  for i in tree:
-    if i.nVisible == 0:
-      oFile.write( '%d\n' % i.Event )
+  # From the event index, the tree is only read the first time
+  for event in selectedEvents( iFiles, 'noVisible', 'MCParticles' ):
+    oFile.write( '%d\n' % event )
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import contextlib
+import cProfile
+import csv
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+from columnCache import atomicWrite
+
+# Optional instrumentation of the scripts, switched on with their --profile
+# option.  The instrumented stages are
+#
+#   read      the columns read from the trees (RDataFrame event loop and
+#             branch decompression)
+#   cache     the columns read through the column cache, including the
+#             reads that fill it
+#   fill      the event loops of the analyses on the columns
+#   optimize  the cut optimization
+#   render    the drawing and saving of the plots
+#   write     the text and .npz outputs
+#
+# and every stage records, per sample, its wall and CPU time, events, bytes
+# read from the files and the peak resident memory of the process at its
+# end.  The totals of the worker processes come back with the results of
+# scanEngine.mapSamples and are added to those of the main process.  The
+# report is written as JSON or CSV, by the extension of its file, and
+# summarized per stage on the screen.  With cProfile on, the event loops
+# also run under cProfile and its statistics are saved next to the report
+# as <report>.prof.
+
+Profile = None
+
+Fields = [ 'stage', 'sample', 'calls', 'wall', 'cpu', 'events', 'eventsPerSecond', 'bytes', 'peakMB' ]
+
+def cpuTime():
+
+  # User and system time of this process, in s
+  times = os.times()
+  return times[0] + times[1]
+# def cpuTime()
+
+def residentPeak():
+
+  # Peak resident memory of this process in MB, ru_maxrss is in kB on Linux
+  # and in bytes on macOS
+  unit = 1e6 if sys.platform == 'darwin' else 1e3
+  return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss/unit
+# def residentPeak()
+
+def sampleLabel( fNames ):
+
+  # The input file of a sample without its extension, '+n' for the n other
+  # files of its chain
+  if not fNames:
+    return ''
+  label = os.path.splitext( os.path.basename( fNames[0] ) )[0]
+  if len( fNames ) > 1:
+    label += ' +%d' % ( len( fNames ) - 1 )
+  return label
+# def sampleLabel()
+
+def enableProfile( reportName, withCProfile = False ):
+
+  global Profile
+  Profile = Profiler( reportName, withCProfile )
+# def enableProfile()
+
+def isEnabled():
+
+  return Profile is not None
+# def isEnabled()
+
+def setSample( sample ):
+
+  # The sample the next stages are recorded for
+  if Profile is not None:
+    Profile.sample = sample
+# def setSample()
+
+@contextlib.contextmanager
+def stage( name, sample = None ):
+
+  # with stage( 'fill' ) as counts: ..., counts['events'] = n
+  # records the stage for sample, the current one by default
+  counts = { 'events': 0, 'bytes': 0 }
+  if Profile is None:
+    yield counts
+    return
+
+  wall, cpu = time.time(), cpuTime()
+  try:
+    yield counts
+  finally:
+    Profile.add( name, sample if sample is not None else Profile.sample,
+                 { 'calls': 1, 'wall': time.time() - wall, 'cpu': cpuTime() - cpu,
+                   'events': counts['events'], 'bytes': counts['bytes'], 'peakMB': residentPeak() } )
+# def stage()
+
+def eventLoop( function, *args ):
+
+  # function( *args ), under cProfile when it is on
+  if Profile is None or Profile.cProfile is None:
+    return function( *args )
+  Profile.cProfile.enable()
+  try:
+    return function( *args )
+  finally:
+    Profile.cProfile.disable()
+# def eventLoop()
+
+def workerSettings():
+
+  return { 'cProfile': Profile.cProfile is not None }
+# def workerSettings()
+
+def workerCall( function, args, settings ):
+
+  # function( *args ) in a worker process, returned with the totals of the
+  # stages it went through and its cProfile statistics
+  global Profile
+  Profile = Profiler( None, settings['cProfile'] )
+  result = function( *args )
+  return result, ( Profile.totals, Profile.statistics() )
+# def workerCall()
+
+def collectWorkers( results ):
+
+  # The results of workerCall, with the worker totals added to the profile
+  values = []
+  for result, ( totals, statistics ) in results:
+    Profile.merge( totals )
+    if statistics:
+      Profile.workerStatistics.append( ProfileData( statistics ) )
+    values.append( result )
+  return values
+# def collectWorkers()
+
+def writeReport( fName, rows ):
+
+  if fName.endswith( '.csv' ):
+    tmpName = '%s.%d.tmp' % ( fName, os.getpid() )
+    f = open( tmpName, 'w' )
+    writer = csv.writer( f )
+    writer.writerow( Fields )
+    for row in rows:
+      writer.writerow( [ row[field] for field in Fields ] )
+    f.close()
+    os.rename( tmpName, fName )
+  else:
+    atomicWrite( fName, json.dumps( rows, indent = 2, sort_keys = True ) )
+# def writeReport()
+
+def printSummary( rows, wall ):
+
+  # One line per stage, all the samples together
+  stages = []
+  for row in rows:
+    if row['stage'] not in [ s['stage'] for s in stages ]:
+      stages.append( dict( row, sample = '' ) )
+    else:
+      total = [ s for s in stages if s['stage'] == row['stage'] ][0]
+      for field in [ 'calls', 'wall', 'cpu', 'events', 'bytes' ]:
+        total[field] += row[field]
+      total['peakMB'] = max( total['peakMB'], row['peakMB'] )
+
+  print( 'Profile of %.1f s:' % wall )
+  print( '  %-10s %8s %10s %10s %12s %12s %10s %10s' % ( 'stage', 'calls', 'wall s', 'cpu s', 'events', 'events/s', 'MB read', 'peak MB' ) )
+  for s in stages:
+    rate = '%12.0f' % ( s['events']/s['wall'] ) if s['events'] and s['wall'] > 0. else '%12s' % '-'
+    print( '  %-10s %8d %10.2f %10.2f %12d %s %10.1f %10.0f' % ( s['stage'], s['calls'], s['wall'], s['cpu'], s['events'], rate, s['bytes']/1e6, s['peakMB'] ) )
+# def printSummary()
+
+def reportProfile():
+
+  # Write the report and the cProfile statistics, and print the summary
+  if Profile is None:
+    return
+  rows = Profile.rows()
+  if Profile.reportName:
+    writeReport( Profile.reportName, rows )
+    print( 'Wrote the profile to %s' % Profile.reportName )
+  printSummary( rows, time.time() - Profile.start )
+
+  stats = None
+  for data in [ Profile.cProfile ] + Profile.workerStatistics:
+    if data is None or not getattr( data, 'stats', True ):
+      continue
+    try:
+      if stats is None:
+        stats = pstats.Stats( data )
+      else:
+        stats.add( data )
+    except TypeError:
+      # A profile without any call
+      pass
+  if stats is not None:
+    if Profile.reportName:
+      stats.dump_stats( '%s.prof' % os.path.splitext( Profile.reportName )[0] )
+    stats.sort_stats( 'cumulative' ).print_stats( 20 )
+# def reportProfile()
+
+
+class ProfileData( object ):
+
+  # The cProfile statistics of a worker, in the form pstats reads them
+  def __init__( self, stats ):
+    self.stats = stats
+
+  def create_stats( self ):
+    pass
+
+# class ProfileData
+
+
+class Profiler( object ):
+
+  # The totals of the stages, keyed by ( stage, sample ), in the order
+  # they were first seen
+  def __init__( self, reportName = None, withCProfile = False ):
+    self.reportName       = reportName
+    self.start            = time.time()
+    self.sample           = None
+    self.keys             = []
+    self.totals           = {}
+    self.cProfile         = cProfile.Profile() if withCProfile else None
+    self.workerStatistics = []
+
+  def add( self, name, sample, values ):
+    key = ( name, sample or '' )
+    if key not in self.totals:
+      self.keys.append( key )
+      self.totals[key] = dict( values )
+      return
+    total = self.totals[key]
+    for field in [ 'calls', 'wall', 'cpu', 'events', 'bytes' ]:
+      total[field] += values[field]
+    total['peakMB'] = max( total['peakMB'], values['peakMB'] )
+
+  def merge( self, totals ):
+    for ( name, sample ), values in sorted( totals.items() ):
+      self.add( name, sample, values )
+
+  def statistics( self ):
+    # The cProfile statistics dict, that can be sent to another process
+    if self.cProfile is None:
+      return None
+    self.cProfile.create_stats()
+    return self.cProfile.stats
+
+  def rows( self ):
+    rows = []
+    for name, sample in self.keys:
+      row = dict( self.totals[( name, sample )], stage = name, sample = sample )
+      row['eventsPerSecond'] = row['events']/row['wall'] if row['events'] and row['wall'] > 0. else 0.
+      rows.append( row )
+    return rows
+
+# class Profiler
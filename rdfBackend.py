@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import ROOT
+import numpy
+from cutScan import notBelowFromBins, windowSplitFromBins
+from profiling import stage
+
+# Alternative backend of the selection and histogramming loops, for running
+# on ROOT's own implicit multi-threading instead of NumPy.  The fiducial
+# filter, the leading particle p and cos(angle) defines and every counter
+# and histogram of a sample are booked on one RDataFrame graph, and all of
+# them are produced by its single, lazy, event loop.
+#
+# Each event is binned in C++ with the same comparisons as the NumPy path
+# (the searchsorted bins of cutScan, histograms.binIndex), the bins are
+# counted with integer-binned histograms and turned into the cut counts by
+# the same cutScan functions.  The outputs are therefore those of the NumPy
+# path, up to the last-bit differences between the std::cos and numpy.cos
+# of events sitting exactly on a cut.  The fiducial cuts are C++
+# expressions, e.g. selectionExpr.Expression.toCpp() of a selection.
+
+Backends = [ 'numpy', 'rdf' ]
+
+BinningCode = '''
+namespace rdfBackend {
+
+// histograms.binIndex
+int binIndex( double x, int nBins, double low, double high ) {
+  if ( x >= low && x < high ) return std::min( 1 + int( nBins*( x - low )/( high - low ) ), nBins );
+  return x < low ? 0 : nBins + 1;
+}
+
+// numpy.searchsorted( cuts, x, side = 'right' ), NaN above all the cuts
+int cutsBelow( double x, const std::vector<double>& cuts ) {
+  return std::upper_bound( cuts.begin(), cuts.end(), x ) - cuts.begin();
+}
+
+// The bin of cutScan.countNotBelow, -1 for the events without particle
+int angleBin( double p, double costheta, const std::vector<double>& cuts ) {
+  return p == 0. ? -1 : cutsBelow( costheta, cuts );
+}
+
+// The ( iP, iLow, iHigh ) bin of cutScan.windowSplitCounts, flattened
+int windowBin( double p, double costheta, const std::vector<double>& pBins,
+               const std::vector<double>& lowCuts, const std::vector<double>& highCuts ) {
+  if ( p == 0. ) return -1;
+  int iLow  = cutsBelow( costheta, lowCuts );
+  int iHigh = std::isnan( costheta ) ? 0 : std::lower_bound( highCuts.begin(), highCuts.end(), costheta ) - highCuts.begin();
+  int iP    = cutsBelow( p, pBins );
+  return ( iP*int( lowCuts.size() + 1 ) + iLow )*int( highCuts.size() + 1 ) + iHigh;
+}
+
+// The ( intercept, slope ) cells passed in cutScan.linearCutCounts
+ROOT::RVec<int> linearCells( double p, double costheta, const std::vector<double>& intercepts, const std::vector<double>& slopes ) {
+  ROOT::RVec<int> cells;
+  if ( p == 0. ) return cells;
+  for ( size_t i = 0; i < intercepts.size(); ++i )
+    for ( size_t j = 0; j < slopes.size(); ++j )
+      if ( !( p*( 1. - intercepts[i] ) > slopes[j]*( costheta - intercepts[i] ) ) ) cells.push_back( i*slopes.size() + j );
+  return cells;
+}
+
+}
+'''
+
+# The cut grids declared to the interpreter, by their values
+Grids = {}
+
+def declareCode():
+
+  if not hasattr( ROOT, 'rdfBackend' ):
+    ROOT.gInterpreter.Declare( BinningCode )
+# def declareCode()
+
+def enableImplicitMT( nThreads = 0 ):
+
+  # ROOT's implicit multi-threading, on all the cores with nThreads = 0
+  if nThreads > 0:
+    ROOT.EnableImplicitMT( nThreads )
+  else:
+    ROOT.EnableImplicitMT()
+# def enableImplicitMT()
+
+def gridName( values ):
+
+  # The C++ name of a constant std::vector<double> holding values, declared
+  # once per grid with all its digits
+  values = tuple( float( value ) for value in values )
+  if values not in Grids:
+    declareCode()
+    Grids[values] = 'rdfBackend::grid%d' % len( Grids )
+    ROOT.gInterpreter.Declare( 'namespace rdfBackend { const std::vector<double> grid%d = { %s }; }'
+                               % ( len( Grids ) - 1, ', '.join( [ '%.17g' % value for value in values ] ) ) )
+  return Grids[values]
+# def gridName()
+
+def leadingFrame( df, Vars ):
+
+  # p_<var> and cos_<var> of the leading particle of every variable
+  for var in Vars:
+    df = df.Define( 'p_%s' % var, 'double( %sP[0] )' % var )
+    df = df.Define( 'cos_%s' % var, 'std::cos( double( %sAngle[0] ) )' % var )
+  return df
+# def leadingFrame()
+
+def bookBins( df, column, nBins ):
+
+  # The number of events (or of elements of an RVec column) in every
+  # integer bin 0..nBins-1 of column, booked lazily.  Negative bins go to
+  # the underflow and are dropped.
+  return df.Histo1D( ( column, column, nBins, -0.5, nBins - 0.5 ), column )
+# def bookBins()
+
+def binCounts( h, nBins ):
+
+  return numpy.array( [ h.GetBinContent( iBin ) for iBin in range( 1, nBins + 1 ) ] ).round().astype( numpy.int64 )
+# def binCounts()
+
+def countSelection( tree, Vars, binExpr, nBins, fiducialCut = 'isIn10kton != 0' ):
+
+  # ( n, nFiducial, [ bin counts of every variable ] ) of the fiducial
+  # events, binExpr( var ) giving the bin of the events of var, in one event
+  # loop
+  declareCode()
+  df = ROOT.RDataFrame( tree )
+  nEvents = df.Count()
+  fiducial = leadingFrame( df.Filter( fiducialCut ), Vars )
+  nFiducial = fiducial.Count()
+  hists = []
+  for var in Vars:
+    column = 'bin_%s' % var
+    hists.append( bookBins( fiducial.Define( column, binExpr( var ) ), column, nBins ) )
+
+  with stage( 'fill' ) as counts:
+    n = int( nEvents.GetValue() )
+    counts['events'] = n
+  return n, int( nFiducial.GetValue() ), [ binCounts( h, nBins ) for h in hists ]
+# def countSelection()
+
+def countAngle( tree, Vars, costhetaCuts, fiducialCut = 'isIn10kton != 0' ):
+
+  # The ( n, nFiducial, nPassed ) of optSelection1D.countPassed
+  cuts = gridName( costhetaCuts )
+  n, nFiducial, bins = countSelection( tree, Vars, lambda var: 'rdfBackend::angleBin( p_%s, cos_%s, %s )' % ( var, var, cuts ), len( costhetaCuts ) + 1, fiducialCut )
+
+  nPassed = {}
+  for var, varBins in zip( Vars, bins ):
+    nPassed[var] = dict( zip( costhetaCuts, [ int( count ) for count in notBelowFromBins( varBins ) ] ) )
+  return n, nFiducial, nPassed
+# def countAngle()
+
+def countLinear( tree, Vars, cutGrids, fiducialCut = 'isIn10kton != 0' ):
+
+  # The ( n, nFiducial, nPassed ) of optSelection1DLinear.countPassed
+  costhetaCuts, slopes = cutGrids
+  intercepts, slopeGrid = gridName( costhetaCuts ), gridName( slopes )
+  shape = ( len( costhetaCuts ), len( slopes ) )
+  n, nFiducial, bins = countSelection( tree, Vars, lambda var: 'rdfBackend::linearCells( p_%s, cos_%s, %s, %s )' % ( var, var, intercepts, slopeGrid ), shape[0]*shape[1], fiducialCut )
+
+  return n, nFiducial, numpy.array( [ varBins.reshape( shape ) for varBins in bins ] )
+# def countLinear()
+
+def countWindows( tree, Vars, cutGrids, fiducialCut = 'isIn10kton != 0' ):
+
+  # The ( n, nFiducial, nPassed ) of optSelection2D.countPassed
+  pBins, costhlCuts, costhhCuts = cutGrids
+  grids = ( gridName( pBins ), gridName( costhlCuts ), gridName( costhhCuts ) )
+  shape = ( len( pBins ) + 1, len( costhlCuts ) + 1, len( costhhCuts ) + 1 )
+  n, nFiducial, bins = countSelection( tree, Vars, lambda var: 'rdfBackend::windowBin( p_%s, cos_%s, %s, %s, %s )' % ( ( var, var ) + grids ),
+                                       shape[0]*shape[1]*shape[2], fiducialCut )
+
+  splits = [ windowSplitFromBins( varBins.reshape( shape ) ) for varBins in bins ]
+  smallP = numpy.array( [ small for small, large in splits ] )
+  largeP = numpy.array( [ large for small, large in splits ] )
+  return n, nFiducial, ( smallP, largeP )
+# def countWindows()
+
+def bookHistogram( df, h, column ):
+
+  # The bin counts of the histograms.Hist1D/Hist2D h, from the bin index
+  # column
+  nCells = h.sumw.size
+  return df.Histo1D( ( column, column, nCells, -0.5, nCells - 0.5 ), column )
+# def bookHistogram()
+
+def addCounts( h, counts ):
+
+  # Fill h with unit weights from the counts of its bins
+  counts = counts.reshape( h.sumw.shape )
+  h.sumw    += counts
+  h.sumw2   += counts
+  h.entries += int( counts.sum() )
+# def addCounts()
+
+def fillAngular( tree, hMomentumList, hAngularList, fiducialCut = 'isIn10kton == 1' ):
+
+  # The ( hMomentumList, hAngularList, n, nPassedEvents ) of
+  # plotAngularDist.fillFromColumns, the histograms filled in place
+  declareCode()
+  df = ROOT.RDataFrame( tree )
+  nEvents = df.Count()
+  nFiducial = df.Filter( fiducialCut ).Count()
+
+  booked = []
+  for hList, Vars, valueExpr in [ ( hMomentumList, [ 'InParticleP', 'OutParticleP' ], 'double( %s[0] )' ),
+                                  ( hAngularList, list( hAngularList.keys() ), 'std::cos( double( %s[0] ) )' ) ]:
+    for var in Vars:
+      h = hList[var]
+      column = 'bin_%s' % var
+      frame = df.Define( column, 'rdfBackend::binIndex( %s, %d, %.17g, %.17g )' % ( valueExpr % var, h.nBins, h.xMin, h.xMax ) )
+      booked.append( ( h, bookHistogram( frame, h, column ) ) )
+
+  with stage( 'fill' ) as counts:
+    n = int( nEvents.GetValue() )
+    counts['events'] = n
+  for h, hist in booked:
+    addCounts( h, binCounts( hist, h.sumw.size ) )
+
+  nPassedEvents = {}
+  for var in hAngularList.keys():
+    if var in [ 'InParticleAngle', 'OutParticleAngle' ]: continue
+    nPassedEvents[var] = int( nFiducial.GetValue() )
+
+  return hMomentumList, hAngularList, n, nPassedEvents
+# def fillAngular()
+
+def fillKinematics( tree, h, Vars, branches, fiducialCut = None ):
+
+  # plotKinematics.fillFromColumns over the whole tree, or the events of
+  # fiducialCut, branches[var] being the leading particle variable of the
+  # correlation var
+  declareCode()
+  df = ROOT.RDataFrame( tree )
+  nEvents = df.Count()
+  if fiducialCut is not None:
+    df = df.Filter( fiducialCut )
+
+  booked = []
+  for var in Vars:
+    branch = branches[var]
+    column = 'bin_%s' % var
+    x = 'rdfBackend::binIndex( std::cos( double( %sAngle[0] ) ), %d, %.17g, %.17g )' % ( branch, h[var].nXBins, h[var].xMin, h[var].xMax )
+    y = 'rdfBackend::binIndex( double( %sP[0] ), %d, %.17g, %.17g )' % ( branch, h[var].nYBins, h[var].yMin, h[var].yMax )
+    frame = df.Define( column, '%s*%d + %s' % ( x, h[var].nYBins + 2, y ) )
+    booked.append( ( h[var], bookHistogram( frame, h[var], column ) ) )
+
+  with stage( 'fill' ) as counts:
+    counts['events'] = int( nEvents.GetValue() )
+  for hist, result in booked:
+    addCounts( hist, binCounts( result, hist.sumw.size ) )
+
+  return h
+# def fillKinematics()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+import argparse
+import dumpROOTEvents
+import mcReader
+import optSelection1D
+import optSelection1DLinear
+import optSelection2D
+import plotAngularDist
+import plotKinematics
+from cutOptimizer import parseScales, writeScanTable, writeResults
+from plotRendering import renderPlots
+from profiling import enableProfile, reportProfile
+from scanEngine import ScanEngine, Consumer, withPassRates, reportPeakMemory, energyLabel, sampleKey, atmosFiles, signalFiles, signalPoints
+
+# Run every analysis from a single pass over the samples: each ROOT file is
+# read once and the columns are handed to all the analyses that use it.  The
+# settings below are the ones of the individual scripts.
+
+Masses = [ 5, 10, 20, 40 ]
+
+OneDVars = [ 'Visible', 'VisibleNoN', 'LeadingParticle', 'LeadingParticleNoN',
+             'SmearedReconstructable', 'SmearedReconstructableNoN',
+             'LeadingSmearedReconstructable', 'LeadingSmearedReconstructableNoN',
+             'SmearedVisible', 'SmearedVisibleNon', 'LeadingSmeared', 'LeadingSmearedNoN' ]
+OneDGammas = [ 1.1, 1.25, 1.5, 10 ]
+OneDCuts   = ( 0.2, 0.95, 16 )
+
+LinearVars   = OneDVars
+LinearGammas = [ 1.1, 1.25, 2, 10 ]
+LinearCuts   = ( 0.1, 0.95, 18 )
+LinearSlopes = ( 0.5, 128., 25 )
+
+TwoDVars   = [ 'Visible', 'VisibleNoN', 'SmearedReconstructable', 'SmearedReconstructableNoN',
+               'SmearedVisible', 'SmearedVisibleNon' ]
+TwoDGammas = [ 1.1, 1.25 ]
+TwoDCuts   = ( 0.1, 1., 19, 0.2, 1., 17, 0.5, 1., 11 )
+
+AngularMomentumVars = [ 'InParticleP', 'OutParticleP' ]
+AngularVars = [ 'InParticleAngle', 'OutParticleAngle',
+                'VisibleAngle', 'VisibleNoNAngle', 'LeadingParticleAngle', 'LeadingParticleNoNAngle',
+                'SmearedVisibleAngle', 'SmearedVisibleNonAngle', 'SmearedReconstructableAngle', 'SmearedReconstructableNoNAngle',
+                'LeadingSmearedAngle', 'LeadingSmearedNoNAngle', 'LeadingSmearedReconstructableAngle', 'LeadingSmearedReconstructableNoNAngle' ]
+AngularGammas = [ 1.1, 1.25, 1.5, 10 ]
+
+KinematicVars   = [ 'TrueKin', 'RecoKin', 'TrueNoNKin', 'RecoNoNKin' ]
+KinematicGammas = [ 1.1, 1.25, 2, 10 ]
+
+DumpVars   = [ 'SmearedReconstructableAngle', 'SmearedReconstructableNoNAngle' ]
+DumpGammas = [ 1.1, 1.25, 1.5, 10 ]
+
+Analyses = [ '1D', 'linear', '2D', 'angular', 'kinematics', 'dump' ]
+
+
+def fillAngular( columns, Mass, Gamma ):
+
+  return plotAngularDist.fillChunk( columns, AngularMomentumVars, AngularVars, Mass, Gamma, 0.6 )
+# def fillAngular()
+
+def fillKinematics( columns, Mass, Gamma ):
+
+  return plotKinematics.fillChunk( columns, KinematicVars, Mass, Gamma )
+# def fillKinematics()
+
+def registerAnalyses( engine, analyses, sDir, bDir, nShards = 1, dumpFormat = 'dat' ):
+
+  def addSignals( Gammas, stage = 'reco', suffix = '' ):
+    keys = {}
+    for Mass, Gamma in signalPoints( Masses, Gammas ):
+      key = sampleKey( Mass, Gamma ) + suffix
+      engine.addSample( key, signalFiles( sDir, Mass, Gamma, stage ) )
+      keys[key] = ( Mass, Gamma )
+    return keys
+
+  # Only the large background samples are split in entry ranges
+  engine.addSample( 'atmos', atmosFiles( bDir ), nShards )
+
+  if '1D' in analyses:
+    samples = dict( ( key, ( OneDVars, ) + OneDCuts ) for key in [ 'atmos' ] + list( addSignals( OneDGammas ).keys() ) )
+    engine.register( Consumer( '1D', optSelection1D.selectionColumns( OneDVars ), optSelection1D.countPassed, samples, finalize = withPassRates ) )
+
+  if 'linear' in analyses:
+    cutGrids = optSelection1DLinear.makeCutGrids( *( LinearCuts + LinearSlopes ) )
+    samples = dict( ( key, ( LinearVars, cutGrids ) ) for key in [ 'atmos' ] + list( addSignals( LinearGammas ).keys() ) )
+    engine.register( Consumer( 'linear', optSelection1DLinear.selectionColumns( LinearVars ), optSelection1DLinear.countPassed, samples, finalize = withPassRates ) )
+
+  if '2D' in analyses:
+    cutGrids = optSelection2D.makeCutGrids( *TwoDCuts )
+    samples = dict( ( key, ( TwoDVars, cutGrids ) ) for key in [ 'atmos' ] + list( addSignals( TwoDGammas ).keys() ) )
+    engine.register( Consumer( '2D', optSelection2D.selectionColumns( TwoDVars ), optSelection2D.countPassed, samples, finalize = withPassRates ) )
+
+  if 'angular' in analyses:
+    samples = { 'atmos': ( 0., 0. ) }
+    samples.update( addSignals( AngularGammas ) )
+    engine.register( Consumer( 'angular', plotAngularDist.selectionColumns( AngularVars ), fillAngular, samples, finalize = plotAngularDist.passRates ) )
+
+  if 'kinematics' in analyses:
+    engine.addSample( 'atmos_RecoSmear', atmosFiles( bDir, 'RecoSmear' ), nShards )
+    samples = { 'atmos_RecoSmear': ( 0, 0 ) }
+    samples.update( addSignals( KinematicGammas, 'RecoSmear', '_RecoSmear' ) )
+    engine.register( Consumer( 'kinematics', plotKinematics.selectionColumns( KinematicVars ), fillKinematics, samples ) )
+
+  if 'dump' in analyses:
+    samples = { 'atmos': ( '%s/prodgenie_atmnu_maxmin_dune10kt_gen_g4_NCFilter_reco_ana.%s' % ( bDir, dumpFormat ), DumpVars, dumpFormat ) }
+    for Mass, Gamma in signalPoints( Masses, DumpGammas ):
+      key = sampleKey( Mass, Gamma )
+      engine.addSample( key, signalFiles( sDir, Mass, Gamma ) )
+      samples[key] = ( '%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_reco_ana.%s' % ( sDir, str( energyLabel( Mass, Gamma ) ), str( Mass ), dumpFormat ), DumpVars, dumpFormat )
+    engine.register( Consumer( 'dump', dumpROOTEvents.selectionColumns( DumpVars ), dumpROOTEvents.fillParts, samples,
+                               merge = dumpROOTEvents.mergeParts, finalize = dumpROOTEvents.writeParts ) )
+
+# def registerAnalyses()
+
+def passCounts( results ):
+
+  # { sample: ( n, nFiducial, nPassed, rPassed ) } -> nPassed, rPassed
+  nPassed  = {}
+  passRate = {}
+  for key, result in results.items():
+    nPassed[key]  = result[2]
+    passRate[key] = result[3]
+
+  return nPassed, passRate
+# def passCounts()
+
+def writeScales( oDir, name, writeSample, bgScales, points, Vars, best ):
+
+  # One <name>_bgScale<scale>.txt file per background scale, as the
+  # individual scripts write them, and all the scales in one table and in
+  # the results file read by scalar_dm_plots
+  energies = [ ( Mass, energyLabel( Mass, Gamma ) ) for Mass, Gamma in points ]
+  for bgScale, scaleSelections in zip( bgScales, best ):
+    txtFile = open( '%s/%s_bgScale%f.txt' % ( oDir, name, bgScale ), 'w' )
+    for ( Mass, Eround ), selection in zip( energies, scaleSelections ):
+      writeSample( txtFile, Mass, Eround, Vars, *selection )
+    txtFile.close()
+
+  txtFile = open( '%s/%s_bgScaleTable.txt' % ( oDir, name ), 'w' )
+  writeScanTable( txtFile, bgScales, energies, Vars, best )
+  txtFile.close()
+  writeResults( '%s/%s_results.npz' % ( oDir, name ), bgScales, energies, Vars, best )
+# def writeScales()
+
+def write1D( results, oDir, bgScales ):
+
+  nPassed, passRate = passCounts( results['1D'] )
+  points = signalPoints( Masses, OneDGammas )
+  best = optSelection1D.optimizeSamples( [ sampleKey( Mass, Gamma ) for Mass, Gamma in points ], OneDVars, bgScales, nPassed, passRate, 'FOM' )
+  writeScales( oDir, '1DFOM_Efficiency_scalar', optSelection1D.writeSample, bgScales, points, OneDVars, best )
+# def write1D()
+
+def writeLinear( results, oDir, bgScales ):
+
+  nPassed, passRate = passCounts( results['linear'] )
+  cutGrids = optSelection1DLinear.makeCutGrids( *( LinearCuts + LinearSlopes ) )
+  points = signalPoints( Masses, LinearGammas )
+  best = optSelection1DLinear.optimizeSamples( [ sampleKey( Mass, Gamma ) for Mass, Gamma in points ], LinearVars, bgScales, nPassed, passRate, cutGrids )
+  writeScales( oDir, '1DLinear_Efficiency_scalar', optSelection1DLinear.writeSample, bgScales, points, LinearVars, best )
+# def writeLinear()
+
+def write2D( results, oDir, bgScales ):
+
+  # The cells are combined from the counts, over nFiducial
+  nPassed, passRate = passCounts( results['2D'] )
+  nFiducial = dict( ( key, result[1] ) for key, result in results['2D'].items() )
+  cutGrids = optSelection2D.makeCutGrids( *TwoDCuts )
+  points = signalPoints( Masses, TwoDGammas )
+  best = optSelection2D.optimizeSamples( [ sampleKey( Mass, Gamma ) for Mass, Gamma in points ], TwoDVars, bgScales, nPassed, nFiducial, cutGrids )
+  writeScales( oDir, '2D_Efficiency_p0.1-1_scalar', optSelection2D.writeSample, bgScales, points, TwoDVars, best )
+# def write2D()
+
+def angularTasks( results, oDir ):
+
+  hADict = {}
+  for key, result in results['angular'].items():
+    hADict[key] = result[1]
+
+  return plotAngularDist.angularPlotTasks( hADict, Masses, AngularGammas, AngularVars, oDir )
+# def angularTasks()
+
+def kinematicTasks( results, oDir ):
+
+  hDict = {}
+  for key, h in results['kinematics'].items():
+    hDict[key.replace( '_RecoSmear', '' )] = h
+
+  tasks = []
+  for sample in sorted( hDict.keys() ):
+    tasks += plotKinematics.kinematicPlotTasks( sample, hDict, KinematicVars, '%s/%s_kinematics' % ( oDir, sample ) )
+  return tasks
+# def kinematicTasks()
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Run all the analyses in a single pass over the samples.')
+  parser.add_argument( '-s', dest = 'sDir', type = str, help = 'The directory of the input SIGNAL files.' )
+  parser.add_argument( '-b', dest = 'bDir', type = str, help = 'The directory of the input BACKGROUND files.' )
+  parser.add_argument( '-o', dest = 'oDir', type = str, help = 'The directory of the output plots and text files.' )
+  parser.add_argument( '-m', dest = 'bgScales', type = str, nargs = '+', default = [ '1.' ],
+                      help = 'The scale factors on the background events to account for additional background source, numbers or first:last:n ranges.  Default 1.' )
+  parser.add_argument( '-a', dest = 'analyses', type = str, nargs = '+', default = Analyses, choices = Analyses,
+                      help = 'The analyses to run.  Default all of them.' )
+  parser.add_argument( '-f', dest = 'dumpFormat', type = str, default = 'dat', choices = dumpROOTEvents.Formats,
+                      help = 'The format of the event dumps, dat or npy.  Default dat.' )
+  parser.add_argument( '-j', dest = 'nJobs', type = int, default = 1,
+                      help = 'The number of samples processed in parallel.  Default 1.' )
+  parser.add_argument( '-n', dest = 'nShards', type = int, default = 1,
+                      help = 'The number of entry ranges the background samples are split into.  Default 1.' )
+  parser.add_argument( '--max-memory', dest = 'maxMemory', type = float, default = None,
+                      help = 'The memory budget of each process in MB, which sets how many entries are read at a time.  Default chunks of %d entries.' % mcReader.DefaultChunkSize )
+  parser.add_argument( '--force', dest = 'force', action = 'store_true',
+                      help = 'Redraw all the plots, also the ones whose histograms and style have not changed.' )
+  parser.add_argument( '-c', dest = 'cacheDir', type = str, default = None,
+                      help = 'Cache the columns read from the ROOT files in this directory.' )
+  parser.add_argument( '--cache-size', dest = 'cacheSize', type = float, default = mcReader.DefaultMaxSize,
+                      help = 'The size cap of the column cache in GB.  Default %(default)s.' )
+  parser.add_argument( '--profile', dest = 'profile', type = str, default = None,
+                      help = 'Write the wall and CPU time, events/s, bytes read and peak memory of every stage and sample to this .json or .csv report, and print a summary.' )
+  parser.add_argument( '--cprofile', dest = 'cProfile', action = 'store_true',
+                      help = 'With --profile, also run cProfile on the event loops and save its statistics next to the report.' )
+
+  args = parser.parse_args()
+  if args.profile:
+    enableProfile( args.profile, args.cProfile )
+
+  optSelection1D.createDir( args.oDir )
+  if args.cacheDir:
+    mcReader.enableCache( args.cacheDir, args.cacheSize )
+  mcReader.setMaxMemory( args.maxMemory )
+  bgScales = parseScales( args.bgScales )
+
+  engine = ScanEngine( 'MCParticles' )
+  registerAnalyses( engine, args.analyses, args.sDir, args.bDir, args.nShards, args.dumpFormat )
+  results = engine.run( args.nJobs )
+
+  if '1D' in args.analyses:
+    write1D( results, args.oDir, bgScales )
+  if 'linear' in args.analyses:
+    writeLinear( results, args.oDir, bgScales )
+  if '2D' in args.analyses:
+    write2D( results, args.oDir, bgScales )
+  # All the plots are rendered together, the unchanged ones skipped
+  tasks = []
+  if 'angular' in args.analyses:
+    tasks += angularTasks( results, args.oDir )
+  if 'kinematics' in args.analyses:
+    tasks += kinematicTasks( results, args.oDir )
+  renderPlots( tasks, args.nJobs, args.force )
+
+  reportProfile()
+  reportPeakMemory( args.maxMemory )
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import resource
+import sys
+from mcReader import getTree, iterChunks, shardRanges, chainFiles
+from profiling import stage, eventLoop, isEnabled, setSample, sampleLabel, workerCall, workerSettings, collectWorkers
+
+def energyLabel( Mass, Gamma ):
+
+  # The energy as it appears in the signal file names and sample keys
+  E = Mass * Gamma
+  if E in [ 11., 15., 22., 25., 30., 44., 50., 60. ]: return int(E)
+  return E
+# def energyLabel()
+
+def sampleKey( Mass, Gamma ):
+
+  return 'e%s_m%s' % ( energyLabel( Mass, Gamma ), Mass )
+# def sampleKey()
+
+def atmosFiles( bDir, stage = 'reco' ):
+
+  return [ '%s/prodgenie_atmnu_%s_dune10kt_gen_g4_NCFilter_%s_ana.root' % ( bDir, flux, stage ) for flux in [ 'max', 'min' ] ]
+# def atmosFiles()
+
+def signalFiles( sDir, Mass, Gamma, stage = 'reco' ):
+
+  return [ '%s/dune_scalar_e%s_m%s_g1_z1.0_Gen_g4_%s_ana.root' % ( sDir, str( energyLabel( Mass, Gamma ) ), str( Mass ), stage ) ]
+# def signalFiles()
+
+def signalPoints( Masses, Gammas ):
+
+  # The (Mass, Gamma) benchmarks, gamma = 2 only exists for M = 10 GeV
+  points = []
+  for Mass in Masses:
+    for Gamma in Gammas:
+      if Mass in [ 5, 20, 40 ] and ( Gamma == 2 ):
+        continue
+      points.append( ( Mass, Gamma ) )
+
+  return points
+# def signalPoints()
+
+def mergeResults( a, b ):
+
+  # Associative reduce of two partial results of the same shape: numbers and
+  # arrays are added, dicts, lists and tuples merged element by element and
+  # ROOT histograms added into the first one.  A None side, the result of
+  # an empty range or chain, leaves the other one.
+  if a is None:
+    return b
+  if b is None:
+    return a
+  if isinstance( a, dict ):
+    merged = dict( a )
+    for key, value in b.items():
+      merged[key] = mergeResults( merged[key], value ) if key in merged else value
+    return merged
+  if isinstance( a, ( list, tuple ) ):
+    return type( a )( [ mergeResults( x, y ) for x, y in zip( a, b ) ] )
+  if hasattr( a, 'Add' ):
+    a.Add( b )
+    return a
+  return a + b
+# def mergeResults()
+
+def passRates( nPassed, nFiducial ):
+
+  # nPassed/nFiducial for nested dicts or tuples of counts or count arrays
+  if isinstance( nPassed, dict ):
+    return dict( ( key, passRates( value, nFiducial ) ) for key, value in nPassed.items() )
+  if isinstance( nPassed, ( list, tuple ) ):
+    return type( nPassed )( [ passRates( value, nFiducial ) for value in nPassed ] )
+  if isinstance( nPassed, ( int, float ) ):
+    return float(nPassed)/float(nFiducial)
+  return nPassed/float(nFiducial)
+# def passRates()
+
+def withPassRates( counts ):
+
+  # ( n, nFiducial, nPassed ) -> ( n, nFiducial, nPassed, rPassed ), only
+  # to be done once the partial counts of all the shards are merged
+  n, nFiducial, nPassed = counts
+  return n, nFiducial, nPassed, passRates( nPassed, nFiducial )
+# def withPassRates()
+
+def scanChunks( tree, exprs, fill, args = (), entries = None, merge = mergeResults ):
+
+  # fill( columns, *args ) on consecutive chunks of the chain (or of its
+  # entry range), merging the partial results in entry order.  fill must
+  # return a new result for every chunk.
+  if isEnabled():
+    setSample( sampleLabel( chainFiles( tree ) ) )
+  result = None
+  for iChunk, columns in enumerate( iterChunks( tree, exprs, entries ) ):
+    with stage( 'fill' ) as counts:
+      partial = eventLoop( fill, columns, *args )
+      counts['events'] = len( columns[exprs[0]] ) if exprs else 0
+    result = merge( result, partial ) if iChunk > 0 else partial
+  return result
+# def scanChunks()
+
+def peakMemory():
+
+  # ( this process, largest finished child process ) peak resident memory
+  # in MB.  ru_maxrss is in kB on Linux and in bytes on macOS.
+  unit = 1e6 if sys.platform == 'darwin' else 1e3
+  return ( resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss/unit,
+           resource.getrusage( resource.RUSAGE_CHILDREN ).ru_maxrss/unit )
+# def peakMemory()
+
+def reportPeakMemory( maxMemory = None ):
+
+  main, worker = peakMemory()
+  line = 'Peak memory: %.0f MB' % main
+  if worker > 0:
+    line += ', largest worker %.0f MB' % worker
+  if maxMemory is not None:
+    line += ' (budget %.0f MB per process)' % maxMemory
+  print( line )
+# def reportPeakMemory()
+
+def callSample( job ):
+
+  function, args = job
+  return function( *args )
+# def callSample()
+
+def mapSamples( function, argsList, nJobs = 1, executor = None ):
+
+  # [ function( *args ) for args in argsList ], with nJobs > 1 in a pool of
+  # processes, or with any executor providing map() (e.g. a pool running on
+  # other hosts).  The results always come back in the order of argsList.
+  # function has to be defined at module level so that it can be pickled.
+  # With profiling on, the workers send the totals of their stages back
+  # with their results.
+  jobs = [ ( function, tuple( args ) ) for args in argsList ]
+  if executor is None and ( nJobs <= 1 or len( argsList ) <= 1 ):
+    return [ callSample( job ) for job in jobs ]
+
+  profiled = isEnabled()
+  if profiled:
+    jobs = [ ( workerCall, ( function, args, workerSettings() ) ) for function, args in jobs ]
+
+  if executor is not None:
+    results = list( executor.map( callSample, jobs ) )
+  else:
+    pool = multiprocessing.Pool( min( nJobs, len( argsList ) ) )
+    try:
+      results = pool.map( callSample, jobs, 1 )
+    finally:
+      pool.close()
+      pool.join()
+
+  return collectWorkers( results ) if profiled else results
+# def mapSamples()
+
+def mapSharded( function, argsList, nJobs = 1, nShards = 1, tName = 'MCParticles', merge = mergeResults, executor = None ):
+
+  # Like mapSamples, but the chain of every job, argsList[i][0], is split in
+  # nShards entry ranges processed separately by
+  #   function( *( argsList[i] + ( ( start, stop ), ) ) )
+  # and the partial results are merged back in entry order.
+  shardJobs = []
+  owners    = []
+  for iJob, args in enumerate( argsList ):
+    ranges = [ None ]
+    if nShards > 1:
+      ranges = shardRanges( getTree( args[0], tName ).GetEntries(), nShards ) or [ None ]
+    for entries in ranges:
+      shardJobs.append( tuple( args ) + ( entries, ) )
+      owners.append( iJob )
+
+  results = {}
+  for iJob, partial in zip( owners, mapSamples( function, shardJobs, nJobs, executor ) ):
+    results[iJob] = merge( results[iJob], partial ) if iJob in results else partial
+
+  return [ results[iJob] for iJob in range( len( argsList ) ) ]
+# def mapSharded()
+
+
+class Consumer( object ):
+
+  # An analysis fed by the scan engine.  For every sample key it wants,
+  # samples[key] holds the extra arguments of
+  #   fill( columns, *samples[key] )
+  # whose return value is the partial result of a chunk of that sample.  The
+  # partial results of the chunks and entry shards of a sample are combined
+  # with merge, in entry order, and finalize, if given, is applied to the
+  # merged result.  The samples are always read chunk by chunk, results
+  # that cannot be added, such as files, are merged as ordered lists of
+  # parts.  fill has to be a module-level function so that consumers can be
+  # shipped to workers.
+  def __init__( self, name, columns, fill, samples, merge = mergeResults, finalize = None ):
+    self.name     = name
+    self.columns  = list( columns )
+    self.fill     = fill
+    self.samples  = samples
+    self.merge    = merge
+    self.finalize = finalize
+
+  def wants( self, key ):
+    return key in self.samples
+
+  def process( self, key, columns ):
+    return self.fill( columns, *self.samples[key] )
+
+# class Consumer
+
+
+class ScanEngine( object ):
+
+  # Reads every registered sample once, with the union of the columns its
+  # consumers need, and hands the same columns to all of them.  A sample can
+  # be split into nShards entry ranges scanned by different workers.
+  def __init__( self, tName = 'MCParticles' ):
+    self.tName     = tName
+    self.samples   = []
+    self.shards    = {}
+    self.consumers = []
+
+  def addSample( self, key, fNames, nShards = 1 ):
+    if key not in [ k for k, f in self.samples ]:
+      self.samples.append( ( key, list( fNames ) ) )
+    self.shards[key] = max( nShards, self.shards.get( key, 1 ) )
+
+  def register( self, consumer ):
+    self.consumers.append( consumer )
+
+  def sampleConsumers( self, key ):
+    return [ consumer for consumer in self.consumers if consumer.wants( key ) ]
+
+  def sampleColumns( self, key ):
+    exprs = []
+    for consumer in self.sampleConsumers( key ):
+      for expr in consumer.columns:
+        if expr not in exprs:
+          exprs.append( expr )
+    return exprs
+
+  def sampleRanges( self, key, fNames ):
+    consumers = self.sampleConsumers( key )
+    if self.shards[key] <= 1 or not consumers:
+      return [ None ]
+    # Every consumer merges, the partial results come back in range order
+    return shardRanges( getTree( fNames, self.tName ).GetEntries(), self.shards[key] ) or [ None ]
+
+  def scanSample( self, key, fNames, entries = None ):
+    consumers = self.sampleConsumers( key )
+    results = {}
+    if not consumers:
+      return results
+
+    if entries is None:
+      print( 'Reading %s for %s...' % ( key, ', '.join( [ consumer.name for consumer in consumers ] ) ) )
+    else:
+      print( 'Reading %s entries %d-%d for %s...' % ( key, entries[0], entries[1], ', '.join( [ consumer.name for consumer in consumers ] ) ) )
+    setSample( key )
+    tree  = getTree( fNames, self.tName )
+    exprs = self.sampleColumns( key )
+    for columns in iterChunks( tree, exprs, entries ):
+      for consumer in consumers:
+        with stage( 'fill:%s' % consumer.name ) as counts:
+          partial = eventLoop( consumer.process, key, columns )
+          counts['events'] = len( columns[exprs[0]] ) if exprs else 0
+        if consumer.name in results:
+          partial = consumer.merge( results[consumer.name], partial )
+        results[consumer.name] = partial
+    return results
+
+  def run( self, nJobs = 1, executor = None ):
+    # results[consumer name][sample key], the samples and their shards are
+    # scanned in nJobs processes or by the executor
+    jobs = []
+    for key, fNames in self.samples:
+      for entries in self.sampleRanges( key, fNames ):
+        jobs.append( ( self, key, fNames, entries ) )
+
+    partials = {}
+    for ( engine, key, fNames, entries ), sampleResults in zip( jobs, mapSamples( scanEngineSample, jobs, nJobs, executor ) ):
+      for name, result in sampleResults.items():
+        partials.setdefault( name, {} ).setdefault( key, [] ).append( result )
+
+    results = {}
+    for consumer in self.consumers:
+      results[consumer.name] = {}
+      for key, parts in partials.get( consumer.name, {} ).items():
+        result = parts[0]
+        for part in parts[1:]:
+          result = consumer.merge( result, part )
+        if consumer.finalize is not None:
+          result = consumer.finalize( result )
+        results[consumer.name][key] = result
+
+    return results
+
+# class ScanEngine
+
+def scanEngineSample( engine, key, fNames, entries = None ):
+
+  return engine.scanSample( key, fNames, entries )
+# def scanEngineSample()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import re
+import numpy
+try:
+  import numexpr
+except ImportError:
+  numexpr = None
+
+# Event selections and variables written as small C-like expressions, e.g.
+#
+#   isIn10kton && VisibleNoNP > 0 && cos( VisibleNoNAngle ) > 0.6
+#
+# with the operators || && ! == != < <= > >= + - * / and parentheses, the
+# functions of Functions and numbers.  Names are branches of the tree: a
+# vector branch stands for its leading element, VisibleNoNP for
+# VisibleNoNP[0], and name[i] reads its element i.  An expression is parsed
+# once with parseExpression(), bound to the branches of a tree with bind(),
+# which rejects the unknown ones, and evaluated on whole columns, as read by
+# mcReader.readColumns for its columns, with NumPy (numexpr when it is
+# installed).  toCpp() gives the same expression for RDataFrame filters.
+#
+# The scripts read their variables and selection from a JSON config
+#
+#   { "vars": [ "Visible", "VisibleNoN" ], "selection": "isIn10kton != 0" }
+
+Fiducial = 'isIn10kton != 0'
+
+ConfigKeys = [ 'vars', 'selection' ]
+
+# name: ( NumPy function, C++ function, numexpr function )
+Functions = { 'abs':  ( numpy.abs, 'std::abs', 'abs' ),
+              'sqrt': ( numpy.sqrt, 'std::sqrt', 'sqrt' ),
+              'exp':  ( numpy.exp, 'std::exp', 'exp' ),
+              'log':  ( numpy.log, 'std::log', 'log' ),
+              'cos':  ( numpy.cos, 'std::cos', 'cos' ),
+              'sin':  ( numpy.sin, 'std::sin', 'sin' ),
+              'tan':  ( numpy.tan, 'std::tan', 'tan' ),
+              'acos': ( numpy.arccos, 'std::acos', 'arccos' ),
+              'asin': ( numpy.arcsin, 'std::asin', 'arcsin' ),
+              'atan': ( numpy.arctan, 'std::atan', 'arctan' ) }
+
+# The binary operators by increasing precedence, and their NumPy functions
+Precedence = [ [ '||' ], [ '&&' ], [ '==', '!=', '<', '<=', '>', '>=' ], [ '+', '-' ], [ '*', '/' ] ]
+Operators = { '||': numpy.logical_or, '&&': numpy.logical_and,
+              '==': numpy.equal, '!=': numpy.not_equal, '<': numpy.less, '<=': numpy.less_equal, '>': numpy.greater, '>=': numpy.greater_equal,
+              '+': numpy.add, '-': numpy.subtract, '*': numpy.multiply, '/': numpy.true_divide }
+Logical     = [ '||', '&&', '!' ]
+Comparisons = Precedence[2]
+
+Token = re.compile( r'\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|(?P<name>[A-Za-z_]\w*)|(?P<op>&&|\|\||==|!=|<=|>=|[-+*/<>!()\[\]]))' )
+
+def tokenize( text ):
+
+  # [ ( kind, value, position ) ] ending with ( 'end', '', len( text ) )
+  tokens = []
+  position = 0
+  text = text.rstrip()
+  while position < len( text ):
+    match = Token.match( text, position )
+    if match is None:
+      position = len( text ) - len( text[position:].lstrip() )
+      raise ValueError( "Unexpected character '%s' at %d in the expression '%s'" % ( text[position], position, text ) )
+    kind = match.lastgroup
+    tokens.append( ( kind, match.group( kind ), match.start( kind ) ) )
+    position = match.end()
+  tokens.append( ( 'end', '', len( text ) ) )
+  return tokens
+# def tokenize()
+
+def parseExpression( text ):
+
+  return Expression( text, Parser( text ).parse() )
+# def parseExpression()
+
+def treeSchema( tree ):
+
+  # { branch: whether it is a vector } of the tree, None when the chain has
+  # no tree to look at
+  if tree.LoadTree( 0 ) < 0 or not tree.GetListOfBranches():
+    return None
+  schema = {}
+  for branch in tree.GetListOfBranches():
+    isVector = branch.GetClassName().startswith( 'vector' ) or any( [ leaf.GetLeafCount() for leaf in branch.GetListOfLeaves() ] )
+    schema[branch.GetName()] = bool( isVector )
+  return schema
+# def treeSchema()
+
+def checkBranches( schema, exprs ):
+
+  # Fail early on column expressions, 'VisibleP[0]' or 'isIn10kton', of
+  # branches the tree does not have
+  if schema is None:
+    return
+  missing = [ expr for expr in exprs if expr.split( '[' )[0] not in schema ]
+  if missing:
+    raise ValueError( 'Unknown branches %s' % ', '.join( missing ) )
+# def checkBranches()
+
+def asExpression( selection, default = Fiducial ):
+
+  # selection as an Expression, from its text, default when it is None
+  if selection is None:
+    selection = default
+  if isinstance( selection, Expression ):
+    return selection
+  return parseExpression( selection )
+# def asExpression()
+
+def bindSelection( tree, selection, exprs = (), default = Fiducial ):
+
+  # selection bound to the branches of tree, which also has to have the
+  # columns exprs of the variables
+  schema = treeSchema( tree )
+  selection = asExpression( selection, default ).bind( schema )
+  checkBranches( schema, exprs )
+  return selection
+# def bindSelection()
+
+def selectionMask( columns, selection = None, default = Fiducial ):
+
+  # The events of the columns passing selection, an Expression or its text
+  return asExpression( selection, default ).mask( columns )
+# def selectionMask()
+
+def loadConfig( fName ):
+
+  # The settings of a JSON config, only the keys of ConfigKeys
+  config = json.load( open( fName ) )
+  unknown = [ key for key in config if key not in ConfigKeys ]
+  if unknown:
+    raise ValueError( 'Unknown keys %s in the config %s, expected %s' % ( ', '.join( unknown ), fName, ', '.join( ConfigKeys ) ) )
+  if 'selection' in config:
+    parseExpression( config['selection'] )
+  return config
+# def loadConfig()
+
+def columnExpr( name, index ):
+
+  return name if index is None else '%s[%d]' % ( name, index )
+# def columnExpr()
+
+
+class Parser( object ):
+
+  # Recursive descent over the tokens, building the tree of the expression
+  # out of tuples:
+  #   ( 'number', value ), ( 'branch', name, index or None ),
+  #   ( 'call', function, argument ), ( 'unary', op, operand ),
+  #   ( 'binary', op, left, right )
+  def __init__( self, text ):
+    self.text   = text
+    self.tokens = tokenize( text )
+    self.i      = 0
+
+  def error( self, message ):
+    kind, value, position = self.tokens[self.i]
+    raise ValueError( "%s at %d in the expression '%s'" % ( message, position, self.text ) )
+
+  def peek( self ):
+    return self.tokens[self.i][1] if self.tokens[self.i][0] in [ 'op', 'end' ] else None
+
+  def take( self, value ):
+    if self.peek() != value:
+      self.error( "Expected '%s'" % value if value else "Unexpected '%s'" % self.tokens[self.i][1] )
+    self.i += 1
+
+  def parse( self ):
+    node = self.binary( 0 )
+    self.take( '' )
+    return node
+
+  def binary( self, level ):
+    if level == len( Precedence ):
+      return self.unary()
+    node = self.binary( level + 1 )
+    while self.peek() in Precedence[level]:
+      op = self.peek()
+      self.i += 1
+      node = ( 'binary', op, node, self.binary( level + 1 ) )
+      if op in Comparisons and self.peek() in Comparisons:
+        self.error( 'Chained comparison' )
+    return node
+
+  def unary( self ):
+    if self.peek() in [ '!', '-', '+' ]:
+      op = self.peek()
+      self.i += 1
+      operand = self.unary()
+      return operand if op == '+' else ( 'unary', op, operand )
+    return self.primary()
+
+  def primary( self ):
+    kind, value, position = self.tokens[self.i]
+    if kind == 'number':
+      self.i += 1
+      return ( 'number', float( value ) )
+    if kind == 'name':
+      self.i += 1
+      if self.peek() == '(':
+        if value not in Functions:
+          self.i -= 1
+          self.error( "Unknown function '%s'" % value )
+        self.i += 1
+        node = ( 'call', value, self.binary( 0 ) )
+        self.take( ')' )
+        return node
+      index = None
+      if self.peek() == '[':
+        self.i += 1
+        if self.tokens[self.i][0] != 'number' or not self.tokens[self.i][1].isdigit():
+          self.error( 'Expected an element index' )
+        index = int( self.tokens[self.i][1] )
+        self.i += 1
+        self.take( ']' )
+      return ( 'branch', value, index )
+    if value == '(':
+      self.i += 1
+      node = self.binary( 0 )
+      self.take( ')' )
+      return node
+    self.error( 'Unexpected %s' % ( "'%s'" % value if value else 'end' ) )
+
+# class Parser
+
+
+class Expression( object ):
+
+  # A parsed expression, evaluated on a dict of columns keyed by the
+  # column expressions of self.columns.  It only holds tuples, so that it
+  # can be shipped to worker processes.
+  def __init__( self, text, node ):
+    self.text    = text
+    self.node    = node
+    self.columns = []
+    self.findColumns( node )
+
+  def findColumns( self, node ):
+    if node[0] == 'branch':
+      expr = columnExpr( node[1], node[2] )
+      if expr not in self.columns:
+        self.columns.append( expr )
+    for child in node[1:]:
+      if isinstance( child, tuple ):
+        self.findColumns( child )
+
+  def bind( self, schema ):
+    # The expression with the branches checked against the schema of
+    # treeSchema(), the vectors reading their leading element
+    if schema is None:
+      return self
+    return Expression( self.text, self.bindNode( self.node, schema ) )
+
+  def bindNode( self, node, schema ):
+    if node[0] == 'branch':
+      name, index = node[1], node[2]
+      if name not in schema:
+        raise ValueError( "Unknown branch '%s' in the expression '%s'" % ( name, self.text ) )
+      if not schema[name] and index is not None:
+        raise ValueError( "The branch '%s' of the expression '%s' is not a vector" % ( name, self.text ) )
+      return ( 'branch', name, 0 if schema[name] and index is None else index )
+    return tuple( [ self.bindNode( child, schema ) if isinstance( child, tuple ) else child for child in node ] )
+
+  def __call__( self, columns ):
+    if numexpr is not None and self.columns:
+      names = dict( ( expr, 'c%d' % i ) for i, expr in enumerate( self.columns ) )
+      return numexpr.evaluate( self.numexprText( self.node, names ), local_dict = dict( ( names[expr], columns[expr] ) for expr in self.columns ) )
+    return self.evaluate( self.node, columns )
+
+  def mask( self, columns ):
+    # The boolean mask of the events of the columns, also for a constant
+    # expression
+    n = len( columns[self.columns[0]] ) if self.columns else len( list( columns.values() )[0] )
+    return numpy.broadcast_to( numpy.asarray( self( columns ) ) != 0, ( n, ) )
+
+  def evaluate( self, node, columns ):
+    kind = node[0]
+    if kind == 'number':
+      return node[1]
+    if kind == 'branch':
+      return columns[columnExpr( node[1], node[2] )]
+    if kind == 'call':
+      return Functions[node[1]][0]( self.evaluate( node[2], columns ) )
+    if kind == 'unary':
+      operand = self.evaluate( node[2], columns )
+      return numpy.logical_not( operand ) if node[1] == '!' else numpy.negative( operand )
+    return Operators[node[1]]( self.evaluate( node[2], columns ), self.evaluate( node[3], columns ) )
+
+  def isBoolean( self, node ):
+    return node[0] in [ 'unary', 'binary' ] and ( node[1] in Logical or node[1] in Comparisons )
+
+  def numexprText( self, node, names ):
+    # numexpr has & | ~ on booleans only, the other operands of the
+    # logical operators are compared to 0
+    kind = node[0]
+    if kind == 'number':
+      return repr( node[1] )
+    if kind == 'branch':
+      return names[columnExpr( node[1], node[2] )]
+    if kind == 'call':
+      return '%s(%s)' % ( Functions[node[1]][2], self.numexprText( node[2], names ) )
+    if kind == 'unary':
+      if node[1] == '!':
+        return '(~%s)' % self.logicalText( node[2], names )
+      return '(-%s)' % self.numexprText( node[2], names )
+    if node[1] in Logical:
+      return '(%s %s %s)' % ( self.logicalText( node[2], names ), node[1][0], self.logicalText( node[3], names ) )
+    return '(%s %s %s)' % ( self.numexprText( node[2], names ), node[1], self.numexprText( node[3], names ) )
+
+  def logicalText( self, node, names ):
+    text = self.numexprText( node, names )
+    return text if self.isBoolean( node ) else '(%s != 0)' % text
+
+  def toCpp( self, node = None ):
+    # The expression for RDataFrame Define and Filter, the branches read as
+    # double like the NumPy columns
+    if node is None:
+      node = self.node
+    kind = node[0]
+    if kind == 'number':
+      return '%.17g' % node[1]
+    if kind == 'branch':
+      return 'double( %s )' % columnExpr( node[1], node[2] )
+    if kind == 'call':
+      return '%s( %s )' % ( Functions[node[1]][1], self.toCpp( node[2] ) )
+    if kind == 'unary':
+      return '%s( %s )' % ( node[1], self.toCpp( node[2] ) )
+    return '( %s %s %s )' % ( self.toCpp( node[2] ), node[1], self.toCpp( node[3] ) )
+
+  def __str__( self ):
+    return self.text
+
+# class Expression
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Check an expression against the branches of a tree and print its columns and C++ form.' )
+  parser.add_argument( 'expression', type = str, help = 'The expression.' )
+  parser.add_argument( '-i', dest = 'fNames', type = str, nargs = '+', default = [], help = 'The ROOT files of the tree to check the branches against.' )
+  parser.add_argument( '-t', dest = 'tName', type = str, default = 'MCParticles', help = 'The tree name.  Default MCParticles.' )
+
+  args = parser.parse_args()
+
+  expression = parseExpression( args.expression )
+  if args.fNames:
+    from mcReader import getTree
+    expression = expression.bind( treeSchema( getTree( args.fNames, args.tName ) ) )
+  print( 'Columns: %s' % ', '.join( expression.columns ) )
+  print( 'C++:     %s' % expression.toCpp() )
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import numpy
+
+# The Asimov discovery significance of s signal events over b expected
+# background events,
+#
+#   Z^2 = 2*( (s + b)*ln(1 + s/b) - s )
+#
+# and its inverse, the signal needed for a Z sigma discovery, for whole
+# arrays of backgrounds at once.
+
+def asimovTerm( x ):
+
+  # (1 + x)*ln(1 + x) - x, with its series below x = 1e-3 where the two
+  # terms cancel: x^2/2 - x^3/6 + x^4/12
+  x = numpy.asarray( x, dtype = numpy.float64 )
+  small = numpy.abs( x ) < 1e-3
+  with numpy.errstate( divide = 'ignore', invalid = 'ignore' ):
+    exact = ( 1. + x )*numpy.log1p( x ) - x
+  return numpy.where( small, x*x*( 0.5 - x/6. + x*x/12. ), exact )
+# def asimovTerm()
+
+def discoverySignificance( s, b ):
+
+  # Z of s signal events over b background events.  Without background any
+  # signal is an infinitely significant discovery, negative backgrounds
+  # give NaN.
+  s = numpy.asarray( s, dtype = numpy.float64 )
+  b = numpy.asarray( b, dtype = numpy.float64 )
+  with numpy.errstate( divide = 'ignore', invalid = 'ignore' ):
+    Z = numpy.sqrt( 2.*b*asimovTerm( s/b ) )
+  return numpy.where( b > 0., Z, numpy.where( b == 0., numpy.where( s > 0., numpy.inf, 0. ), numpy.nan ) )
+# def discoverySignificance()
+
+def discoverySignal( b, Z = 5., tolerance = 1e-12, maxIterations = 100 ):
+
+  # The signal s of Z sigma significance over each background b, the root of
+  #   f(s) = 2*b*asimovTerm( s/b ) - Z^2,  f'(s) = 2*ln(1 + s/b)
+  # f is increasing and convex, so Newton iterations started above the root
+  # decrease monotonically to it.  The start
+  #   s0 = ( Z^2 + sqrt( Z^4 + 4 Z^2 b ) )/2,  i.e. s0/sqrt(s0 + b) = Z
+  # is always above it, as the Asimov Z is larger than s/sqrt(s + b), and
+  # follows the root down to b -> 0, where it goes to 0 as Z^2/(2 ln(s/b)).
+  # b = 0 gives s = 0 and negative backgrounds NaN.
+  b = numpy.asarray( b, dtype = numpy.float64 )
+  Z2 = float( Z )**2
+  positive = b > 0.
+  bPos = numpy.where( positive, b, 1. )
+
+  s = 0.5*( Z2 + numpy.sqrt( Z2*Z2 + 4.*Z2*bPos ) )
+  for iteration in range( maxIterations ):
+    step = ( 2.*bPos*asimovTerm( s/bPos ) - Z2 )/( 2.*numpy.log1p( s/bPos ) )
+    s = s - step
+    if ( numpy.abs( step ) <= tolerance*s ).all():
+      break
+
+  return numpy.where( positive, s, numpy.where( b == 0., 0., numpy.nan ) )
+# def discoverySignal()
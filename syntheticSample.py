@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import numpy
+
+# Synthetic MCParticles samples with the branches the analyses read, to
+# measure their throughput without the production files.  A sample is a
+# dict of columns, the per-event branches as arrays and the vector branches
+# as ( counts, values ) pairs, the number of elements of every event and
+# their values concatenated.  It is written to a ROOT file (PyROOT needed)
+# or to a columnar .npz file.
+#
+# The leading particle vectors '<var>P' and '<var>Angle' have at least one
+# element, 0 momentum when nothing is visible as in the production files,
+# and the signal angles are peaked forward while the atmos ones are
+# isotropic.
+
+# The '<var>P' and '<var>Angle' vectors read by the scripts
+LeadingVars = [ 'InParticle', 'OutParticle',
+                'Visible', 'VisibleNoN', 'LeadingParticle', 'LeadingParticleNoN',
+                'SmearedVisible', 'SmearedVisibleNon', 'SmearedReconstructable', 'SmearedReconstructableNoN',
+                'LeadingSmeared', 'LeadingSmearedNoN', 'LeadingSmearedReconstructable', 'LeadingSmearedReconstructableNoN' ]
+
+# The 'n<Particle>s' counts and '<Particle>Px/Py/Pz/P/E' vectors of the
+# notebooks and jaggedArrays, with the particle masses in GeV
+Particles = { 'Proton': 0.938272, 'Neutron': 0.939565 }
+
+Kinds   = [ 'atmos', 'signal' ]
+Formats = [ 'root', 'npz' ]
+
+def jagged( counts, values ):
+
+  return ( numpy.asarray( counts, dtype = numpy.int32 ), numpy.asarray( values, dtype = numpy.float64 ) )
+# def jagged()
+
+def makeColumns( nEvents, kind = 'atmos', seed = 1 ):
+
+  rng = numpy.random.RandomState( seed )
+  columns = {}
+  columns['Event']      = numpy.arange( nEvents, dtype = numpy.int32 )
+  columns['isIn10kton'] = ( rng.uniform( size = nEvents ) < 0.75 ).astype( numpy.int32 )
+  columns['nVisible']   = rng.poisson( 2. if kind == 'signal' else 1.5, nEvents ).astype( numpy.int32 )
+
+  counts = numpy.maximum( columns['nVisible'], 1 )
+  size = int( counts.sum() )
+  first = numpy.concatenate( ( [ 0 ], numpy.cumsum( counts )[:-1] ) )
+  for var in LeadingVars:
+    p = rng.exponential( 1., size )
+    # Nothing visible, or randomly lost by the variants with fewer particles
+    p[first[columns['nVisible'] == 0]] = 0.
+    p[first[rng.uniform( size = nEvents ) < 0.05]] = 0.
+    if kind == 'signal':
+      costheta = numpy.maximum( 1. - rng.exponential( 0.15, size ), -1. )
+    else:
+      costheta = rng.uniform( -1., 1., size )
+    columns['%sP' % var]     = jagged( counts, p )
+    columns['%sAngle' % var] = jagged( counts, numpy.arccos( costheta ) )
+
+  for particle, mass in Particles.items():
+    n = rng.poisson( 1.2, nEvents ).astype( numpy.int32 )
+    size = int( n.sum() )
+    px, py, pz = rng.normal( 0., 0.3, size ), rng.normal( 0., 0.3, size ), rng.normal( 0.2, 0.4, size )
+    p = numpy.sqrt( px*px + py*py + pz*pz )
+    columns['n%ss' % particle] = n
+    columns['%sPx' % particle] = jagged( n, px )
+    columns['%sPy' % particle] = jagged( n, py )
+    columns['%sPz' % particle] = jagged( n, pz )
+    columns['%sP' % particle]  = jagged( n, p )
+    columns['%sE' % particle]  = jagged( n, numpy.sqrt( p*p + mass*mass ) )
+
+  # The incoming DM direction read by jaggedArrays, along z with a small
+  # spread
+  dm = numpy.ones( nEvents, dtype = numpy.int32 )
+  columns['InDMPx'] = jagged( dm, rng.normal( 0., 0.05, nEvents ) )
+  columns['InDMPy'] = jagged( dm, rng.normal( 0., 0.05, nEvents ) )
+  columns['InDMPz'] = jagged( dm, numpy.ones( nEvents ) )
+
+  return columns
+# def makeColumns()
+
+def writeColumnar( columns, fName ):
+
+  # The vectors are stored as '<name>.counts' and '<name>.values'
+  arrays = {}
+  for name, column in columns.items():
+    if isinstance( column, tuple ):
+      arrays['%s.counts' % name], arrays['%s.values' % name] = column
+    else:
+      arrays[name] = column
+  tmpName = '%s.%d.tmp.npz' % ( fName[:-4], os.getpid() )
+  numpy.savez( tmpName, **arrays )
+  os.rename( tmpName, fName )
+# def writeColumnar()
+
+def loadColumnar( fName ):
+
+  arrays = numpy.load( fName )
+  columns = {}
+  for key in arrays.files:
+    if key.endswith( '.counts' ):
+      name = key[:-len( '.counts' )]
+      columns[name] = ( arrays[key], arrays['%s.values' % name] )
+    elif not key.endswith( '.values' ):
+      columns[key] = arrays[key]
+  return columns
+# def loadColumnar()
+
+ReaderCode = '''
+ROOT::RVec<double> syntheticVector( ULong64_t values, ULong64_t offsets, ULong64_t entry ) {
+  const double* v = reinterpret_cast<const double*>( values );
+  const Long64_t* o = reinterpret_cast<const Long64_t*>( offsets );
+  return ROOT::RVec<double>( v + o[entry], v + o[entry + 1] );
+}
+int syntheticInt( ULong64_t values, ULong64_t entry ) { return reinterpret_cast<const int*>( values )[entry]; }
+'''
+
+def writeROOT( columns, fName, tName = 'MCParticles' ):
+
+  # The columns are defined on an empty RDataFrame straight from the NumPy
+  # buffers and snapshot in one event loop.  PyROOT is only needed here.
+  import ROOT
+  if not hasattr( ROOT, 'syntheticVector' ):
+    ROOT.gInterpreter.Declare( ReaderCode )
+
+  nEvents = len( columns['Event'] )
+  buffers = []
+  df = ROOT.RDataFrame( nEvents )
+  for name in sorted( columns.keys() ):
+    column = columns[name]
+    if isinstance( column, tuple ):
+      counts, values = column
+      offsets = numpy.concatenate( ( [ 0 ], numpy.cumsum( counts, dtype = numpy.int64 ) ) ).astype( numpy.int64 )
+      values = numpy.ascontiguousarray( values, dtype = numpy.float64 )
+      buffers += [ offsets, values ]
+      df = df.Define( name, 'syntheticVector( %dULL, %dULL, rdfentry_ )' % ( values.ctypes.data, offsets.ctypes.data ) )
+    else:
+      column = numpy.ascontiguousarray( column, dtype = numpy.int32 )
+      buffers.append( column )
+      df = df.Define( name, 'syntheticInt( %dULL, rdfentry_ )' % column.ctypes.data )
+
+  names = ROOT.std.vector( 'string' )()
+  for name in sorted( columns.keys() ):
+    names.push_back( name )
+  tmpName = '%s.%d.tmp.root' % ( fName[:-5], os.getpid() )
+  df.Snapshot( tName, tmpName, names )
+  os.rename( tmpName, fName )
+# def writeROOT()
+
+def writeSample( fName, nEvents, kind = 'atmos', seed = 1, fmt = None ):
+
+  if fmt is None:
+    fmt = 'npz' if fName.endswith( '.npz' ) else 'root'
+  columns = makeColumns( nEvents, kind, seed )
+  if fmt == 'npz':
+    writeColumnar( columns, fName )
+  else:
+    writeROOT( columns, fName )
+  return fName
+# def writeSample()
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser( description = 'Generate a synthetic MCParticles sample.' )
+  parser.add_argument( '-o', dest = 'oFile', type = str, help = 'The output file, .root or .npz.' )
+  parser.add_argument( '-n', dest = 'nEvents', type = int, default = 100000, help = 'The number of events.  Default 100000.' )
+  parser.add_argument( '-k', dest = 'kind', type = str, default = 'atmos', choices = Kinds, help = 'The kind of events.  Default atmos.' )
+  parser.add_argument( '-f', dest = 'fmt', type = str, default = None, choices = Formats,
+                      help = 'The output format.  Default from the file extension.' )
+  parser.add_argument( '--seed', dest = 'seed', type = int, default = 1, help = 'The random seed.  Default 1.' )
+
+  args = parser.parse_args()
+
+  print( 'Wrote %d %s events to %s' % ( args.nEvents, args.kind, writeSample( args.oFile, args.nEvents, args.kind, args.seed, args.fmt ) ) )